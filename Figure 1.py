@@ -1,5 +1,4 @@
 #Figure 1
-import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import os
@@ -8,13 +7,22 @@ warnings.filterwarnings('ignore')
 import matplotlib.gridspec as gridspec
 from matplotlib.patches import Rectangle
 import matplotlib.patches as mpatches
-
-plt.rcParams['font.sans-serif'] = ['Arial', 'DejaVu Sans', 'Liberation Sans', 'sans-serif']
-plt.rcParams['axes.unicode_minus'] = False
+from matplotlib.collections import PolyCollection
+import re
+from concurrent.futures import ProcessPoolExecutor
+from figure_export import export_figure
+from figure_loader import call_figure_function
+from gbd_io import filter_frame, read_workbook
+from instrumentation import set_rows, set_trace_output_dir, stage, traced
+import joinpoint_engine
+import stage_cache
+from joinpoint_engine import joinpoint_regression
+from stage_cache import cached, input_digest, source_digest, stage_key
 
 class JoinpointAnalysisRefined:
-    def __init__(self, file_path):
+    def __init__(self, file_path, joinpoint_source='sheets'):
         self.file_path = file_path
+        self.joinpoint_source = joinpoint_source
         self.diseases = ['ADHD', 'ASD', 'Epilepsy', 'Hearing Loss', 'Intellectual Disability', 'Vision Loss']
         self.disease_mapping = {
             'ADHD': 'Attention-deficit/hyperactivity disorder',
@@ -43,11 +51,19 @@ class JoinpointAnalysisRefined:
             "Vision loss": "#CC79A7"
         }
         
+        # created by run_figure1/run_figure1_batch when they write to it, not here
         self.output_dir = os.path.expanduser("~/Desktop/GBD")
-        if not os.path.exists(self.output_dir):
-            os.makedirs(self.output_dir)
+        
+        self.location = 'Global'
+        self.sex = 'Both'
+        self.age = '<20 years'
+        self.series_keys = ['location', 'sex', 'age', 'cause', 'measure']
         
         self.max_joinpoints = 5
+        self.n_permutations = 4499
+        self.n_jobs = None
+        self.use_cache = stage_cache.ENABLED
+        self.smoothing_kernels = {}
     
     def set_plot_style(self):
         plt.style.use('default')
@@ -68,17 +84,21 @@ class JoinpointAnalysisRefined:
     
     def load_data(self):
         try:
-            self.raw_data = pd.read_excel(self.file_path, sheet_name='Sheet1', engine='openpyxl')
-            self.aapc_data = pd.read_excel(self.file_path, sheet_name='Sheet2', engine='openpyxl')
-            try:
-                self.apc_data = pd.read_excel(self.file_path, sheet_name='Sheet3', engine='openpyxl')
-            except:
-                self.apc_data = self.aapc_data.copy()
+            with stage('load_data'):
+                sheets = read_workbook(self.file_path, ['Sheet1', 'Sheet2', 'Sheet3'], use_cache=self.use_cache)
+                self.raw_data = sheets['Sheet1']
+                set_rows(len(self.raw_data))
+            self.aapc_data = None
+            self.apc_data = None
+            if self.joinpoint_source != 'native':
+                if 'Sheet2' in sheets:
+                    self.aapc_data = sheets['Sheet2']
+                    self.apc_data = sheets['Sheet3'] if 'Sheet3' in sheets else self.aapc_data.copy()
+                else:
+                    print("Sheet2 not available, fitting joinpoint models from Sheet1")
             
-            for df in [self.raw_data, self.aapc_data, self.apc_data]:
-                df.columns = df.columns.astype(str).str.strip()
-                for col in df.select_dtypes(include=['object']):
-                    df[col] = df[col].astype(str).str.replace('＜', '<').str.replace('（', '(').str.replace('）', ')')
+            if self.aapc_data is None:
+                self.fit_native_joinpoints()
             
             print("Data loaded successfully!")
             print(f"Raw data columns: {self.raw_data.columns.tolist()}")
@@ -90,66 +110,114 @@ class JoinpointAnalysisRefined:
             print(f"Data loading failed: {e}")
             return False
     
+    def joinpoint_cache_key(self):
+        return stage_key('joinpoint', input_digest(self.file_path), self.max_joinpoints,
+                         self.n_permutations, source_digest(joinpoint_engine))
+    
+    @stage('statistics')
+    def fit_native_joinpoints(self):
+        def fit():
+            print(f"Fitting joinpoint models (up to {self.max_joinpoints} joinpoints) for all series...")
+            return joinpoint_regression(
+                self.raw_data, max_joinpoints=self.max_joinpoints,
+                n_permutations=self.n_permutations, n_jobs=self.n_jobs
+            )
+        
+        if self.use_cache:
+            self.apc_data, self.aapc_data = cached(self.joinpoint_cache_key(), fit)
+        else:
+            self.apc_data, self.aapc_data = fit()
+        print(f"Joinpoint models fitted - APC segments: {len(self.apc_data)}, series: {len(self.aapc_data)}")
+        set_rows(len(self.aapc_data))
+    
+    @stage('preprocess')
     def preprocess_data(self):
-        condition = (
-            (self.raw_data['age'] == '<20 years') &
-            (self.raw_data['sex'] == 'Both') &
-            (self.raw_data['location'] == 'Global')
-        )
-        
-        aapc_condition = (
-            (self.aapc_data['age'] == '<20 years') &
-            (self.aapc_data['sex'] == 'Both') &
-            (self.aapc_data['location'] == 'Global')
-        )
-        
-        apc_condition = (
-            (self.apc_data['age'] == '<20 years') &
-            (self.apc_data['sex'] == 'Both') &
-            (self.apc_data['location'] == 'Global')
-        )
-        
-        self.filtered_raw = self.raw_data[condition].copy()
-        self.filtered_aapc = self.aapc_data[aapc_condition].copy()
-        self.filtered_apc = self.apc_data[apc_condition].copy()
-        
         disease_patterns = list(self.disease_mapping.values())
         disease_patterns.extend(['Autism spectrum disorder', 'Attention deficit hyperactivity disorder'])
         
-        self.filtered_raw = self.filtered_raw[self.filtered_raw['cause'].isin(disease_patterns)].copy()
-        self.filtered_aapc = self.filtered_aapc[self.filtered_aapc['cause'].isin(disease_patterns)].copy()
-        self.filtered_apc = self.filtered_apc[self.filtered_apc['cause'].isin(disease_patterns)].copy()
+        disease_filter = [('cause', 'in', disease_patterns)]
+        disease_raw = filter_frame(self.raw_data, disease_filter)
+        disease_aapc = filter_frame(self.aapc_data, disease_filter)
+        disease_apc = filter_frame(self.apc_data, disease_filter)
+        
+        self.build_series_store(disease_raw, disease_aapc, disease_apc)
+        
+        # filter_frame takes one boolean selection per table; the results are not copied again
+        selection = [('age', '==', self.age), ('sex', '==', self.sex), ('location', '==', self.location)]
+        self.filtered_raw = filter_frame(disease_raw, selection)
+        self.filtered_aapc = filter_frame(disease_aapc, selection)
+        self.filtered_apc = filter_frame(disease_apc, selection)
         
         print(f"Filtered data count - Raw: {len(self.filtered_raw)}, AAPC: {len(self.filtered_aapc)}, APC: {len(self.filtered_apc)}")
+        set_rows(len(self.filtered_raw))
+    
+    def build_series_store(self, disease_raw, disease_aapc, disease_apc):
+        keys = self.series_keys
+        value_cols = [col for col in ['val', 'upper', 'lower'] if col in disease_raw.columns]
+        
+        yearly = disease_raw.groupby(keys + ['year'], sort=True)[value_cols].mean()
+        self.series_store = {}
+        for key, group in yearly.groupby(level=keys, sort=False):
+            series = {'year': group.index.get_level_values('year').to_numpy()}
+            for col in ['val', 'upper', 'lower']:
+                series[col] = group[col].to_numpy(dtype=float) if col in group.columns else np.full(len(group), np.nan)
+            self.series_store[key] = series
+        
+        if 'Segment Start' in disease_apc.columns:
+            disease_apc = disease_apc.sort_values('Segment Start')
+        self.apc_store = {key: group for key, group in disease_apc.groupby(keys, sort=False)}
+        self.aapc_store = {key: group for key, group in disease_aapc.groupby(keys, sort=False)}
+        self.empty_apc = disease_apc.iloc[0:0]
+        self.empty_aapc = disease_aapc.iloc[0:0]
+    
+    def series_key(self, disease_name, measure):
+        return (self.location, self.sex, self.age, disease_name, measure)
     
     def get_disease_color(self, disease_name):
         return self.disease_colors.get(disease_name, '#7F7F7F')
     
-    def create_smooth_curve_numpy(self, years, values):
+    def get_smoothing_kernel(self, window_size):
+        if window_size not in self.smoothing_kernels:
+            window = np.hanning(window_size)
+            self.smoothing_kernels[window_size] = window / window.sum()
+        return self.smoothing_kernels[window_size]
+    
+    def create_smooth_curves_numpy(self, years, values):
+        # values: 2-D stack of series sharing the year grid `years`
         try:
-            valid_mask = ~np.isnan(values)
-            clean_years = np.array(years)[valid_mask]
-            clean_values = np.array(values)[valid_mask]
+            years = np.asarray(years, dtype=float)
+            values = np.array(values, dtype=float, ndmin=2)
             
-            if len(clean_years) < 2:
+            # gaps are bridged linearly so every row stays on the shared grid
+            for row in np.where(np.isnan(values).any(axis=1))[0]:
+                valid = ~np.isnan(values[row])
+                if valid.any():
+                    values[row] = np.interp(years, years[valid], values[row, valid])
+            
+            if len(years) < 2:
                 return years, values
             
-            num_points = max(len(clean_years) * 5, 100)
-            years_dense = np.linspace(clean_years.min(), clean_years.max(), num_points)
+            num_points = max(len(years) * 5, 100)
+            years_dense = np.linspace(years.min(), years.max(), num_points)
             
-            values_dense = np.interp(years_dense, clean_years, clean_values)
+            idx = np.clip(np.searchsorted(years, years_dense, side='right') - 1, 0, len(years) - 2)
+            frac = (years_dense - years[idx]) / (years[idx + 1] - years[idx])
+            values_dense = values[:, idx] * (1 - frac) + values[:, idx + 1] * frac
             
-            if len(values_dense) > 10:
-                window_size = min(15, len(values_dense) // 6)
+            if num_points > 10:
+                window_size = min(15, num_points // 6)
                 if window_size > 1:
-                    window = np.hanning(window_size)
-                    window /= window.sum()
+                    window = self.get_smoothing_kernel(window_size)
                     
-                    values_smooth = np.convolve(values_dense, window, mode='same')
+                    # same as np.convolve(row, window, mode='same') for every row
+                    padded = np.pad(values_dense, ((0, 0), (window_size - 1, window_size - 1)))
+                    windows = np.lib.stride_tricks.sliding_window_view(padded, window_size, axis=1)
+                    start = (window_size - 1) // 2
+                    values_smooth = windows[:, start:start + num_points] @ window[::-1]
                     
                     half_window = window_size // 2
-                    values_smooth[:half_window] = values_dense[:half_window]
-                    values_smooth[-half_window:] = values_dense[-half_window:]
+                    values_smooth[:, :half_window] = values_dense[:, :half_window]
+                    values_smooth[:, -half_window:] = values_dense[:, -half_window:]
                     
                     values_dense = values_smooth
             
@@ -159,16 +227,26 @@ class JoinpointAnalysisRefined:
             print(f"Smooth curve error: {e}")
             return years, values
     
+    def create_smooth_curve_numpy(self, years, values):
+        try:
+            valid_mask = ~np.isnan(values)
+            clean_years = np.array(years, dtype=float)[valid_mask]
+            clean_values = np.array(values, dtype=float)[valid_mask]
+            
+            if len(clean_years) < 2:
+                return years, values
+            
+            years_dense, values_dense = self.create_smooth_curves_numpy(clean_years, clean_values[None, :])
+            return years_dense, values_dense[0]
+            
+        except Exception as e:
+            print(f"Smooth curve error: {e}")
+            return years, values
+    
     def get_enhanced_apc_summary_text(self, disease_name, measure):
-        disease_apc = self.filtered_apc[
-            (self.filtered_apc['cause'] == disease_name) &
-            (self.filtered_apc['measure'] == measure)
-        ].copy()
-        
-        disease_aapc = self.filtered_aapc[
-            (self.filtered_aapc['cause'] == disease_name) &
-            (self.filtered_aapc['measure'] == measure)
-        ].copy()
+        key = self.series_key(disease_name, measure)
+        disease_apc = self.apc_store.get(key, self.empty_apc)
+        disease_aapc = self.aapc_store.get(key, self.empty_aapc)
         
         if len(disease_apc) == 0 and len(disease_aapc) == 0:
             return "Data not available"
@@ -176,9 +254,7 @@ class JoinpointAnalysisRefined:
         apc_lines = []
         
         if len(disease_apc) > 0:
-            segments = disease_apc.sort_values('Segment Start') if 'Segment Start' in disease_apc.columns else disease_apc
-            
-            for _, segment in segments.iterrows():
+            for _, segment in disease_apc.iterrows():
                 try:
                     if 'Segment Start' in segment and 'Segment End' in segment:
                         start_year = int(segment['Segment Start'])
@@ -210,8 +286,7 @@ class JoinpointAnalysisRefined:
                 except:
                     continue
         else:
-            apc_lines.append("1990–2005: APC=+1.20% (95% UI: 0.85–1.55), p<0.05")
-            apc_lines.append("2005–2021: APC=-0.75% (95% UI: -1.20– -0.30), p<0.05")
+            apc_lines.append("APC: N/A")
         
         if len(disease_aapc) > 0:
             try:
@@ -232,7 +307,11 @@ class JoinpointAnalysisRefined:
                         elif 'p<0.01' in p_val or 'p＜0.01' in p_val:
                             p_display = ', p<0.01'
                         else:
-                            p_display = ''
+                            try:
+                                p_num = float(p_val.replace('p=', ''))
+                                p_display = f', p={p_num:.3f}' if p_num < 0.1 else ', p>0.05'
+                            except:
+                                p_display = ''
                         
                         aapc_line = f"AAPC: {aapc_value:+.2f}% (95% UI: {ui_low:.2f}–{ui_high:.2f}){p_display}"
                     else:
@@ -247,20 +326,15 @@ class JoinpointAnalysisRefined:
         return "\n".join(apc_lines)
     
     def get_joinpoints_from_data(self, disease_name, measure):
-        disease_apc = self.filtered_apc[
-            (self.filtered_apc['cause'] == disease_name) &
-            (self.filtered_apc['measure'] == measure)
-        ].copy()
+        segments = self.apc_store.get(self.series_key(disease_name, measure), self.empty_apc)
         
         joinpoint_years = []
-        if len(disease_apc) > 1:
-            segments = disease_apc.sort_values('Segment Start') if 'Segment Start' in disease_apc.columns else disease_apc
+        if len(segments) > 1:
             for i in range(1, len(segments)):
                 try:
-                    if 'Segment Start' in segments.columns:
-                        jp_year = int(segments.iloc[i]['Segment Start'])
-                    else:
-                        jp_year = 1990 + i * 10
+                    if 'Segment Start' not in segments.columns:
+                        break
+                    jp_year = int(segments.iloc[i]['Segment Start'])
                     if 1990 <= jp_year <= 2021:
                         joinpoint_years.append(jp_year)
                 except:
@@ -268,7 +342,7 @@ class JoinpointAnalysisRefined:
         
         return joinpoint_years
     
-    def plot_disease_refined(self, ax, disease, measure, row_idx, col_idx):
+    def prepare_panel_data(self, disease, measure):
         disease_full_name = self.disease_mapping[disease]
         
         possible_names = [
@@ -277,71 +351,43 @@ class JoinpointAnalysisRefined:
             disease_full_name.replace('disorder', 'disorders')
         ]
         
-        disease_raw = pd.DataFrame()
+        series = None
         actual_name = disease_full_name
         
         for name in possible_names:
-            temp_raw = self.filtered_raw[
-                (self.filtered_raw['cause'] == name) & 
-                (self.filtered_raw['measure'] == measure)
-            ].copy()
-            if len(temp_raw) > 0:
-                disease_raw = temp_raw
+            series = self.series_store.get(self.series_key(name, measure))
+            if series is not None:
                 actual_name = name
                 break
         
-        if len(disease_raw) == 0:
-            ax.text(0.5, 0.5, f'Data Not Available', 
-                   transform=ax.transAxes, ha='center', va='center',
-                   fontsize=12, fontweight='bold',
-                   bbox=dict(boxstyle="round,pad=0.3", facecolor="#F0F0F0", alpha=0.8))
-            
-            ax.set_xlabel('Year', fontsize=11)
-            if col_idx == 0:
-                unit_text = '(per 100,000)' if measure == 'Prevalence' else '(per 100,000, log scale)' if measure == 'DALYs' else ''
-                ax.set_ylabel(f'{measure} {unit_text}', fontsize=11)
-            return
+        if series is None:
+            return {'status': 'missing'}
         
         main_color = self.get_disease_color(actual_name)
         
-        years = sorted(disease_raw['year'].unique())
-        values = []
-        upper_vals = []
-        lower_vals = []
-        
-        for year in years:
-            year_data = disease_raw[disease_raw['year'] == year]
-            if len(year_data) > 0:
-                val = year_data['val'].mean()
-                values.append(val)
-                
-                if 'upper' in year_data.columns:
-                    upper_val = year_data['upper'].mean()
-                    upper_vals.append(upper_val)
-                else:
-                    upper_vals.append(np.nan)
-                
-                if 'lower' in year_data.columns:
-                    lower_val = year_data['lower'].mean()
-                    lower_vals.append(lower_val)
-                else:
-                    lower_vals.append(np.nan)
-            else:
-                values.append(np.nan)
-                upper_vals.append(np.nan)
-                lower_vals.append(np.nan)
+        years = series['year']
+        values = series['val']
+        upper_vals = series['upper']
+        lower_vals = series['lower']
         
         valid_indices = ~np.isnan(values)
         if not np.any(valid_indices):
-            ax.text(0.5, 0.5, f'No Valid Data', 
-                   transform=ax.transAxes, ha='center', va='center',
-                   fontsize=12, fontweight='bold')
-            return
+            return {'status': 'empty'}
             
-        valid_years = np.array(years)[valid_indices]
-        valid_values = np.array(values)[valid_indices]
-        valid_upper = np.array(upper_vals)[valid_indices]
-        valid_lower = np.array(lower_vals)[valid_indices]
+        valid_years = years[valid_indices]
+        valid_values = values[valid_indices]
+        valid_upper = upper_vals[valid_indices]
+        valid_lower = lower_vals[valid_indices]
+        
+        panel = {
+            'status': 'ok',
+            'color': main_color,
+            'band': None,
+            'segments': [],
+            'joinpoints': np.empty((0, 2)),
+            'trend': None,
+            'ylim': None,
+        }
         
         has_valid_ui = False
         if len(valid_upper) > 0 and len(valid_lower) > 0:
@@ -356,10 +402,9 @@ class JoinpointAnalysisRefined:
                 ui_lower = valid_lower[ui_valid]
                 
                 if len(ui_years) > 1:
-                    years_smooth_ui, upper_smooth = self.create_smooth_curve_numpy(ui_years, ui_upper)
-                    _, lower_smooth = self.create_smooth_curve_numpy(ui_years, ui_lower)
-                    ax.fill_between(years_smooth_ui, lower_smooth, upper_smooth, 
-                                   alpha=0.25, color='gray', zorder=1)
+                    years_smooth_ui, ui_smooth = self.create_smooth_curves_numpy(ui_years, np.vstack([ui_upper, ui_lower]))
+                    upper_smooth, lower_smooth = ui_smooth
+                    panel['band'] = (years_smooth_ui, lower_smooth, upper_smooth)
         
         joinpoint_years = self.get_joinpoints_from_data(actual_name, measure)
         
@@ -376,52 +421,114 @@ class JoinpointAnalysisRefined:
                 seg_values = valid_values[seg_mask]
                 
                 if len(seg_years) >= 2:
-                    years_smooth, values_smooth = self.create_smooth_curve_numpy(seg_years, seg_values)
-                    
-                    ax.plot(years_smooth, values_smooth, color=main_color, 
-                           linewidth=3.5, alpha=0.9, zorder=3, solid_capstyle='round')
+                    panel['segments'].append(self.create_smooth_curve_numpy(seg_years, seg_values))
         else:
             if len(valid_years) > 1:
-                years_smooth, values_smooth = self.create_smooth_curve_numpy(valid_years, valid_values)
-                ax.plot(years_smooth, values_smooth, color=main_color, 
-                       linewidth=3.5, alpha=0.9, zorder=3, solid_capstyle='round')
+                panel['segments'].append(self.create_smooth_curve_numpy(valid_years, valid_values))
         
         if joinpoint_years:
+            points = []
             for jp_year in joinpoint_years:
-                year_diffs = [abs(year - jp_year) for year in valid_years]
-                closest_idx = year_diffs.index(min(year_diffs))
-                
-                if closest_idx < len(valid_values):
-                    ax.scatter([valid_years[closest_idx]], [valid_values[closest_idx]], 
-                             color='red', s=120, marker='D', zorder=5, 
-                             edgecolors='white', linewidths=2.5)
-        
-        disease_aapc = self.filtered_aapc[
-            (self.filtered_aapc['cause'] == actual_name) &
-            (self.filtered_aapc['measure'] == measure)
-        ]
+                closest_idx = int(np.argmin(np.abs(valid_years - jp_year)))
+                points.append((valid_years[closest_idx], valid_values[closest_idx]))
+            panel['joinpoints'] = np.array(points, dtype=float)
+        
+        disease_aapc = self.aapc_store.get(self.series_key(actual_name, measure), self.empty_aapc)
         
         if len(disease_aapc) > 0:
             try:
                 aapc_value = float(disease_aapc.iloc[0]['AAPC'])
-                
-                if len(valid_values) > 0:
-                    base_value = valid_values[0]
-                    aapc_trend_values = []
-                    
-                    for year in valid_years:
-                        years_elapsed = year - valid_years[0]
-                        trend_value = base_value * ((1 + aapc_value/100) ** years_elapsed)
-                        aapc_trend_values.append(trend_value)
-                    
-                    ax.plot(valid_years, aapc_trend_values, color='black', 
-                           linestyle='--', linewidth=2.5, alpha=0.8, zorder=2)
+                years_elapsed = valid_years - valid_years[0]
+                aapc_trend_values = valid_values[0] * ((1 + aapc_value/100) ** years_elapsed)
+                panel['trend'] = (valid_years, aapc_trend_values)
             except:
                 pass
         
-        summary_text = self.get_enhanced_apc_summary_text(actual_name, measure)
+        panel['summary'] = self.get_enhanced_apc_summary_text(actual_name, measure)
+        panel['log_scale'] = measure == 'DALYs' and np.min(valid_values) > 0
+        panel['xlim'] = (min(valid_years)-0.5, max(valid_years)+0.5)
         
-        ax.text(0.98, 0.02, summary_text, transform=ax.transAxes,
+        if has_valid_ui and not np.isnan(valid_lower).all() and not np.isnan(valid_upper).all():
+            y_min = np.nanmin(valid_lower)
+            y_max = np.nanmax(valid_upper)
+        else:
+            y_min, y_max = min(valid_values), max(valid_values)
+        
+        y_range = y_max - y_min
+        if y_range > 0:
+            margin = y_range * 0.1
+            if measure == 'DALYs' and y_min > 0:
+                panel['ylim'] = (y_min * 0.8, y_max * 1.2)
+            else:
+                panel['ylim'] = (y_min - margin, y_max + margin)
+        
+        year_range = max(valid_years) - min(valid_years)
+        if year_range > 25:
+            step = 5
+        elif year_range > 15:
+            step = 3
+        else:
+            step = 2
+        panel['xticks'] = list(range(int(min(valid_years)), int(max(valid_years))+1, step))
+        
+        return panel
+    
+    def get_ylabel(self, measure, status):
+        if status != 'ok':
+            unit_text = '(per 100,000)' if measure == 'Prevalence' else '(per 100,000, log scale)' if measure == 'DALYs' else ''
+            return f'{measure} {unit_text}'
+        if measure == 'DALYs':
+            return f'{measure}\n(per 100,000, log scale)'
+        return f'{measure}\n(per 100,000)'
+    
+    def style_panel_spines(self, ax):
+        for spine in ax.spines.values():
+            spine.set_color('#DDDDDD')
+            spine.set_linewidth(1)
+        ax.spines['top'].set_visible(False)
+        ax.spines['right'].set_visible(False)
+    
+    def plot_disease_refined(self, ax, disease, measure, row_idx, col_idx):
+        panel = self.prepare_panel_data(disease, measure)
+        
+        if panel['status'] == 'missing':
+            ax.text(0.5, 0.5, f'Data Not Available', 
+                   transform=ax.transAxes, ha='center', va='center',
+                   fontsize=12, fontweight='bold',
+                   bbox=dict(boxstyle="round,pad=0.3", facecolor="#F0F0F0", alpha=0.8))
+            
+            ax.set_xlabel('Year', fontsize=11)
+            if col_idx == 0:
+                ax.set_ylabel(self.get_ylabel(measure, 'missing'), fontsize=11)
+            return
+        
+        if panel['status'] == 'empty':
+            ax.text(0.5, 0.5, f'No Valid Data', 
+                   transform=ax.transAxes, ha='center', va='center',
+                   fontsize=12, fontweight='bold')
+            return
+        
+        main_color = panel['color']
+        
+        if panel['band'] is not None:
+            years_smooth_ui, lower_smooth, upper_smooth = panel['band']
+            ax.fill_between(years_smooth_ui, lower_smooth, upper_smooth, 
+                           alpha=0.25, color='gray', zorder=1)
+        
+        for years_smooth, values_smooth in panel['segments']:
+            ax.plot(years_smooth, values_smooth, color=main_color, 
+                   linewidth=3.5, alpha=0.9, zorder=3, solid_capstyle='round')
+        
+        if len(panel['joinpoints']):
+            ax.scatter(panel['joinpoints'][:, 0], panel['joinpoints'][:, 1], 
+                     color='red', s=120, marker='D', zorder=5, 
+                     edgecolors='white', linewidths=2.5)
+        
+        if panel['trend'] is not None:
+            ax.plot(panel['trend'][0], panel['trend'][1], color='black', 
+                   linestyle='--', linewidth=2.5, alpha=0.8, zorder=2)
+        
+        ax.text(0.98, 0.02, panel['summary'], transform=ax.transAxes,
                fontsize=9, verticalalignment='bottom', horizontalalignment='right',
                bbox=dict(boxstyle="round,pad=0.4", facecolor='white', 
                         edgecolor=main_color, alpha=0.95, linewidth=1.5),
@@ -430,51 +537,103 @@ class JoinpointAnalysisRefined:
         ax.set_xlabel('Year', fontsize=11)
         
         if col_idx == 0:
-            if measure == 'DALYs':
-                ax.set_ylabel(f'{measure}\n(per 100,000, log scale)', fontsize=11)
-                if len(valid_values) > 0 and np.min(valid_values) > 0:
-                    ax.set_yscale('log')
-            else:
-                ax.set_ylabel(f'{measure}\n(per 100,000)', fontsize=11)
+            ax.set_ylabel(self.get_ylabel(measure, 'ok'), fontsize=11)
+            if panel['log_scale']:
+                ax.set_yscale('log')
         
         ax.grid(True, alpha=0.4, linestyle='-', linewidth=0.5)
         
-        if len(valid_years) > 0:
-            ax.set_xlim(min(valid_years)-0.5, max(valid_years)+0.5)
-            
-            if has_valid_ui and not np.isnan(valid_lower).all() and not np.isnan(valid_upper).all():
-                y_min = np.nanmin(valid_lower)
-                y_max = np.nanmax(valid_upper)
-            else:
-                y_min, y_max = min(valid_values), max(valid_values)
-            
-            y_range = y_max - y_min
-            if y_range > 0:
-                margin = y_range * 0.1
-                if measure == 'DALYs' and y_min > 0:
-                    ax.set_ylim(y_min * 0.8, y_max * 1.2)
-                else:
-                    ax.set_ylim(y_min - margin, y_max + margin)
-            
-            year_range = max(valid_years) - min(valid_years)
-            if year_range > 25:
-                step = 5
-            elif year_range > 15:
-                step = 3
-            else:
-                step = 2
-            ax.set_xticks(range(int(min(valid_years)), int(max(valid_years))+1, step))
+        ax.set_xlim(*panel['xlim'])
+        if panel['ylim'] is not None:
+            ax.set_ylim(*panel['ylim'])
+        ax.set_xticks(panel['xticks'])
         
-        for spine in ax.spines.values():
-            spine.set_color('#DDDDDD')
-            spine.set_linewidth(1)
-        ax.spines['top'].set_visible(False)
-        ax.spines['right'].set_visible(False)
+        self.style_panel_spines(ax)
     
-    def create_refined_layout(self):
-        self.set_plot_style()
+    def create_panel_artists(self, ax, measure, col_idx):
+        artists = {
+            'measure': measure,
+            'col_idx': col_idx,
+            'band': PolyCollection([np.empty((0, 2))], color='gray', alpha=0.25, zorder=1),
+            'line': ax.plot([], [], linewidth=3.5, alpha=0.9, zorder=3, solid_capstyle='round')[0],
+            'trend': ax.plot([], [], color='black', linestyle='--', linewidth=2.5, alpha=0.8, zorder=2)[0],
+            'joinpoints': ax.scatter([], [], color='red', s=120, marker='D', zorder=5,
+                                     edgecolors='white', linewidths=2.5),
+            'summary': ax.text(0.98, 0.02, '', transform=ax.transAxes,
+                               fontsize=9, verticalalignment='bottom', horizontalalignment='right',
+                               bbox=dict(boxstyle="round,pad=0.4", facecolor='white', 
+                                         edgecolor='#7F7F7F', alpha=0.95, linewidth=1.5),
+                               fontfamily='monospace'),
+            'missing': ax.text(0.5, 0.5, 'Data Not Available', 
+                               transform=ax.transAxes, ha='center', va='center',
+                               fontsize=12, fontweight='bold',
+                               bbox=dict(boxstyle="round,pad=0.3", facecolor="#F0F0F0", alpha=0.8)),
+            'empty': ax.text(0.5, 0.5, 'No Valid Data', 
+                             transform=ax.transAxes, ha='center', va='center',
+                             fontsize=12, fontweight='bold'),
+        }
+        ax.add_collection(artists['band'])
+        ax.set_xlabel('Year', fontsize=11)
+        self.style_panel_spines(ax)
+        return artists
+    
+    def update_panel(self, ax, artists, panel):
+        status = panel['status']
+        ok = status == 'ok'
+        
+        artists['missing'].set_visible(status == 'missing')
+        artists['empty'].set_visible(status == 'empty')
+        for name in ['band', 'line', 'trend', 'joinpoints', 'summary']:
+            artists[name].set_visible(ok)
+        
+        if artists['col_idx'] == 0:
+            ax.set_ylabel(self.get_ylabel(artists['measure'], status), fontsize=11)
+            ax.set_yscale('log' if ok and panel['log_scale'] else 'linear')
+        ax.grid(ok, alpha=0.4, linestyle='-', linewidth=0.5)
+        
+        if not ok:
+            return
+        
+        if panel['band'] is not None:
+            years_smooth_ui, lower_smooth, upper_smooth = panel['band']
+            verts = np.concatenate([
+                np.column_stack([years_smooth_ui, lower_smooth]),
+                np.column_stack([years_smooth_ui[::-1], upper_smooth[::-1]])
+            ])
+            artists['band'].set_verts([verts])
+        else:
+            artists['band'].set_verts([np.empty((0, 2))])
+        
+        # segments share one line artist, separated by NaN breaks
+        line_x, line_y = [], []
+        for years_smooth, values_smooth in panel['segments']:
+            line_x.extend([years_smooth, [np.nan]])
+            line_y.extend([values_smooth, [np.nan]])
+        if line_x:
+            artists['line'].set_data(np.concatenate(line_x), np.concatenate(line_y))
+        else:
+            artists['line'].set_data([], [])
+        artists['line'].set_color(panel['color'])
+        
+        artists['joinpoints'].set_offsets(panel['joinpoints'])
+        
+        if panel['trend'] is not None:
+            artists['trend'].set_data(*panel['trend'])
+        else:
+            artists['trend'].set_data([], [])
+        
+        artists['summary'].set_text(panel['summary'])
+        artists['summary'].get_bbox_patch().set_edgecolor(panel['color'])
         
-        available_measures = self.filtered_raw['measure'].unique()
+        ax.set_xlim(*panel['xlim'])
+        if panel['ylim'] is not None:
+            ax.set_ylim(*panel['ylim'])
+        else:
+            ax.relim()
+            ax.autoscale_view()
+        ax.set_xticks(panel['xticks'])
+    
+    def get_measures_to_plot(self, available_measures):
         print(f"Available measures: {available_measures}")
         
         measures_to_plot = []
@@ -487,11 +646,11 @@ class JoinpointAnalysisRefined:
             print("No DALYs or Prevalence data found")
             if len(available_measures) > 0:
                 measures_to_plot = list(available_measures)[:2]
-            else:
-                return None
         
         print(f"Measures to plot: {measures_to_plot}")
-        
+        return measures_to_plot
+    
+    def create_layout_frame(self, measures_to_plot):
         fig = plt.figure(figsize=(24, 14))
         
         gs_main = gridspec.GridSpec(4, 1, height_ratios=[0.08, 3, 0.15, 0.2], hspace=0.08)
@@ -513,15 +672,12 @@ class JoinpointAnalysisRefined:
         gs_diseases = gridspec.GridSpecFromSubplotSpec(2, 6, gs_main[1], 
                                                       hspace=0.2, wspace=0.2)
         
-        if 'Prevalence' in measures_to_plot:
-            for i, disease in enumerate(self.diseases):
-                ax = fig.add_subplot(gs_diseases[0, i])
-                self.plot_disease_refined(ax, disease, 'Prevalence', row_idx=0, col_idx=i)
-        
-        if 'DALYs' in measures_to_plot:
-            for i, disease in enumerate(self.diseases):
-                ax = fig.add_subplot(gs_diseases[1, i])
-                self.plot_disease_refined(ax, disease, 'DALYs', row_idx=1, col_idx=i)
+        panels = []
+        for row_idx, measure in enumerate(['Prevalence', 'DALYs']):
+            if measure in measures_to_plot:
+                for i, disease in enumerate(self.diseases):
+                    ax = fig.add_subplot(gs_diseases[row_idx, i])
+                    panels.append((ax, disease, measure, row_idx, i))
         
         ax_legend = fig.add_subplot(gs_main[2])
         ax_legend.axis('off')
@@ -540,7 +696,7 @@ class JoinpointAnalysisRefined:
         ax_note = fig.add_subplot(gs_main[3])
         ax_note.axis('off')
         
-        note_text1 = "1. Joinpoint regression allowing up to a maximum of 5 joinpoints was used to identify periods of distinct trends."
+        note_text1 = f"1. Joinpoint regression allowing up to a maximum of {self.max_joinpoints} joinpoints was used to identify periods of distinct trends."
         note_text2 = "2. APC = annual percent change for each segment; AAPC = weighted average annual percent change across all segments."
         
         ax_note.text(0.0, 0.8, note_text1, ha='left', va='top',
@@ -548,11 +704,62 @@ class JoinpointAnalysisRefined:
         ax_note.text(0.0, 0.3, note_text2, ha='left', va='top',
                     transform=ax_note.transAxes, fontsize=11)
         
-        plt.tight_layout()
-        plt.subplots_adjust(top=0.95, bottom=0.05)
+        return fig, panels
+    
+    def create_refined_layout(self):
+        self.set_plot_style()
+        
+        measures_to_plot = self.get_measures_to_plot(self.filtered_raw['measure'].unique())
+        if len(measures_to_plot) == 0:
+            return None
+        
+        fig, panels = self.create_layout_frame(measures_to_plot)
+        
+        for ax, disease, measure, row_idx, col_idx in panels:
+            with stage(f'render.{disease}.{measure}'):
+                self.plot_disease_refined(ax, disease, measure, row_idx=row_idx, col_idx=col_idx)
+        
+        with stage('tight_layout'):
+            plt.tight_layout()
+            plt.subplots_adjust(top=0.95, bottom=0.05)
         
         return fig
     
+    def create_figure_template(self, measures_to_plot):
+        self.set_plot_style()
+        
+        fig, panels = self.create_layout_frame(measures_to_plot)
+        header = fig.text(0.5, 0.995, '', ha='center', va='top', fontsize=14, fontweight='bold')
+        
+        template = {'fig': fig, 'header': header, 'panels': []}
+        for ax, disease, measure, row_idx, col_idx in panels:
+            artists = self.create_panel_artists(ax, measure, col_idx)
+            template['panels'].append((ax, disease, measure, artists))
+        
+        fig.tight_layout()
+        fig.subplots_adjust(top=0.95, bottom=0.05)
+        return template
+    
+    def render_template(self, template, location, sex, age):
+        self.location, self.sex, self.age = location, sex, age
+        template['header'].set_text(f'{location}, {sex}, {age}')
+        for ax, disease, measure, artists in template['panels']:
+            self.update_panel(ax, artists, self.prepare_panel_data(disease, measure))
+        return template['fig']
+    
+    def get_series_selections(self):
+        return sorted({key[:3] for key in self.series_store})
+    
+    def get_store_subset(self, selections):
+        selections = set(selections)
+        return {
+            'series_store': {k: v for k, v in self.series_store.items() if k[:3] in selections},
+            'apc_store': {k: v for k, v in self.apc_store.items() if k[:3] in selections},
+            'aapc_store': {k: v for k, v in self.aapc_store.items() if k[:3] in selections},
+            'empty_apc': self.empty_apc,
+            'empty_aapc': self.empty_aapc,
+        }
+    
     def generate_analysis(self):
         if not self.load_data():
             return None
@@ -564,20 +771,22 @@ class JoinpointAnalysisRefined:
         
         return fig
 
-def run_figure1(file_path):
-    analyzer = JoinpointAnalysisRefined(file_path)
+@traced('Figure1')
+def run_figure1(file_path, joinpoint_source='sheets', output_dir=None):
+    analyzer = JoinpointAnalysisRefined(file_path, joinpoint_source)
+    if output_dir:
+        analyzer.output_dir = output_dir
+    os.makedirs(analyzer.output_dir, exist_ok=True)
+    set_trace_output_dir(analyzer.output_dir)
     fig = analyzer.generate_analysis()
     
     if fig is not None:
         try:
-            output_path = os.path.join(analyzer.output_dir, 'Figure1_Joinpoint_Analysis.png')
-            fig.savefig(output_path, dpi=300, bbox_inches='tight', 
-                       facecolor='white', edgecolor='none')
-            print(f"Figure 1 saved: {output_path}")
-            
-            pdf_path = os.path.join(analyzer.output_dir, 'Figure1_Joinpoint_Analysis.pdf')
-            fig.savefig(pdf_path, bbox_inches='tight', facecolor='white')
-            print(f"Figure 1 PDF saved: {pdf_path}")
+            with stage('export'):
+                paths = export_figure(fig, os.path.join(analyzer.output_dir, 'Figure1_Joinpoint_Analysis'),
+                                      {'png': 300, 'pdf': None}, facecolor='white', edgecolor='none')
+            print(f"Figure 1 saved: {paths['png']}")
+            print(f"Figure 1 PDF saved: {paths['pdf']}")
             
         except Exception as e:
             print(f"Error saving Figure 1: {e}")
@@ -586,6 +795,68 @@ def run_figure1(file_path):
         return True
     return False
 
+def series_file_stem(location, sex, age):
+    label = f'{location} {sex} {age}'.replace('<', 'under ').replace('+', ' plus')
+    return 'Figure1_' + re.sub(r'[^0-9A-Za-z]+', '_', label).strip('_')
+
+def render_series_batch(file_path, output_dir, measures_to_plot, selections, stores, formats):
+    plt.switch_backend('Agg')
+    analyzer = JoinpointAnalysisRefined(file_path)
+    analyzer.output_dir = output_dir
+    for name, value in stores.items():
+        setattr(analyzer, name, value)
+    
+    template = analyzer.create_figure_template(measures_to_plot)
+    saved = []
+    for location, sex, age in selections:
+        fig = analyzer.render_template(template, location, sex, age)
+        stem = series_file_stem(location, sex, age)
+        paths = export_figure(fig, os.path.join(output_dir, stem),
+                              {fmt: 300 if fmt != 'pdf' else None for fmt in formats},
+                              n_jobs=1, facecolor='white', edgecolor='none')
+        saved.extend(paths.values())
+    
+    plt.close(template['fig'])
+    return saved
+
+@traced('Figure1_batch')
+def run_figure1_batch(file_path, joinpoint_source='sheets', output_dir=None, n_jobs=None, formats=('png', 'pdf')):
+    analyzer = JoinpointAnalysisRefined(file_path, joinpoint_source)
+    if not analyzer.load_data():
+        return False
+    analyzer.preprocess_data()
+    
+    output_dir = output_dir or os.path.join(analyzer.output_dir, 'Figure1_batch')
+    os.makedirs(output_dir, exist_ok=True)
+    set_trace_output_dir(output_dir)
+    
+    selections = analyzer.get_series_selections()
+    measures_to_plot = analyzer.get_measures_to_plot(sorted({key[4] for key in analyzer.series_store}))
+    if not selections or not measures_to_plot:
+        print("No series found for Figure 1 batch mode")
+        return False
+    
+    n_workers = max(1, min(n_jobs or os.cpu_count() or 1, len(selections)))
+    chunks = [selections[i::n_workers] for i in range(n_workers)]
+    print(f"Rendering Figure 1 for {len(selections)} location/sex/age groups on {n_workers} worker(s)...")
+    
+    saved = []
+    with stage('render_batch'), ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [
+            pool.submit(call_figure_function, 1, 'render_series_batch', file_path, output_dir,
+                        measures_to_plot, chunk, analyzer.get_store_subset(chunk), formats)
+            for chunk in chunks
+        ]
+        for future in futures:
+            try:
+                saved.extend(future.result())
+            except Exception as e:
+                print(f"Error rendering Figure 1 batch: {e}")
+                return False
+    
+    print(f"Figure 1 batch saved {len(saved)} files to: {output_dir}")
+    return True
+
 if __name__ == "__main__":
     file_path = "/～/data.xlsx"
     run_figure1(file_path)
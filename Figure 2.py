@@ -3,104 +3,53 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import numpy as np
 import os
+import aapc_engine
+import gbd_io
+import joinpoint_engine
+from aapc_engine import draw_aapc, grouped_log_linear
+from gbd_io import ingest_key, iter_gbd_filtered
+from instrumentation import set_rows, stage, traced
+from stage_cache import cached, input_digest, source_digest, stage_key
 
-def manual_linregress(x, y):
-    x = np.array(x, dtype=float)
-    y = np.array(y, dtype=float)
-    n = len(x)
-    
-    if n < 2:
-        return 0, 0, 0, 1.0, 0
-    
-    x_mean = np.mean(x)
-    y_mean = np.mean(y)
-    
-    numerator = np.sum((x - x_mean) * (y - y_mean))
-    denominator = np.sum((x - x_mean) ** 2)
-    
-    if denominator == 0:
-        return 0, y_mean, 0, 1.0, 0
-    
-    slope = numerator / denominator
-    intercept = y_mean - slope * x_mean
-    
-    y_pred = slope * x + intercept
-    ss_res = np.sum((y - y_pred) ** 2)
-    ss_tot = np.sum((y - y_mean) ** 2)
-    
-    if ss_tot == 0:
-        r_squared = 1.0
-    else:
-        r_squared = max(0, 1 - (ss_res / ss_tot))
-    
-    r_value = np.sqrt(r_squared) if slope >= 0 else -np.sqrt(r_squared)
-    
-    if n > 2:
-        mse = ss_res / (n - 2)
-        var_slope = mse / denominator if denominator > 0 else 0
-        std_err = np.sqrt(var_slope) if var_slope > 0 else 0
-    else:
-        std_err = 0
-    
-    if std_err > 0:
-        t_stat = abs(slope / std_err)
-        if t_stat > 2.58:
-            p_value = 0.01
-        elif t_stat > 1.96:
-            p_value = 0.05
-        else:
-            p_value = 0.1
-    else:
-        p_value = 1.0
-    
-    return slope, intercept, r_value, p_value, std_err
-
-def calculate_aapc(df, measure, diseases):
+def aapc_results_from_table(aapc_table, measure, diseases):
     aapc_results = []
     for cause in diseases:
-        subset = df[(df['cause'] == cause) & (df['measure'] == measure)]
-        if not subset.empty:
-            years = subset['year']
-            values = subset['val']
-            slope, intercept, r_value, p_value, std_err = manual_linregress(years, np.log(values))
-            aapc = (np.exp(slope) - 1) * 100
-            ci_low = (np.exp(slope - 1.96 * std_err) - 1) * 100
-            ci_high = (np.exp(slope + 1.96 * std_err) - 1) * 100
+        row = aapc_table[(aapc_table['cause'] == cause) & (aapc_table['measure'] == measure)]
+        if not row.empty:
+            row = row.iloc[0]
+            p_value = row['p_value']
             significance = '*' if p_value < 0.05 else ''
             p_value_text = 'p < 0.05' if p_value < 0.05 else f'p = {p_value:.2f}'
-            aapc_results.append((cause, aapc, ci_low, ci_high, significance, p_value_text))
+            aapc_results.append((cause, row['aapc'], row['ci_low'], row['ci_high'], significance, p_value_text,
+                                 row.get('p_draws', np.nan)))
     return aapc_results
 
-def run_figure2(file_path, output_dir):
-    os.makedirs(output_dir, exist_ok=True)
-    
-    data = pd.read_csv(file_path)
-    
-    diseases = ["Attention-deficit/hyperactivity disorder", "Autism spectrum disorders", 
-                "Epilepsy", "Hearing loss", "Intellectual disability", "Vision loss"]
-    labels = ["ADHD", "ASD", "Epilepsy", "Hearing Loss", "Intellectual disability", "Vision Loss"]
-    
-    disease_label_map = dict(zip(diseases, labels))
-    
-    filtered_data = data[
-        (data['cause'].isin(diseases)) &
-        (data['location'] == 'Global') &
-        (data['sex'] == 'Both') &
-        (data['age'].str.contains('<20')) &
-        (data['metric'] == 'Rate') &
-        (data['year'].between(1990, 2021))
-    ].copy()
-    
-    prevalence_aapc = calculate_aapc(filtered_data, 'Prevalence', diseases)
-    dalys_aapc = calculate_aapc(filtered_data, 'DALYs', diseases)
-    prevalence_df = pd.DataFrame(prevalence_aapc, columns=['cause', 'aapc_prevalence', 'ci_low_prevalence', 'ci_high_prevalence', 'significance_prevalence', 'p_value_prevalence'])
-    dalys_df = pd.DataFrame(dalys_aapc, columns=['cause', 'aapc_dalys', 'ci_low_dalys', 'ci_high_dalys', 'significance_dalys', 'p_value_dalys'])
-    
-    merged_df = prevalence_df.merge(dalys_df, on='cause')
-    merged_df = merged_df.sort_values(by='aapc_prevalence', ascending=False)
-    
-    merged_df.to_csv(os.path.join(output_dir, 'Figure2_AAPC_Results.csv'), index=False)
-    
+def apply_draw_intervals(aapc_table, draw_table, keys=('cause', 'measure')):
+    # uncertainty from the GBD draws (2.5th/97.5th percentiles of the per-draw AAPCs)
+    # in place of the OLS interval; the point estimate and p_value stay the log-linear fit's,
+    # and the draw-based p-value is added as p_draws
+    keys = list(keys)
+    table = aapc_table.astype({key: str for key in keys}).set_index(keys)
+    draws = draw_table.astype({key: str for key in keys}).set_index(keys)
+    table.update(draws[['ci_low', 'ci_high']])
+    table['p_draws'] = draws['p_draws'].reindex(table.index)
+    return table.reset_index()
+
+def figure2_filters(diseases):
+    return [
+        ('cause', 'in', diseases),
+        ('location', '==', 'Global'),
+        ('sex', '==', 'Both'),
+        ('age', 'contains', '<20'),
+        ('metric', '==', 'Rate'),
+        ('year', 'between', (1990, 2021)),
+    ]
+
+def aapc_cache_key(file_path, diseases):
+    return stage_key('aapc', ingest_key(file_path, figure2_filters(diseases)), ['cause', 'measure'],
+                     source_digest(aapc_engine, joinpoint_engine, gbd_io))
+
+def plot_aapc_comparison(merged_df, disease_label_map):
     colors_prevalence = '#E56F5E'
     colors_dalys = '#FAC795'
     
@@ -176,12 +125,56 @@ def run_figure2(file_path, output_dir):
     ax.tick_params(axis='x', which='major', length=6, width=0.5, direction='out')
     ax.tick_params(axis='x', which='minor', length=3, width=0.5, direction='out')
     ax.set_xticks(np.arange(x_min, x_max + 0.125, 0.125), minor=True)
+
+    return fig
+
+@traced('Figure2')
+def run_figure2(file_path, output_dir, data=None, draws_path=None):
+    os.makedirs(output_dir, exist_ok=True)
+    
+    diseases = ["Attention-deficit/hyperactivity disorder", "Autism spectrum disorders", 
+                "Epilepsy", "Hearing loss", "Intellectual disability", "Vision loss"]
+    labels = ["ADHD", "ASD", "Epilepsy", "Hearing Loss", "Intellectual disability", "Vision Loss"]
+    
+    disease_label_map = dict(zip(diseases, labels))
+    
+    filters = figure2_filters(diseases)
+    aapc_key = aapc_cache_key(file_path, diseases)
+    with stage('statistics'):
+        aapc_table = cached(aapc_key, lambda: pd.concat(
+            [grouped_log_linear(part, ['cause', 'measure'])
+             for part in iter_gbd_filtered(file_path, filters, ['cause', 'measure'], data)],
+            ignore_index=True))
+        set_rows(len(aapc_table))
+    if draws_path:
+        draws_key = stage_key('aapc_draws', input_digest(draws_path), filters, ['cause', 'measure'],
+                              source_digest(aapc_engine, joinpoint_engine, gbd_io))
+        with stage('draw_uncertainty'):
+            draw_table = cached(draws_key, lambda: draw_aapc(draws_path, ['cause', 'measure'], filters))
+            set_rows(len(draw_table))
+        print(f"Using draw-based 95% UI from {draws_path} ({int(draw_table['n_draws'].max())} draws)")
+        aapc_table = apply_draw_intervals(aapc_table, draw_table)
+    prevalence_aapc = aapc_results_from_table(aapc_table, 'Prevalence', diseases)
+    dalys_aapc = aapc_results_from_table(aapc_table, 'DALYs', diseases)
+    prevalence_df = pd.DataFrame(prevalence_aapc, columns=['cause', 'aapc_prevalence', 'ci_low_prevalence', 'ci_high_prevalence', 'significance_prevalence', 'p_value_prevalence', 'p_draws_prevalence'])
+    dalys_df = pd.DataFrame(dalys_aapc, columns=['cause', 'aapc_dalys', 'ci_low_dalys', 'ci_high_dalys', 'significance_dalys', 'p_value_dalys', 'p_draws_dalys'])
+    
+    merged_df = prevalence_df.merge(dalys_df, on='cause')
+    merged_df = merged_df.sort_values(by='aapc_prevalence', ascending=False)
+    if not draws_path:
+        merged_df = merged_df.drop(columns=['p_draws_prevalence', 'p_draws_dalys'])
+    
+    merged_df.to_csv(os.path.join(output_dir, 'Figure2_AAPC_Results.csv'), index=False)
+    
+    with stage('render'):
+        fig = plot_aapc_comparison(merged_df, disease_label_map)
     
     output_path = os.path.join(output_dir, 'Figure2_AAPC_Comparison.png')
-    plt.savefig(output_path, bbox_inches='tight', transparent=True, dpi=300)
+    with stage('savefig.png'):
+        fig.savefig(output_path, bbox_inches='tight', transparent=True, dpi=300)
     print(f"Figure 2 saved: {output_path}")
     
-    plt.close()
+    plt.close(fig)
     return True
 
 if __name__ == "__main__":
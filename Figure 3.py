@@ -5,40 +5,117 @@ import matplotlib.pyplot as plt
 import os
 from matplotlib.font_manager import FontProperties
 import warnings
+import gbd_io
+from gbd_io import ingest_key, iter_gbd_filtered
+from figure_export import export_figure, save_tiff_streaming
+from figure_fonts import resolve_font_families
+from instrumentation import set_rows, stage, traced
+from stage_cache import cached, source_digest, stage_key
 warnings.filterwarnings('ignore')
 
-plt.rcParams['figure.dpi'] = 300
-plt.rcParams['savefig.dpi'] = 600
-plt.rcParams['font.family'] = 'serif'
-plt.rcParams['font.serif'] = ['Times New Roman']
+SERIF_FONTS = ['Times New Roman', 'Times', 'Liberation Serif', 'Nimbus Roman', 'DejaVu Serif']
+
+LOCATIONS = [
+    'Global', 'High SDI', 'High-middle SDI', 'Middle SDI', 'Low-middle SDI', 'Low SDI',
+    'Andean Latin America', 'Australasia', 'Caribbean', 'Central Asia', 
+    'Central Europe', 'Central Latin America', 'Central Sub-Saharan Africa', 
+    'East Asia', 'Eastern Europe', 'Eastern Sub-Saharan Africa', 
+    'High-income Asia Pacific', 'High-income North America', 
+    'North Africa and Middle East', 'Oceania', 'South Asia', 
+    'South-East Asia Region', 'Southern Latin America', 
+    'Southern Sub-Saharan Africa', 'Tropical Latin America', 
+    'Western Europe', 'Western Sub-Saharan Africa'
+]
+YEARS = [1990, 2021]
+CAUSES = [
+    'Attention-deficit/hyperactivity disorder', 'Autism spectrum disorders', 
+    'Epilepsy', 'Hearing loss', 'Intellectual disability', 'Vision loss'
+]
+
+CAUSE_COLORS = {
+    "Attention-deficit/hyperactivity disorder": "#0072B2",
+    "Autism spectrum disorders": "#E69F00",
+    "Epilepsy": "#009E73",
+    "Hearing loss": "#F0E442",
+    "Intellectual disability": "#D55E00",
+    "Vision loss": "#CC79A7"
+}
+
+CAUSE_HATCHES = ['|||||', '/////', '\\\\\\\\\\\\\\\\\\\\', '++++', '----', 'oooo']
+
+def set_plot_style():
+    plt.rcParams['figure.dpi'] = 300
+    plt.rcParams['savefig.dpi'] = 600
+    plt.rcParams['font.family'] = 'serif'
+    plt.rcParams['font.serif'] = resolve_font_families(SERIF_FONTS)
 
 def ensure_dir(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
         print(f"Created directory: {directory}")
 
-def generate_percentage_tables(filtered_data, measures, years):
+def build_percentage_cube(filtered_data, measures, years, locations, causes):
+    # dense measure x year x location x cause array of cause shares, built once;
+    # filtered_data is a frame or an iterable of frames (chunked input), summed as they arrive
+    axes = [
+        ('measure', list(measures)),
+        ('year', list(years)),
+        ('location', list(locations)),
+        ('cause', list(causes)),
+    ]
+    shape = tuple(len(labels) for _, labels in axes)
+    val_sum = np.zeros(shape)
+    counts = np.zeros(shape)
+    
+    frames = [filtered_data] if isinstance(filtered_data, pd.DataFrame) else filtered_data
+    for frame in frames:
+        codes = [pd.Categorical(frame[col], categories=labels).codes for col, labels in axes]
+        keep = np.all([c >= 0 for c in codes], axis=0)
+        index = tuple(c[keep] for c in codes)
+        np.add.at(val_sum, index, frame['val'].to_numpy(dtype=float)[keep])
+        np.add.at(counts, index, 1)
+    
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.where(counts > 0, val_sum / counts, np.nan)
+        totals = np.nansum(values, axis=3, keepdims=True)
+        percentage = values / totals * 100
+    
+    return {
+        'measures': list(measures),
+        'years': list(years),
+        'locations': list(locations),
+        'causes': list(causes),
+        'percentage': percentage,
+        'present': counts > 0,
+    }
+
+def cube_slice(cube, measure, year):
+    m = cube['measures'].index(measure)
+    y = cube['years'].index(year)
+    present = cube['present'][m, y]
+    location_mask = present.any(axis=1)
+    cause_mask = present.any(axis=0)
+    if not location_mask.any():
+        return None
+    
+    data = np.nan_to_num(cube['percentage'][m, y][np.ix_(location_mask, cause_mask)])
+    return pd.DataFrame(
+        data,
+        index=pd.Index(np.array(cube['locations'])[location_mask], name='location'),
+        columns=pd.Index(np.array(cube['causes'])[cause_mask], name='cause'),
+    )
+
+def generate_percentage_tables(cube):
     print("Generating percentage data tables...")
     tables = {}
     
-    for measure in measures:
-        for year in years:
-            data_subset = filtered_data[
-                (filtered_data['year'] == year) & 
-                (filtered_data['measure'] == measure)
-            ]
+    for measure in cube['measures']:
+        for year in cube['years']:
+            pivot_table = cube_slice(cube, measure, year)
             
-            if len(data_subset) == 0:
+            if pivot_table is None:
                 continue
             
-            pivot_table = data_subset.pivot_table(
-                values='percentage', 
-                index='location', 
-                columns='cause', 
-                fill_value=0,
-                aggfunc='mean'
-            )
-            
             pivot_table = pivot_table.round(1)
             pivot_table['Total'] = pivot_table.sum(axis=1).round(1)
             tables[f'{measure}_{year}'] = pivot_table
@@ -78,22 +155,12 @@ def save_percentage_tables(tables, output_dir):
     
     return excel_path, final_csv_path
 
-def plot_stacked_bar(data, measure, year, ax, colors, hatches, annotate=True):
-    data_subset = data[
-        (data['year'] == year) & 
-        (data['measure'] == measure)
-    ]
+def plot_stacked_bar(cube, measure, year, ax, colors, hatches, annotate=True):
+    pivot_data = cube_slice(cube, measure, year)
     
-    if len(data_subset) == 0:
+    if pivot_data is None:
         return None
     
-    pivot_data = data_subset.pivot_table(
-        values='percentage', 
-        index='location', 
-        columns='cause', 
-        fill_value=0
-    )
-    
     color_list = [colors[cause] for cause in pivot_data.columns]
     
     bars = pivot_data.plot(
@@ -139,90 +206,76 @@ def plot_stacked_bar(data, measure, year, ax, colors, hatches, annotate=True):
     
     return bars
 
-def run_figure3(file_path, output_dir):
+def draw_measure_chart(container, cube, measure, years, colors, hatches):
+    # container is a Figure or a SubFigure, so the same drawing serves both layouts
+    axes = container.subplots(nrows=1, ncols=2, sharey=True)
+    container.subplots_adjust(hspace=0.3, wspace=0.05)
+
+    for j, year in enumerate(years):
+        plot_stacked_bar(cube, measure, year, axes[j], colors, hatches)
+
+    container.text(0.5, 0.9, f'{measure} (%)', ha='center', fontsize=18, fontweight='bold')
+    return axes
+
+def figure3_filters(measures, locations, years, causes):
+    return [
+        ('metric', '==', 'Rate'),
+        ('age', '==', '<20 years'),
+        ('sex', '==', 'Both'),
+        ('location', 'in', locations),
+        ('year', 'in', years),
+        ('measure', 'in', measures),
+        ('cause', 'in', causes),
+    ]
+
+@traced('Figure3')
+def run_figure3(file_path, output_dir, save_intermediate=False, data=None):
     ensure_dir(output_dir)
+    set_plot_style()
     
     measures = ['Prevalence', 'DALYs']
-    locations = [
-        'Global', 'High SDI', 'High-middle SDI', 'Middle SDI', 'Low-middle SDI', 'Low SDI',
-        'Andean Latin America', 'Australasia', 'Caribbean', 'Central Asia', 
-        'Central Europe', 'Central Latin America', 'Central Sub-Saharan Africa', 
-        'East Asia', 'Eastern Europe', 'Eastern Sub-Saharan Africa', 
-        'High-income Asia Pacific', 'High-income North America', 
-        'North Africa and Middle East', 'Oceania', 'South Asia', 
-        'South-East Asia Region', 'Southern Latin America', 
-        'Southern Sub-Saharan Africa', 'Tropical Latin America', 
-        'Western Europe', 'Western Sub-Saharan Africa'
-    ]
-    years = [1990, 2021]
-    causes = [
-        'Attention-deficit/hyperactivity disorder', 'Autism spectrum disorders', 
-        'Epilepsy', 'Hearing loss', 'Intellectual disability', 'Vision loss'
-    ]
+    locations = LOCATIONS
+    years = YEARS
+    causes = CAUSES
+    colors = CAUSE_COLORS
+    hatches = CAUSE_HATCHES
     
-    colors = {
-        "Attention-deficit/hyperactivity disorder": "#0072B2",
-        "Autism spectrum disorders": "#E69F00",
-        "Epilepsy": "#009E73",
-        "Hearing loss": "#F0E442",
-        "Intellectual disability": "#D55E00",
-        "Vision loss": "#CC79A7"
-    }
+    print("Reading data...")
+    filters = figure3_filters(measures, locations, years, causes)
+    cube_key = stage_key('percentage', ingest_key(file_path, filters), measures, years, locations, causes,
+                         source_digest(build_percentage_cube, gbd_io))
     
-    hatches = ['|||||', '/////', '\\\\\\\\\\\\\\\\\\\\', '++++', '----', 'oooo']
+    def load_cube():
+        def frames():
+            for filtered_data in iter_gbd_filtered(file_path, filters, ['location'], data):
+                print(f"Data loaded successfully, filtered rows: {len(filtered_data)}")
+                yield filtered_data
+        return build_percentage_cube(frames(), measures, years, locations[::-1], causes)
     
-    print("Reading data...")
     try:
-        data = pd.read_csv(file_path, encoding='utf-8')
-        print(f"Data loaded successfully, total rows: {len(data)}")
+        with stage('statistics'):
+            percentage_cube = cached(cube_key, load_cube)
+            set_rows(percentage_cube['present'].sum())
     except Exception as e:
         print(f"Error reading data: {e}")
         return False
     
-    print("Filtering data...")
-    filtered_data = data[
-        (data['metric'] == 'Rate') & 
-        (data['age'] == '<20 years') & 
-        (data['sex'] == 'Both') & 
-        (data['location'].isin(locations)) & 
-        (data['year'].isin(years)) & 
-        (data['measure'].isin(measures)) & 
-        (data['cause'].isin(causes))
-    ].copy()
-    
-    print(f"Filtered data rows: {len(filtered_data)}")
-    
-    filtered_data.loc[:, 'val_sum'] = filtered_data.groupby(['location', 'year', 'measure'])['val'].transform('sum')
-    filtered_data.loc[:, 'percentage'] = (filtered_data['val'] / filtered_data['val_sum']) * 100
-    
-    filtered_data['location'] = pd.Categorical(
-        filtered_data['location'], 
-        categories=locations[::-1], 
-        ordered=True
-    )
-    filtered_data = filtered_data.sort_values(
-        by=['location', 'year', 'measure'], 
-        ascending=[False, True, True]
-    )
-    
-    percentage_tables = generate_percentage_tables(filtered_data, measures, years)
-    excel_file, csv_file = save_percentage_tables(percentage_tables, output_dir)
-
-    print("Generating side-by-side charts...")
-    for measure in measures:
-        fig, axes = plt.subplots(nrows=1, ncols=2, figsize=(16, 14), sharey=True)
-        fig.subplots_adjust(hspace=0.3, wspace=0.05)
+    with stage('tables'):
+        percentage_tables = generate_percentage_tables(percentage_cube)
+        excel_file, csv_file = save_percentage_tables(percentage_tables, output_dir)
 
-        for j, year in enumerate(years):
-            ax = axes[j]
-            plot_stacked_bar(filtered_data, measure, year, ax, colors, hatches)
+    if save_intermediate:
+        print("Generating side-by-side charts...")
+        for measure in measures:
+            with stage(f'render.{measure}.integrated'):
+                fig = plt.figure(figsize=(16, 14))
+                draw_measure_chart(fig, percentage_cube, measure, years, colors, hatches)
 
-        fig.text(0.5, 0.9, f'{measure} (%)', ha='center', fontsize=18, fontweight='bold')
-
-        integrated_path = os.path.join(output_dir, f'Figure3_{measure}_integrated_plot.tiff')
-        plt.savefig(integrated_path, bbox_inches='tight', dpi=600, format='tiff')
-        plt.close()
-        print(f"Saved: {measure}_integrated_plot.tiff")
+            integrated_path = os.path.join(output_dir, f'Figure3_{measure}_integrated_plot.tiff')
+            with stage(f'savefig.{measure}.integrated.tiff'):
+                save_tiff_streaming(fig, integrated_path, dpi=600)
+            plt.close(fig)
+            print(f"Saved: {measure}_integrated_plot.tiff")
     
     legend_handles = []
     for i, cause in enumerate(causes):
@@ -233,32 +286,21 @@ def run_figure3(file_path, output_dir):
                              hatch=hatches[i] if i < len(hatches) else '')
         legend_handles.append(patch)
     
-    font_props = FontProperties(family='Times New Roman', size=14)
+    font_props = FontProperties(family=plt.rcParams['font.serif'], size=14)
     
     print("Generating combined plot...")
-    fig, axes = plt.subplots(nrows=2, ncols=1, figsize=(16, 28), sharey=True)
-    fig.subplots_adjust(hspace=0)
-
-    for i, measure in enumerate(measures):
-        img_path = os.path.join(output_dir, f'Figure3_{measure}_integrated_plot.tiff')
-        if os.path.exists(img_path):
-            try:
-                img = plt.imread(img_path)
-                axes[i].imshow(img)
-                axes[i].axis('off')
-            except Exception as e:
-                print(f"Image loading failed: {e}")
-                axes[i].text(0.5, 0.5, f'Loading {measure}...', 
-                           ha='center', va='center', transform=axes[i].transAxes)
+    fig = plt.figure(figsize=(16, 14 * len(measures)))
+    subfigs = fig.subfigures(nrows=len(measures), ncols=1, hspace=0, squeeze=False)[:, 0]
 
-        box = axes[i].get_position()
-        axes[i].set_position([box.x0, box.y0 + 0.08, box.width, box.height * 0.7])
+    for subfig, measure in zip(subfigs, measures):
+        with stage(f'render.{measure}'):
+            draw_measure_chart(subfig, percentage_cube, measure, years, colors, hatches)
 
     legend = fig.legend(
         legend_handles, 
         causes, 
-        loc='center right', 
-        bbox_to_anchor=(1.2, 0.5),
+        loc='center left', 
+        bbox_to_anchor=(0.93, 0.5),
         prop=font_props,
         handlelength=3.0,
         borderpad=1.2,
@@ -270,15 +312,11 @@ def run_figure3(file_path, output_dir):
         labelspacing=1.2
     )
 
-    fig.tight_layout(pad=0, rect=[0, 0, 0.93, 1])
-
-    final_combined_path = os.path.join(output_dir, 'Figure3_final.tiff')
-    plt.savefig(final_combined_path, bbox_inches='tight', dpi=600, format='tiff')
-    
-    png_path = os.path.join(output_dir, 'Figure3_final.png')
-    plt.savefig(png_path, bbox_inches='tight', dpi=300)
+    with stage('export'):
+        paths = export_figure(fig, os.path.join(output_dir, 'Figure3_final'), {'tiff': 600, 'png': 300, 'pdf': None})
+    final_combined_path, pdf_path = paths['tiff'], paths['pdf']
     
-    plt.close()
+    plt.close(fig)
     print(f"Final combined plot saved: {final_combined_path}")
 
     color_info = pd.DataFrame([
@@ -296,6 +334,7 @@ def run_figure3(file_path, output_dir):
     print(f"Chart generation completed.")
     print(f"Output files:")
     print(f"  - Combined plot: {final_combined_path}")
+    print(f"  - Vector plot: {pdf_path}")
     print(f"  - Data tables: {excel_file}")
     print(f"  - Combined data: {csv_file}")
     
@@ -0,0 +1,167 @@
+#AAPC engine
+import re
+import warnings
+import numpy as np
+import pandas as pd
+from gbd_io import iter_csv_chunks, read_csv_header, resolve_csv_sources
+from joinpoint_engine import t_critical, t_pvalue
+
+AAPC_GROUP_COLS = ['cause', 'measure', 'location', 'sex', 'age', 'metric']
+
+
+def grouped_log_linear(df, group_cols=AAPC_GROUP_COLS, year_col='year', value_col='val', alpha=0.05):
+    # ln(val) = a + b * year for every group, from per-group sums in one pass
+    group_cols = [col for col in group_cols if col in df.columns]
+    grouped = df.groupby(group_cols, sort=True, observed=True)
+    codes = grouped.ngroup().fillna(-1).to_numpy(dtype=int)
+    keys = grouped.size().index.to_frame(index=False)
+    n_groups = len(keys)
+
+    x = df[year_col].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.log(df[value_col].to_numpy(dtype=float))
+    valid = np.isfinite(x) & np.isfinite(y) & (codes >= 0)
+    codes, x, y = codes[valid], x[valid], y[valid]
+    year_origin = x.min() if len(x) else 0.0
+    x = x - year_origin
+
+    def segment_sum(values):
+        return np.bincount(codes, weights=values, minlength=n_groups)
+
+    n = np.bincount(codes, minlength=n_groups).astype(float)
+    sx, sy = segment_sum(x), segment_sum(y)
+    sxx, sxy, syy = segment_sum(x * x), segment_sum(x * y), segment_sum(y * y)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_mean = sx / n
+        y_mean = sy / n
+        sxx_c = sxx - sx * x_mean
+        sxy_c = sxy - sx * y_mean
+        syy_c = syy - sy * y_mean
+
+        slope = np.where(sxx_c > 0, sxy_c / sxx_c, 0.0)
+        intercept = y_mean - slope * x_mean
+        ss_res = np.maximum(syy_c - slope * sxy_c, 0)
+        r_squared = np.where(syy_c > 0, np.clip(1 - ss_res / syy_c, 0, 1), 1.0)
+        r_value = np.sign(slope) * np.sqrt(r_squared)
+
+        df_resid = n - 2
+        std_err = np.where((df_resid > 0) & (sxx_c > 0), np.sqrt(ss_res / np.maximum(df_resid, 1) / sxx_c), 0.0)
+        t_stat = np.where(std_err > 0, slope / std_err, 0.0)
+
+    p_value = np.where(std_err > 0, t_pvalue(t_stat, df_resid), 1.0)
+    t_crit = t_critical(df_resid, alpha)
+
+    result = keys
+    result['n'] = n.astype(int)
+    result['slope'] = slope
+    result['intercept'] = intercept
+    result['year_origin'] = year_origin
+    result['x_mean'] = x_mean
+    result['sxx'] = sxx_c
+    result['r_value'] = r_value
+    result['std_err'] = std_err
+    result['t_stat'] = t_stat
+    result['p_value'] = p_value
+    result['aapc'] = (np.exp(slope) - 1) * 100
+    result['ci_low'] = (np.exp(slope - t_crit * std_err) - 1) * 100
+    result['ci_high'] = (np.exp(slope + t_crit * std_err) - 1) * 100
+    return result[result['n'] > 0].reset_index(drop=True)
+
+
+def draw_columns(columns):
+    # draw_0 ... draw_999 in numeric order
+    draws = [col for col in columns if re.fullmatch(r'draw_\d+', str(col))]
+    return sorted(draws, key=lambda col: int(col[5:]))
+
+
+def _grow(array, rows):
+    grown = np.zeros((rows,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def draw_aapc(file_path, group_cols=AAPC_GROUP_COLS, filters=None, year_col='year', alpha=0.05,
+              chunksize=2_000, batch_size=10_000):
+    # AAPC of every draw of every series, from GBD draw files (one row per series-year with
+    # draw_0..draw_999), streamed in chunks of rows. Memory scales with the number of series,
+    # not the file size: per series only the log-linear sums are kept, one per draw.
+    # p_draws is the two-sided share of draws whose AAPC falls on the other side of zero,
+    # not a regression p-value.
+    sources = resolve_csv_sources(file_path)
+    header = read_csv_header(sources[0])
+    draws = draw_columns(header)
+    if not draws:
+        raise ValueError(f"No draw_* columns in {file_path}")
+    group_cols = [col for col in group_cols if col in header]
+    # a filter on a column the draw file lacks (e.g. location_id instead of location) would pool
+    # draws across the series it was meant to separate
+    missing = sorted({column for column, _, _ in filters or []} - set(header))
+    if missing:
+        raise ValueError(f"{file_path} has no {', '.join(missing)} column(s) to filter on; "
+                         f"draw files need the same label columns as the export")
+    usecols = group_cols + [year_col] + draws
+
+    group_ids = {}
+    capacity = 0
+    n = sx = sxx = np.zeros(0)
+    sy = sxy = np.zeros((0, len(draws)))
+    year_origin = None
+    for source in sources:
+        for _, chunk in iter_csv_chunks(source, filters, usecols=usecols, chunksize=chunksize):
+            if chunk.empty:
+                continue
+            keys = zip(*(chunk[col].tolist() for col in group_cols))
+            ids = np.fromiter((group_ids.setdefault(key, len(group_ids)) for key in keys),
+                              dtype=np.intp, count=len(chunk))
+            if len(group_ids) > capacity:
+                capacity = max(len(group_ids), 2 * capacity, 1024)
+                n, sx, sxx, sy, sxy = (_grow(a, capacity) for a in (n, sx, sxx, sy, sxy))
+
+            x = chunk[year_col].to_numpy(dtype=float)
+            if year_origin is None:
+                year_origin = x.min()
+            x = x - year_origin
+            with np.errstate(divide='ignore', invalid='ignore'):
+                y = np.log(chunk[draws].to_numpy(dtype=float))
+            y[~np.isfinite(y)] = np.nan
+
+            order = np.argsort(ids, kind='stable')
+            groups, starts = np.unique(ids[order], return_index=True)
+            x, y = x[order], y[order]
+            n[groups] += np.diff(np.append(starts, len(order)))
+            sx[groups] += np.add.reduceat(x, starts)
+            sxx[groups] += np.add.reduceat(x * x, starts)
+            sy[groups] += np.add.reduceat(y, starts, axis=0)
+            sxy[groups] += np.add.reduceat(x[:, None] * y, starts, axis=0)
+
+    n_groups = len(group_ids)
+    result = pd.DataFrame(list(group_ids), columns=group_cols)
+    stats_cols = {name: np.full(n_groups, np.nan) for name in
+                  ['aapc_mean', 'aapc_median', 'ci_low', 'ci_high', 'p_draws']}
+    n_valid = np.zeros(n_groups, dtype=int)
+    for start in range(0, n_groups, batch_size):
+        batch = slice(start, min(start + batch_size, n_groups))
+        n_b, sx_b, sxx_b = n[batch, None], sx[batch, None], sxx[batch, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (n_b * sxy[batch] - sx_b * sy[batch]) / (n_b * sxx_b - sx_b ** 2)
+        aapc = (np.exp(slope) - 1) * 100
+        valid = np.isfinite(aapc)
+        n_valid[batch] = valid.sum(axis=1)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            stats_cols['aapc_mean'][batch] = np.nanmean(aapc, axis=1)
+            low, median, high = np.nanpercentile(aapc, [alpha / 2 * 100, 50, (1 - alpha / 2) * 100], axis=1)
+        stats_cols['aapc_median'][batch] = median
+        stats_cols['ci_low'][batch] = low
+        stats_cols['ci_high'][batch] = high
+        # two-sided share of draws on the other side of zero
+        below = (aapc < 0).sum(axis=1) / np.maximum(n_valid[batch], 1)
+        stats_cols['p_draws'][batch] = np.minimum(2 * np.minimum(below, 1 - below), 1)
+
+    result['n'] = n[:n_groups].astype(int)
+    result['n_draws'] = n_valid
+    for name, values in stats_cols.items():
+        result[name] = values
+    result = result[result['n_draws'] > 0]
+    return result.sort_values(group_cols).reset_index(drop=True)
@@ -0,0 +1,167 @@
+#Age standardization
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from gbd_io import GBD_COLUMNS, LABEL_COLUMNS, filter_frame, read_gbd_csv
+
+POPULATION_DIMS = ['location', 'sex', 'age', 'year']
+# column names used by IHME population and standard-population downloads
+COLUMN_ALIASES = {'location_name': 'location', 'sex_name': 'sex', 'age_group_name': 'age', 'year_id': 'year'}
+UNDER_20_AGES = ['<5 years', '5-9 years', '10-14 years', '15-19 years']
+RATE_SCALE = 100_000
+STANDARD_POPULATION_FILE = os.environ.get('GBD_STANDARD_POPULATION')
+
+
+def normalize_columns(df):
+    return df.rename(columns={old: new for old, new in COLUMN_ALIASES.items()
+                              if old in df.columns and new not in df.columns})
+
+
+def read_population(path, filters=None):
+    # location x sex x age x year population; the value column is 'population' or 'val'
+    population = normalize_columns(pd.read_csv(path))
+    if 'population' not in population.columns:
+        population = population.rename(columns={'val': 'population'})
+    population = filter_frame(population, filters)
+    return population[POPULATION_DIMS + ['population']].reset_index(drop=True)
+
+
+def read_standard_population(path=None):
+    # the GBD world standard population as age -> weight, summing to 1. The weights are not bundled:
+    # they are read from IHME's published table, downloaded alongside the GBD export
+    path = path or STANDARD_POPULATION_FILE
+    if not path:
+        raise ValueError("No GBD standard population file given: download IHME's standard population table "
+                         "and pass it with --standard or set GBD_STANDARD_POPULATION")
+    standard = normalize_columns(pd.read_csv(path))
+    weight_col = next(col for col in ['weight', 'std_pop', 'standard_population', 'population', 'val']
+                      if col in standard.columns)
+    weights = standard.groupby('age', sort=False)[weight_col].sum().astype(float)
+    return weights / weights.sum()
+
+
+def population_table(population):
+    # dense location x sex x age x year array plus label indexes, so rows can be matched
+    # by integer gather instead of a merge
+    index = {dim: pd.Index(pd.unique(np.asarray(population[dim], dtype=object))) for dim in POPULATION_DIMS}
+    values = np.full(tuple(len(index[dim]) for dim in POPULATION_DIMS), np.nan)
+    values[tuple(index[dim].get_indexer(np.asarray(population[dim], dtype=object)) for dim in POPULATION_DIMS)] = \
+        population['population'].to_numpy(dtype=float)
+    return {'index': index, 'values': values}
+
+
+def lookup_population(frame, table):
+    # population of every row of a long-format frame (NaN where the table has none)
+    codes = [table['index'][dim].get_indexer(np.asarray(frame[dim], dtype=object)) for dim in POPULATION_DIMS]
+    found = np.all([code >= 0 for code in codes], axis=0)
+    population = np.full(len(frame), np.nan)
+    population[found] = table['values'][tuple(code[found] for code in codes)]
+    return population
+
+
+def age_specific_rates(counts, population):
+    # Number rows with their population and rate per 100,000 attached
+    table = population if isinstance(population, dict) else population_table(population)
+    counts = filter_frame(counts, [('metric', '==', 'Number')]) if 'metric' in counts.columns else counts
+    rates = counts.reset_index(drop=True)
+    rates['population'] = lookup_population(rates, table)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rates['rate'] = np.where(rates['population'] > 0, rates['val'].to_numpy(dtype=float) / rates['population'],
+                                 np.nan) * RATE_SCALE
+    return rates
+
+
+def _reduce_over_age(frame, ages, columns):
+    # sums of the given per-row arrays over the listed ages, per remaining label/year group;
+    # a group missing any of the ages (or their population) gets NaN
+    keys = [col for col in LABEL_COLUMNS + ['year'] if col in frame.columns and col not in ('age', 'metric')]
+    age_code = pd.Index(ages).get_indexer(np.asarray(frame['age'], dtype=object))
+    grouped = frame.groupby(keys, observed=True, sort=True)
+    codes = grouped.ngroup().to_numpy()
+    result = grouped.size().index.to_frame(index=False)
+
+    keep = age_code >= 0
+    for values in columns.values():
+        keep &= np.isfinite(values)
+    codes, age_code = codes[keep], age_code[keep]
+    # distinct ages per group: one bit per age
+    seen = np.zeros((len(result), len(ages)), dtype=bool)
+    seen[codes, age_code] = True
+    complete = seen.all(axis=1)
+
+    sums = {}
+    for name, values in columns.items():
+        total = np.bincount(codes, weights=values[keep], minlength=len(result))
+        sums[name] = np.where(complete, total, np.nan)
+    return result, sums
+
+
+def _long_format(keys, age, metric, val):
+    frame = keys.copy()
+    frame['age'] = age
+    frame['metric'] = metric
+    frame['val'] = val
+    frame['upper'] = np.nan
+    frame['lower'] = np.nan
+    return frame[[col for col in GBD_COLUMNS if col in frame.columns]]
+
+
+def age_aggregate(counts, population, ages=UNDER_20_AGES, label='<20 years'):
+    # custom age group from age-specific counts: summed Number and the pooled rate per 100,000.
+    # Uncertainty intervals do not add up across ages, so upper/lower are left empty.
+    rates = age_specific_rates(counts, population)
+    keys, sums = _reduce_over_age(rates, list(ages), {
+        'number': rates['val'].to_numpy(dtype=float),
+        'population': rates['population'].to_numpy(dtype=float),
+    })
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate = sums['number'] / sums['population'] * RATE_SCALE
+    return pd.concat([_long_format(keys, label, 'Number', sums['number']),
+                      _long_format(keys, label, 'Rate', rate)], ignore_index=True)
+
+
+def age_standardize(frame, standard, population=None, ages=None, label='Age-standardized'):
+    # direct standardization: sum over ages of standard weight x age-specific rate.
+    # Rates come from Number rows and `population`, or from the frame's Rate rows when no
+    # population is given; weights are renormalized over the ages used, which must all have a standard weight.
+    if population is not None:
+        rates = age_specific_rates(frame, population)
+        rate = rates['rate'].to_numpy(dtype=float)
+    else:
+        rates = filter_frame(frame, [('metric', '==', 'Rate')]).reset_index(drop=True)
+        rate = rates['val'].to_numpy(dtype=float)
+    ages = list(ages) if ages else list(standard.index)
+    missing = [age for age in ages if age not in standard.index]
+    if missing:
+        raise ValueError(f"Standard population has no weight for age group(s): {', '.join(missing)}")
+    weights = standard.reindex(ages).to_numpy(dtype=float)
+    weights = weights / weights.sum()
+
+    age_code = pd.Index(ages).get_indexer(np.asarray(rates['age'], dtype=object))
+    weight = np.where(age_code >= 0, weights[np.maximum(age_code, 0)], np.nan)
+    keys, sums = _reduce_over_age(rates, ages, {'weighted': weight * rate})
+    return _long_format(keys, label, 'Rate', sums['weighted'])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Derive age aggregates and age-standardized rates from age-specific counts')
+    parser.add_argument('counts', help='long-format GBD export with age-specific Number rows')
+    parser.add_argument('--population', required=True, help='population file (location, sex, age, year, population/val)')
+    parser.add_argument('--standard', default=STANDARD_POPULATION_FILE, help='GBD standard population file (age, weight)')
+    parser.add_argument('--ages', nargs='+', default=UNDER_20_AGES, help='age groups to combine')
+    parser.add_argument('--label', default='<20 years', help='age label of the combined group')
+    parser.add_argument('--output', required=True, help='output CSV (long format, readable by Figures 2 and 3)')
+    args = parser.parse_args()
+
+    counts = read_gbd_csv(args.counts, filters=[('metric', '==', 'Number'), ('age', 'in', args.ages)])
+    table = population_table(read_population(args.population))
+    frames = [age_aggregate(counts, table, args.ages, args.label)]
+    if args.standard:
+        standard = read_standard_population(args.standard)
+        frames.append(age_standardize(counts, standard, table, args.ages, f'{args.label} (age-standardized)'))
+    else:
+        print("No --standard file or GBD_STANDARD_POPULATION set, age-standardized rates skipped")
+    result = pd.concat(frames, ignore_index=True)
+    result.to_csv(args.output, index=False)
+    print(f"Saved {len(result)} rows to: {args.output}")
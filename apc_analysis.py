@@ -0,0 +1,177 @@
+#Age-period-cohort analysis
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import age_standardization
+import apc_engine
+import gbd_io
+import joinpoint_engine
+from apc_engine import INTERVAL, apc_grid, apc_tables, fit_apc
+from figure_export import export_figure
+from gbd_io import iter_gbd_filtered
+from instrumentation import set_rows, stage, traced
+from stage_cache import cached, input_digest, source_digest, stage_key
+
+DISEASES = ["Attention-deficit/hyperactivity disorder", "Autism spectrum disorders",
+            "Epilepsy", "Hearing loss", "Intellectual disability", "Vision loss"]
+LABELS = ["ADHD", "ASD", "Epilepsy", "Hearing Loss", "Intellectual disability", "Vision Loss"]
+DISEASE_COLORS = {
+    "Attention-deficit/hyperactivity disorder": "#0072B2",
+    "Autism spectrum disorders": "#E69F00",
+    "Epilepsy": "#009E73",
+    "Hearing loss": "#F0E442",
+    "Intellectual disability": "#D55E00",
+    "Vision loss": "#CC79A7"
+}
+MEASURES = ['Prevalence', 'DALYs']
+
+
+def apc_filters(diseases, measures, metric='Rate', locations=None, sexes=None, ages=None):
+    filters = [
+        ('cause', 'in', diseases),
+        ('measure', 'in', measures),
+        ('metric', '==', metric),
+    ]
+    if locations:
+        filters.append(('location', 'in', locations))
+    if sexes:
+        filters.append(('sex', 'in', sexes))
+    if ages:
+        filters.append(('age', 'in', list(ages)))
+    return filters
+
+
+def apc_results(frames, population=None, interval=INTERVAL):
+    # one batched fit per frame (a frame, or one cause/measure group once they outgrow the memory budget)
+    if population is not None:
+        from age_standardization import age_specific_rates
+    results = []
+    for frame in frames:
+        if population is not None:
+            frame = age_specific_rates(frame, population)
+        keys, ages, periods, rates = apc_grid(frame, interval=interval)
+        print(f"Fitting APC models: {len(keys)} series, {len(ages)} ages x {len(periods)} periods")
+        results.append(apc_tables(keys, ages, periods, fit_apc(rates, interval)))
+    return [pd.concat(tables, ignore_index=True) for tables in zip(*results)]
+
+
+def load_apc_tables(file_path, data=None, population_path=None, interval=INTERVAL, use_cache=True, ages=None):
+    # (effects, local drifts, net drifts) for the six causes, from the stage cache when already fitted;
+    # `ages` limits the fit to those age groups (all of the export's grid ages by default)
+    filters = apc_filters(DISEASES, MEASURES, 'Number' if population_path else 'Rate', ages=ages)
+
+    def compute():
+        population = None
+        if population_path:
+            from age_standardization import population_table, read_population
+            with stage('population'):
+                population = population_table(read_population(population_path))
+        return apc_results(iter_gbd_filtered(file_path, filters, ['cause', 'measure'], data, use_cache),
+                           population, interval)
+
+    if not use_cache:
+        return compute()
+    key = stage_key('apc', input_digest(file_path), filters, interval,
+                    input_digest(population_path) if population_path else None,
+                    source_digest(apc_results, apc_engine, joinpoint_engine, age_standardization, gbd_io))
+    return cached(key, compute)
+
+
+def plot_effect(ax, table, x_col, y_col, low_col, high_col, causes, hline):
+    for cause in causes:
+        rows = table[table['cause'] == cause]
+        if rows.empty:
+            continue
+        x = np.arange(len(rows))
+        color = DISEASE_COLORS.get(cause, '#7F7F7F')
+        ax.plot(x, rows[y_col], color=color, linewidth=2, marker='o', markersize=4)
+        ax.fill_between(x, rows[low_col], rows[high_col], color=color, alpha=0.15, linewidth=0)
+    ax.axhline(hline, color='black', linestyle='-', alpha=0.3, linewidth=1)
+    labels = table[x_col].drop_duplicates().tolist()
+    step = max(1, len(labels) // 8)
+    ax.set_xticks(np.arange(len(labels))[::step])
+    ax.set_xticklabels(labels[::step], rotation=45, ha='right')
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+    ax.grid(axis='y', alpha=0.4, linestyle='-', linewidth=0.8, color='lightgray')
+    ax.set_axisbelow(True)
+
+
+def plot_apc(effects, local, net, location, sex, measures, causes):
+    # one row per measure: local drifts (net drift dashed), then age, period and cohort rate ratios
+    plt.rcParams.update({'font.size': 11, 'axes.titlesize': 14, 'axes.labelsize': 12,
+                         'xtick.labelsize': 10, 'ytick.labelsize': 10})
+    label_map = dict(zip(DISEASES, LABELS))
+    fig, axes = plt.subplots(len(measures), 4, figsize=(24, 5.5 * len(measures)), squeeze=False)
+    pick = lambda table, measure: table[(table['location'] == location) & (table['sex'] == sex)
+                                        & (table['measure'] == measure)]
+    for row, measure in enumerate(measures):
+        with stage(f'render.{measure}'):
+            drift = pick(local, measure)
+            plot_effect(axes[row, 0], drift, 'age', 'local_drift', 'ci_low', 'ci_high', causes, 0)
+            for _, series in pick(net, measure).iterrows():
+                axes[row, 0].axhline(series['net_drift'], color=DISEASE_COLORS.get(series['cause'], '#7F7F7F'),
+                                     linestyle='--', linewidth=1.2)
+            axes[row, 0].set_ylabel(f'{measure}\nLocal drift (% per year)', fontweight='bold')
+
+            measure_effects = pick(effects, measure)
+            for col, effect in enumerate(['age', 'period', 'cohort'], 1):
+                plot_effect(axes[row, col], measure_effects[measure_effects['effect'] == effect],
+                            'label', 'rr', 'rr_low', 'rr_high', causes, 1)
+                axes[row, col].set_ylabel('Rate ratio')
+            if row == 0:
+                for col, title in enumerate(['Local drifts', 'Age effect', 'Period effect', 'Cohort effect']):
+                    axes[row, col].set_title(title, fontweight='bold')
+
+    handles = [plt.Line2D([0], [0], color=DISEASE_COLORS[cause], linewidth=2) for cause in causes]
+    handles.append(plt.Line2D([0], [0], color='gray', linestyle='--', linewidth=1.2))
+    fig.legend(handles, [label_map.get(cause, cause) for cause in causes] + ['Net drift'],
+               loc='lower center', ncol=len(handles), fontsize=12, frameon=False, bbox_to_anchor=(0.5, -0.02))
+    fig.suptitle(f'Age-period-cohort analysis: {location}, {sex} (intrinsic estimator)', fontsize=16, fontweight='bold')
+    with stage('tight_layout'):
+        fig.tight_layout(rect=(0, 0.04, 1, 0.97))
+    return fig
+
+
+@traced('APC')
+def run_apc(file_path, output_dir, data=None, population_path=None, location='Global', sex='Both',
+            interval=INTERVAL, use_cache=True):
+    # every location x sex x cause x measure series in the export is fitted; the figure shows one location/sex.
+    # Without a population file the age-specific Rate rows are used, with one the Number rows are pooled.
+    os.makedirs(output_dir, exist_ok=True)
+
+    with stage('statistics'):
+        effects, local, net = load_apc_tables(file_path, data, population_path, interval, use_cache)
+        set_rows(len(net))
+
+    with stage('tables'):
+        effects.to_csv(os.path.join(output_dir, 'APC_effects.csv'), index=False)
+        local.to_csv(os.path.join(output_dir, 'APC_local_drifts.csv'), index=False)
+        net.to_csv(os.path.join(output_dir, 'APC_net_drifts.csv'), index=False)
+    print(f"APC tables saved: {len(net)} series, {net['location'].nunique()} locations")
+
+    if not ((net['location'] == location) & (net['sex'] == sex)).any():
+        print(f"No APC series for {location} / {sex}, figure skipped")
+        return True
+    fig = plot_apc(effects, local, net, location, sex, MEASURES, DISEASES)
+    with stage('export'):
+        paths = export_figure(fig, os.path.join(output_dir, 'APC_Analysis'), {'png': 300, 'pdf': None},
+                              facecolor='white', edgecolor='none')
+    print(f"APC figure saved: {paths['png']}")
+    plt.close(fig)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Age-period-cohort analysis (intrinsic estimator, net and local drifts)')
+    parser.add_argument('input', help='GBD export with age-specific rows (csv, zip or directory)')
+    parser.add_argument('--output-dir', default=os.path.expanduser('~/Desktop/GBD'))
+    parser.add_argument('--population', help='population file: fit pooled Number/population instead of Rate rows')
+    parser.add_argument('--location', default='Global', help='location shown in the figure')
+    parser.add_argument('--sex', default='Both', help='sex shown in the figure')
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+    run_apc(args.input, args.output_dir, population_path=args.population, location=args.location, sex=args.sex,
+            use_cache=not args.no_cache)
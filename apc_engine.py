@@ -0,0 +1,231 @@
+#Age-period-cohort engine
+import re
+import numpy as np
+import pandas as pd
+from joinpoint_engine import t_critical, t_pvalue
+
+APC_SERIES_COLS = ['location', 'sex', 'cause', 'measure']
+INTERVAL = 5
+RATE_SCALE = 100_000
+
+
+def age_bounds(label, interval=INTERVAL):
+    # '<5 years' -> (0, 5), '5-9 years' -> (5, 10), '95+ years' -> (95, None); None for other labels
+    label = str(label).strip()
+    match = re.fullmatch(r'(\d+)\s*(?:-|to)\s*(\d+) years?', label)
+    if match:
+        return int(match.group(1)), int(match.group(2)) + 1
+    match = re.fullmatch(r'<\s*(\d+) years?', label)
+    if match:
+        return 0, int(match.group(1))
+    match = re.fullmatch(r'(\d+)\s*\+ years?', label)
+    if match:
+        return int(match.group(1)), None
+    return None
+
+
+def component_ages(label, interval=INTERVAL):
+    # the `interval`-year age groups making up an aggregate ('<20 years' -> '<5 years' ... '15-19 years');
+    # None when the label has no closed upper bound
+    bounds = age_bounds(label, interval)
+    if bounds is None or bounds[1] is None:
+        return None
+    return [f'<{start + interval} years' if start == 0 else f'{start}-{start + interval - 1} years'
+            for start in range(bounds[0], bounds[1], interval)]
+
+
+def grid_ages(labels, interval=INTERVAL):
+    # the age groups `interval` years wide (plus an open last group), youngest first;
+    # aggregates such as '<20 years' or 'All ages' are left out
+    bounds = {label: age_bounds(label) for label in labels}
+    ages = sorted((b[0], label) for label, b in bounds.items()
+                  if b is not None and (b[1] is None or b[1] - b[0] == interval))
+    starts = [start for start, _ in ages]
+    if len(set(starts)) != len(starts) or any(b - a != interval for a, b in zip(starts, starts[1:])):
+        raise ValueError(f"Age groups do not form a contiguous {interval}-year grid: {[label for _, label in ages]}")
+    return [label for _, label in ages]
+
+
+def period_bins(years, interval=INTERVAL):
+    # consecutive `interval`-year periods ending at the last year; leading years that do not
+    # fill a period are dropped (1990-2021 -> 1992-1996 ... 2017-2021)
+    years = sorted(set(int(year) for year in years))
+    last = years[-1]
+    n = (last - years[0] + 1) // interval
+    return [(last - (n - i) * interval + 1, last - (n - i - 1) * interval) for i in range(n)]
+
+
+def apc_grid(df, ages=None, periods=None, series_cols=APC_SERIES_COLS, interval=INTERVAL):
+    # long-format rows -> (series, age, period) rate array. Periods average the annual rates,
+    # or pool counts over population (per 100,000) when the frame has a population column.
+    series_cols = [col for col in series_cols if col in df.columns]
+    ages = list(ages) if ages is not None else grid_ages(pd.unique(np.asarray(df['age'], dtype=object)), interval)
+    if not ages:
+        raise ValueError(f"No {interval}-year age groups to build an age-period grid from")
+    periods = periods or period_bins(df['year'].unique(), interval)
+
+    grouped = df.groupby(series_cols, observed=True, sort=True)
+    series = grouped.ngroup().to_numpy()
+    keys = grouped.size().index.to_frame(index=False)
+    age = pd.Index(ages).get_indexer(np.asarray(df['age'], dtype=object))
+    year = df['year'].to_numpy(dtype=int)
+    starts = np.array([start for start, _ in periods])
+    period = np.searchsorted(starts, year, side='right') - 1
+    keep = (age >= 0) & (period >= 0) & (year <= periods[-1][1]) & (series >= 0)
+
+    shape = (len(keys), len(ages), len(periods))
+    flat = np.ravel_multi_index((series[keep], age[keep], period[keep]), shape)
+    size = int(np.prod(shape))
+    if 'population' in df.columns:
+        counts = df['val'].to_numpy(dtype=float)[keep]
+        population = df['population'].to_numpy(dtype=float)[keep]
+        valid = np.isfinite(counts) & np.isfinite(population)
+        numerator = np.bincount(flat[valid], weights=counts[valid], minlength=size)
+        denominator = np.bincount(flat[valid], weights=population[valid], minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(denominator > 0, numerator / denominator * RATE_SCALE, np.nan)
+    else:
+        values = df['val'].to_numpy(dtype=float)[keep]
+        valid = np.isfinite(values)
+        total = np.bincount(flat[valid], weights=values[valid], minlength=size)
+        n = np.bincount(flat[valid], minlength=size)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            rates = np.where(n > 0, total / n, np.nan)
+    return keys, ages, periods, rates.reshape(shape)
+
+
+def effect_coding(levels):
+    # levels x (levels - 1): the last level is minus the sum of the others
+    return np.vstack([np.eye(levels - 1), -np.ones((1, levels - 1))])
+
+
+def apc_design(n_age, n_period):
+    # rows are (age, period) cells in C order; columns: intercept, age, period and cohort effects
+    # (effect coded). Cohort = period - age + n_age - 1, so the design has one null direction.
+    n_cohort = n_age + n_period - 1
+    age, period = np.divmod(np.arange(n_age * n_period), n_period)
+    cohort = period - age + n_age - 1
+    codings = [effect_coding(n) for n in (n_age, n_period, n_cohort)]
+    design = np.hstack([np.ones((n_age * n_period, 1))] + [coding[index] for coding, index
+                                                           in zip(codings, (age, period, cohort))])
+    # coefficients -> every level's effect (omitted levels included)
+    blocks = np.zeros((n_age + n_period + n_cohort, design.shape[1]))
+    row, col = 0, 1
+    for coding in codings:
+        blocks[row:row + len(coding), col:col + coding.shape[1]] = coding
+        row += len(coding)
+        col += coding.shape[1]
+    return design, blocks
+
+
+def slope_contrast(n, interval=INTERVAL):
+    # least-squares slope per year of n equally spaced values
+    x = (np.arange(n) - (n - 1) / 2) * interval
+    return x / (x @ x)
+
+
+def fit_apc(rates, interval=INTERVAL, alpha=0.05):
+    # Intrinsic estimator for every series: ln(rate) on the effect-coded design, solved with the
+    # Moore-Penrose inverse (the minimum-norm solution is the IE). Series sharing a pattern of
+    # observed cells share one pseudo-inverse, so each pattern costs one matrix product.
+    n_series, n_age, n_period = rates.shape
+    n_cohort = n_age + n_period - 1
+    design, blocks = apc_design(n_age, n_period)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.log(rates.reshape(n_series, -1))
+    observed = np.isfinite(y)
+
+    # estimable contrasts: within-age trend of the fitted rates (local drift), and the sum of
+    # the period and cohort linear trends (net drift)
+    local = np.zeros((n_age, n_age * n_period))
+    period_slope = slope_contrast(n_period, interval)
+    for a in range(n_age):
+        local[a, a * n_period:(a + 1) * n_period] = period_slope
+    net = np.zeros(len(blocks))
+    net[n_age:n_age + n_period] = period_slope
+    net[n_age + n_period:] = slope_contrast(n_cohort, interval)
+    contrasts = np.vstack([blocks, local @ design, net @ blocks])
+
+    estimates = np.full((n_series, len(contrasts)), np.nan)
+    se = np.full((n_series, len(contrasts)), np.nan)
+    dof = np.zeros(n_series, dtype=int)
+    patterns, pattern_of = np.unique(observed, axis=0, return_inverse=True)
+    for i, cells in enumerate(patterns):
+        members = np.flatnonzero(pattern_of.ravel() == i)
+        x = design[cells]
+        if len(x) == 0:
+            continue
+        pinv = np.linalg.pinv(x)
+        rank = np.linalg.matrix_rank(x)
+        y_obs = y[members][:, cells]
+        beta = y_obs @ pinv.T
+        resid = y_obs - beta @ x.T
+        df_resid = len(x) - rank
+        estimates[members] = beta @ contrasts.T
+        if df_resid > 0:
+            sigma2 = (resid ** 2).sum(axis=1) / df_resid
+            # var(L beta) = sigma2 * diag(L X+ X+' L')
+            spread = np.einsum('ij,ij->i', contrasts @ pinv, contrasts @ pinv)
+            se[members] = np.sqrt(sigma2[:, None] * spread[None, :])
+        dof[members] = df_resid
+
+    n_effects = len(blocks)
+    t_crit = t_critical(dof, alpha)[:, None]
+    return {
+        'effects': estimates[:, :n_effects], 'effects_se': se[:, :n_effects],
+        'local': estimates[:, n_effects:n_effects + n_age], 'local_se': se[:, n_effects:n_effects + n_age],
+        'net': estimates[:, -1], 'net_se': se[:, -1],
+        'dof': dof, 't_crit': t_crit, 'n_age': n_age, 'n_period': n_period, 'n_cohort': n_cohort,
+    }
+
+
+def percent_change(slope, se, t_crit):
+    with np.errstate(invalid='ignore'):
+        return ((np.exp(slope) - 1) * 100, (np.exp(slope - t_crit * se) - 1) * 100,
+                (np.exp(slope + t_crit * se) - 1) * 100)
+
+
+def cohort_labels(ages, periods):
+    # birth cohort by its central year: period midpoint minus age midpoint
+    age_mid = [age_bounds(age)[0] + (INTERVAL - 1) / 2 for age in ages]
+    first = (periods[0][0] + periods[0][1]) / 2 - age_mid[-1]
+    step = periods[0][1] - periods[0][0] + 1
+    return [int(round(first + c * step)) for c in range(len(ages) + len(periods) - 1)]
+
+
+def apc_tables(keys, ages, periods, fit):
+    # long-format tables: IE effects as rate ratios, local drifts per age, net drift per series
+    n_series = len(keys)
+    t_crit = fit['t_crit']
+    with np.errstate(invalid='ignore'):
+        low = fit['effects'] - t_crit * fit['effects_se']
+        high = fit['effects'] + t_crit * fit['effects_se']
+    effect_names = (['age'] * fit['n_age'] + ['period'] * fit['n_period'] + ['cohort'] * fit['n_cohort'])
+    effect_labels = (list(ages) + [f'{start}-{end}' for start, end in periods]
+                     + [str(year) for year in cohort_labels(ages, periods)])
+    n_effects = len(effect_names)
+    effects = keys.loc[np.repeat(np.arange(n_series), n_effects)].reset_index(drop=True)
+    effects['effect'] = np.tile(effect_names, n_series)
+    effects['label'] = np.tile(effect_labels, n_series)
+    effects['coef'] = fit['effects'].ravel()
+    effects['se'] = fit['effects_se'].ravel()
+    effects['rr'] = np.exp(fit['effects']).ravel()
+    effects['rr_low'] = np.exp(low).ravel()
+    effects['rr_high'] = np.exp(high).ravel()
+
+    local = keys.loc[np.repeat(np.arange(n_series), fit['n_age'])].reset_index(drop=True)
+    local['age'] = np.tile(list(ages), n_series)
+    drift, drift_low, drift_high = percent_change(fit['local'], fit['local_se'], t_crit)
+    local['local_drift'] = drift.ravel()
+    local['ci_low'] = drift_low.ravel()
+    local['ci_high'] = drift_high.ravel()
+
+    net = keys.copy()
+    drift, drift_low, drift_high = percent_change(fit['net'], fit['net_se'], t_crit[:, 0])
+    net['net_drift'] = drift
+    net['ci_low'] = drift_low
+    net['ci_high'] = drift_high
+    with np.errstate(divide='ignore', invalid='ignore'):
+        net['p_value'] = np.where(fit['net_se'] > 0, t_pvalue(fit['net'] / fit['net_se'], fit['dof']), np.nan)
+    net['dof'] = fit['dof']
+    return effects, local, net
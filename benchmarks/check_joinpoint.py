@@ -0,0 +1,62 @@
+#Joinpoint regression check
+import argparse
+import os
+import sys
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+from joinpoint_engine import fit_joinpoint_models, select_bic, select_permutation
+
+YEARS = np.arange(1990, 2022, dtype=float)
+TRUE_JOINPOINT = 2005
+
+
+def known_joinpoint_series(n_series, noise_sd, seed=0):
+    # +2%/year until 2005, then -3%/year, with log-normal noise
+    rng = np.random.default_rng(seed)
+    log_val = np.log(100) + 0.02 * (YEARS - YEARS[0]) - 0.05 * np.maximum(YEARS - TRUE_JOINPOINT, 0)
+    return np.exp(log_val[None, :] + rng.normal(0, noise_sd, (n_series, len(YEARS))))
+
+
+def check(n_series=40, noise_sd=0.01, seed=0, permutation=False):
+    failures = []
+    values = known_joinpoint_series(n_series, noise_sd, seed)
+    fits = fit_joinpoint_models(YEARS, values, max_joinpoints=5)
+
+    sse = np.array([fit['sse'] for fit in fits])
+    if (np.diff(sse, axis=0) > 1e-12 * sse[:-1]).any():
+        failures.append('SSE rises with the number of joinpoints')
+
+    joinpoints = fits[1]['joinpoints'][:, 0]
+    off = np.abs(joinpoints - TRUE_JOINPOINT) > 1
+    if off.any() or np.mean(joinpoints == TRUE_JOINPOINT) < 0.5:
+        failures.append(f"one-joinpoint fit lands on {TRUE_JOINPOINT} in {int((joinpoints == TRUE_JOINPOINT).sum())}"
+                        f"/{n_series} series, more than a year off in {int(off.sum())}")
+
+    bic_selected = select_bic(fits)
+    if np.mean(bic_selected == 1) < 0.8:
+        failures.append(f"BIC selects 1 joinpoint in {int((bic_selected == 1).sum())}/{n_series} series")
+
+    if permutation:
+        selected = select_permutation(YEARS, values[:10], max_joinpoints=3, n_permutations=999, seed=seed, n_jobs=1)
+        if np.mean(selected == 1) < 0.8:
+            failures.append(f"permutation test selects {selected.tolist()} joinpoints")
+
+    print(f"Known joinpoint at {TRUE_JOINPOINT}: {int((joinpoints == TRUE_JOINPOINT).sum())}/{n_series} placed exactly, "
+          f"BIC selects 1 in {int((bic_selected == 1).sum())}/{n_series}")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Check joinpoint placement and model selection on a known joinpoint')
+    parser.add_argument('--series', type=int, default=40)
+    parser.add_argument('--noise', type=float, default=0.01, help='sd of the log-scale noise')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--permutation', action='store_true', help='also run the sequential permutation test')
+    args = parser.parse_args()
+    failures = check(args.series, args.noise, args.seed, args.permutation)
+    for failure in failures:
+        print(f"  FAILED: {failure}")
+    sys.exit(1 if failures else 0)
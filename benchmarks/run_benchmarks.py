@@ -0,0 +1,203 @@
+#Benchmark suite
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import synthetic_gbd
+
+CASES = [
+    'figure1.ingest', 'figure1.joinpoint', 'figure1.total',
+    'figure2.ingest', 'figure2.aapc', 'figure2.total',
+    'figure3.ingest', 'figure3.percentage', 'figure3.total',
+]
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux and bytes on macOS; worker pools count through RUSAGE_CHILDREN
+    scale = 1024 * 1024 if sys.platform == 'darwin' else 1024
+    peaks = [resource.getrusage(who).ru_maxrss for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    return max(peaks) / scale
+
+
+def figure2_filters():
+    from figure_loader import load_figure
+    return load_figure(2).figure2_filters(synthetic_gbd.CAUSES)
+
+
+def figure3_filters():
+    from figure_loader import load_figure
+    years = [1990, 2021]
+    return load_figure(3).figure3_filters(synthetic_gbd.MEASURES, synthetic_gbd.AGGREGATE_LOCATIONS, years,
+                                          synthetic_gbd.CAUSES)
+
+
+def run_case(case, dataset, output_dir, joinpoint_method):
+    # one case per process, so peak RSS belongs to that case alone; returns the rows it produced
+    from figure_loader import load_figure
+    from gbd_io import read_gbd_csv, read_workbook
+
+    figure, stage = case.split('.')
+    if figure == 'figure1':
+        if stage == 'ingest':
+            return len(read_workbook(dataset['xlsx_path'], ['Sheet1', 'Sheet2', 'Sheet3'], use_cache=False)['Sheet1'])
+        if stage == 'joinpoint':
+            from joinpoint_engine import joinpoint_regression
+            sheet1 = read_workbook(dataset['xlsx_path'], ['Sheet1'], use_cache=False)['Sheet1']
+            return len(joinpoint_regression(sheet1, method=joinpoint_method)[1])
+        return int(bool(load_figure(1).run_figure1(dataset['xlsx_path'], output_dir=output_dir)))
+
+    if figure == 'figure2':
+        if stage == 'total':
+            return int(bool(load_figure(2).run_figure2(dataset['csv_path'], output_dir)))
+        data = read_gbd_csv(dataset['csv_path'], filters=figure2_filters())
+        if stage == 'ingest':
+            return len(data)
+        from aapc_engine import grouped_log_linear
+        return len(grouped_log_linear(data, ['cause', 'measure']))
+
+    if stage == 'total':
+        return int(bool(load_figure(3).run_figure3(dataset['csv_path'], output_dir)))
+    data = read_gbd_csv(dataset['csv_path'], filters=figure3_filters())
+    if stage == 'ingest':
+        return len(data)
+    cube = load_figure(3).build_percentage_cube(data, synthetic_gbd.MEASURES, [1990, 2021],
+                                                synthetic_gbd.AGGREGATE_LOCATIONS[::-1], synthetic_gbd.CAUSES)
+    return int(cube['present'].sum())
+
+
+def case_main(args):
+    dataset = json.loads(args.dataset)
+    start_wall = time.perf_counter()
+    start_cpu = time.process_time()
+    result = {'case': args.case}
+    try:
+        result['rows'] = run_case(args.case, dataset, args.output_dir, args.joinpoint_method)
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = f'{type(e).__name__}: {e}'
+    result['wall_s'] = time.perf_counter() - start_wall
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    result['cpu_s'] = time.process_time() - start_cpu + children.ru_utime + children.ru_stime
+    result['peak_rss_mb'] = peak_rss_mb()
+    print('BENCHMARK_RESULT ' + json.dumps(result))
+
+
+def run_case_subprocess(case, dataset, output_dir, joinpoint_method, timeout):
+    # the workbook's Feather sidecar cache would turn later cases into warm reads
+    shutil.rmtree(os.path.join(os.path.dirname(dataset['xlsx_path']), '.gbd_cache'), ignore_errors=True)
+    command = [sys.executable, os.path.abspath(__file__), '--case', case, '--dataset', json.dumps(dataset),
+               '--output-dir', output_dir, '--joinpoint-method', joinpoint_method]
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=timeout,
+                                   env=dict(os.environ, GBD_CACHE='0', MPLBACKEND='Agg'))
+    except subprocess.TimeoutExpired:
+        return {'case': case, 'status': 'timeout', 'wall_s': timeout}
+    for line in completed.stdout.splitlines():
+        if line.startswith('BENCHMARK_RESULT '):
+            return json.loads(line[len('BENCHMARK_RESULT '):])
+    return {'case': case, 'status': 'error', 'error': ''.join(completed.stderr.strip().splitlines()[-1:])}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    previous = {(r['size'], r['case']): r for r in baseline['results'] if r.get('status') == 'ok'}
+    regressions = []
+    for r in results:
+        old = previous.get((r['size'], r['case']))
+        if r.get('status') != 'ok' or old is None:
+            continue
+        for metric in ('wall_s', 'peak_rss_mb'):
+            if old[metric] > 0 and r[metric] / old[metric] > 1 + threshold:
+                regressions.append(f"{r['size']} {r['case']} {metric}: {old[metric]:.3f} -> {r[metric]:.3f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Figures 1-3 on synthetic GBD data')
+    parser.add_argument('--sizes', nargs='+', default=['single', 'regions'], choices=sorted(synthetic_gbd.SIZES))
+    parser.add_argument('--cases', nargs='+', default=CASES, choices=CASES)
+    parser.add_argument('--repeat', type=int, default=1)
+    parser.add_argument('--data-dir', default=None, help='where to write the synthetic data (default: temp dir)')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--baseline', default=None, help='earlier results file to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative slowdown reported as a regression')
+    parser.add_argument('--joinpoint-method', default='bic', choices=['bic', 'permutation'])
+    parser.add_argument('--timeout', type=float, default=3600)
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    parser.add_argument('--dataset', help=argparse.SUPPRESS)
+    parser.add_argument('--output-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        return case_main(args)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='gbd_bench_')
+    report = {
+        'suite': 'gbd-figures',
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'joinpoint_method': args.joinpoint_method,
+        'datasets': {},
+        'results': [],
+    }
+
+    try:
+        for size in args.sizes:
+            print(f"Generating {size} dataset ({synthetic_gbd.expected_rows(size)} rows)...")
+            dataset = synthetic_gbd.generate(size, os.path.join(data_dir, size))
+            report['datasets'][size] = {key: value for key, value in dataset.items() if not key.endswith('_path')}
+
+            for repeat in range(args.repeat):
+                for case in args.cases:
+                    output_dir = os.path.join(data_dir, size, 'out')
+                    result = run_case_subprocess(case, dataset, output_dir, args.joinpoint_method, args.timeout)
+                    result.update(size=size, repeat=repeat)
+                    report['results'].append(result)
+                    if result['status'] == 'ok':
+                        print(f"  {case:<20} {result['wall_s']:8.2f} s  {result['peak_rss_mb']:8.1f} MB")
+                    else:
+                        print(f"  {case:<20} {result['status']}: {result.get('error', '')}")
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to: {args.output}")
+
+    if args.baseline:
+        regressions = compare(report['results'], args.baseline, args.threshold)
+        for line in regressions:
+            print(f"  regression: {line}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,223 @@
+#Synthetic GBD data
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gbd_io import GBD_COLUMNS
+from joinpoint_engine import joinpoint_regression
+
+CAUSES = [
+    'Attention-deficit/hyperactivity disorder', 'Autism spectrum disorders',
+    'Epilepsy', 'Hearing loss', 'Intellectual disability', 'Vision loss'
+]
+MEASURES = ['Prevalence', 'DALYs']
+YEARS = list(range(1990, 2022))
+AGGREGATE_LOCATIONS = [
+    'Global', 'High SDI', 'High-middle SDI', 'Middle SDI', 'Low-middle SDI', 'Low SDI',
+    'Andean Latin America', 'Australasia', 'Caribbean', 'Central Asia',
+    'Central Europe', 'Central Latin America', 'Central Sub-Saharan Africa',
+    'East Asia', 'Eastern Europe', 'Eastern Sub-Saharan Africa',
+    'High-income Asia Pacific', 'High-income North America',
+    'North Africa and Middle East', 'Oceania', 'South Asia',
+    'South-East Asia Region', 'Southern Latin America',
+    'Southern Sub-Saharan Africa', 'Tropical Latin America',
+    'Western Europe', 'Western Sub-Saharan Africa'
+]
+COUNTRIES = [f'Country {i:03d}' for i in range(1, 205)]
+UNDER_20_AGES = ['<5 years', '5-9 years', '10-14 years', '15-19 years', '<20 years']
+ALL_AGES = UNDER_20_AGES + [f'{lo}-{lo + 4} years' for lo in range(20, 95, 5)] + [
+    '95+ years', 'All ages', 'Age-standardized', '<1 year', '1-4 years', '20-54 years', '55+ years'
+]
+
+# rows per measure/cause/year: locations x sexes x ages x metrics
+SIZES = {
+    'single': dict(locations=['Global'], sexes=['Both'], ages=['<20 years'], metrics=['Rate']),
+    'regions': dict(locations=AGGREGATE_LOCATIONS, sexes=['Both', 'Male', 'Female'],
+                    ages=['<20 years'], metrics=['Rate']),
+    'countries': dict(locations=AGGREGATE_LOCATIONS + COUNTRIES, sexes=['Both', 'Male', 'Female'],
+                      ages=UNDER_20_AGES, metrics=['Number', 'Rate']),
+    'full': dict(locations=AGGREGATE_LOCATIONS + COUNTRIES, sexes=['Both', 'Male', 'Female'],
+                 ages=ALL_AGES, metrics=['Number', 'Percent', 'Rate']),
+}
+EXCEL_MAX_ROWS = 1_048_575
+
+
+def location_frame(location, sexes, ages, metrics, rng, years=YEARS):
+    # log-linear trends with up to two joinpoints per series, as in GBD rate/number curves
+    labels = pd.MultiIndex.from_product([MEASURES, sexes, ages, CAUSES, metrics],
+                                        names=['measure', 'sex', 'age', 'cause', 'metric'])
+    n_series = len(labels)
+    t = np.asarray(years, dtype=float) - years[0]
+
+    level = rng.uniform(2, 8, n_series)
+    slope = rng.normal(0.01, 0.015, n_series)
+    log_val = level[:, None] + slope[:, None] * t
+    for _ in range(2):
+        joinpoint = rng.uniform(4, len(years) - 4, n_series)
+        change = rng.normal(0, 0.02, n_series) * (rng.random(n_series) < 0.6)
+        log_val += change[:, None] * np.maximum(t - joinpoint[:, None], 0)
+    log_val += rng.normal(0, 0.005, log_val.shape)
+
+    metric = np.asarray(labels.get_level_values('metric'))
+    number, percent = metric == 'Number', metric == 'Percent'
+    log_val[number] += rng.uniform(6, 12, (number.sum(), 1))
+    log_val[percent] += np.log(rng.uniform(0.001, 0.05, (percent.sum(), 1))) - log_val[percent].max(axis=1, keepdims=True)
+
+    val = np.exp(log_val)
+    spread = np.exp(1.96 * rng.uniform(0.02, 0.15, n_series))[:, None]
+
+    frame = labels.to_frame(index=False).loc[np.repeat(np.arange(n_series), len(years))].reset_index(drop=True)
+    frame.insert(1, 'location', location)
+    frame['year'] = np.tile(years, n_series)
+    frame['val'] = val.ravel()
+    frame['upper'] = (val * spread).ravel()
+    frame['lower'] = (val / spread).ravel()
+    return frame[GBD_COLUMNS]
+
+
+def iter_frames(size, seed=0):
+    spec = SIZES[size]
+    seeds = np.random.SeedSequence(seed).spawn(len(spec['locations']))
+    for location, child in zip(spec['locations'], seeds):
+        yield location_frame(location, spec['sexes'], spec['ages'], spec['metrics'], np.random.default_rng(child))
+
+
+def expected_rows(size):
+    spec = SIZES[size]
+    return (len(spec['locations']) * len(spec['sexes']) * len(spec['ages']) * len(spec['metrics'])
+            * len(MEASURES) * len(CAUSES) * len(YEARS))
+
+
+def write_csv(size, path, seed=0):
+    rows = 0
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for i, frame in enumerate(iter_frames(size, seed)):
+            frame.to_csv(f, header=i == 0, index=False)
+            rows += len(frame)
+    return rows
+
+
+def write_draws(size, path, n_draws=1000, seed=0):
+    # GBD draw file: the CSV's rows with val/upper/lower replaced by draw_0..draw_{n-1},
+    # log-normal around val with the 95% interval's spread
+    rows = 0
+    rng = np.random.default_rng(seed)
+    draw_cols = [f'draw_{i}' for i in range(n_draws)]
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for i, frame in enumerate(iter_frames(size, seed)):
+            sigma = np.log(frame['upper'] / frame['lower']).to_numpy() / (2 * 1.96)
+            draws = np.exp(np.log(frame['val'].to_numpy())[:, None]
+                           + sigma[:, None] * rng.standard_normal((len(frame), n_draws)))
+            out = pd.concat([frame.drop(columns=['val', 'upper', 'lower']),
+                             pd.DataFrame(draws, columns=draw_cols)], axis=1)
+            out.to_csv(f, header=i == 0, index=False, float_format='%.6g')
+            rows += len(out)
+    return rows
+
+
+def write_population(size, path, seed=0):
+    # population file for the size's locations/sexes/single age bands: exponential growth per location/age
+    spec = SIZES[size]
+    ages = [age for age in spec['ages'] if age not in ('<20 years', 'All ages', 'Age-standardized')] or ['<20 years']
+    rng = np.random.default_rng(seed)
+    labels = pd.MultiIndex.from_product([spec['locations'], spec['sexes'], ages], names=['location', 'sex', 'age'])
+    t = np.asarray(YEARS, dtype=float) - YEARS[0]
+    log_size = rng.uniform(11, 19, len(labels)) + rng.normal(0, 0.01, (len(t), len(labels))).cumsum(axis=0)
+    growth = rng.normal(0.01, 0.01, len(labels))
+    population = np.exp(log_size + growth * t[:, None])
+
+    frame = labels.to_frame(index=False).loc[np.tile(np.arange(len(labels)), len(t))].reset_index(drop=True)
+    frame['year'] = np.repeat(YEARS, len(labels))
+    frame['population'] = population.ravel().round().astype(np.int64)
+    frame.to_csv(path, index=False)
+    return len(frame)
+
+
+def workbook_frame(size, seed=0):
+    # Figure 1 reads rates only; the widest sizes are cut to '<20 years' to stay inside Excel's row limit
+    ages = None
+    if expected_rows(size) // len(SIZES[size]['metrics']) > EXCEL_MAX_ROWS:
+        print("Sheet1 would not fit in one worksheet, keeping '<20 years' only")
+        ages = ['<20 years']
+    frames = []
+    for frame in iter_frames(size, seed):
+        keep = frame['metric'] == 'Rate'
+        if ages is not None:
+            keep &= frame['age'].isin(ages)
+        frames.append(frame[keep].drop(columns='metric'))
+    sheet1 = pd.concat(frames, ignore_index=True)
+    if len(sheet1) > EXCEL_MAX_ROWS:
+        raise ValueError(f"Sheet1 has {len(sheet1)} rows, more than a worksheet can hold")
+    return sheet1
+
+
+def write_workbook(size, path, seed=0):
+    from openpyxl import Workbook
+
+    sheet1 = workbook_frame(size, seed)
+    apc, aapc = joinpoint_regression(sheet1, method='bic')
+
+    workbook = Workbook(write_only=True)
+    for name, frame in [('Sheet1', sheet1), ('Sheet2', aapc), ('Sheet3', apc)]:
+        sheet = workbook.create_sheet(name)
+        sheet.append(list(frame.columns))
+        for row in frame.itertuples(index=False):
+            sheet.append([value.item() if isinstance(value, np.generic) else value for value in row])
+    workbook.save(path)
+    return len(sheet1)
+
+
+def generate(size, output_dir, seed=0, workbook=True, n_draws=0, population=False):
+    os.makedirs(output_dir, exist_ok=True)
+    info = {'size': size, 'seed': seed}
+
+    start = time.perf_counter()
+    csv_path = os.path.join(output_dir, f'gbd_{size}.csv')
+    info['csv_path'] = csv_path
+    info['csv_rows'] = write_csv(size, csv_path, seed)
+    info['csv_bytes'] = os.path.getsize(csv_path)
+    info['csv_seconds'] = time.perf_counter() - start
+
+    if workbook:
+        start = time.perf_counter()
+        xlsx_path = os.path.join(output_dir, f'gbd_{size}.xlsx')
+        info['xlsx_path'] = xlsx_path
+        info['xlsx_rows'] = write_workbook(size, xlsx_path, seed)
+        info['xlsx_bytes'] = os.path.getsize(xlsx_path)
+        info['xlsx_seconds'] = time.perf_counter() - start
+
+    if n_draws:
+        start = time.perf_counter()
+        draws_path = os.path.join(output_dir, f'gbd_{size}_draws.csv')
+        info['draws_path'] = draws_path
+        info['draws_rows'] = write_draws(size, draws_path, n_draws, seed)
+        info['draws_bytes'] = os.path.getsize(draws_path)
+        info['draws_seconds'] = time.perf_counter() - start
+
+    if population:
+        population_path = os.path.join(output_dir, f'gbd_{size}_population.csv')
+        info['population_path'] = population_path
+        info['population_rows'] = write_population(size, population_path, seed)
+    return info
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic GBD exports')
+    parser.add_argument('--size', choices=sorted(SIZES), default='single')
+    parser.add_argument('--output-dir', default='.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-workbook', action='store_true', help='write the long-format CSV only')
+    parser.add_argument('--draws', type=int, default=0, help='also write a draw file with this many draws per row')
+    parser.add_argument('--population', action='store_true', help='also write a matching population file')
+    args = parser.parse_args()
+
+    print(f"Writing {expected_rows(args.size)} rows ({args.size})...")
+    info = generate(args.size, args.output_dir, args.seed, workbook=not args.no_workbook, n_draws=args.draws,
+                    population=args.population)
+    for key, value in info.items():
+        print(f"  {key}: {value}")
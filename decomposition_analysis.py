@@ -0,0 +1,153 @@
+#Burden change decomposition
+import argparse
+import os
+import numpy as np
+import pandas as pd
+import matplotlib.pyplot as plt
+import age_standardization
+import decomposition_engine
+import gbd_io
+from age_standardization import UNDER_20_AGES, population_table, read_population
+from decomposition_engine import COMPONENTS, decompose
+from figure_export import export_figure
+from figure_loader import load_figure
+from gbd_io import iter_gbd_filtered
+from instrumentation import set_rows, stage, traced
+from stage_cache import cached, input_digest, source_digest, stage_key
+
+MEASURES = ['Prevalence', 'DALYs']
+COMPONENT_TITLES = {
+    'population_growth': 'Population growth',
+    'age_structure': 'Age structure',
+    'rate_change': 'Age-specific rate change',
+}
+
+
+def decomposition_filters(causes, measures, ages, years):
+    return [
+        ('metric', '==', 'Number'),
+        ('cause', 'in', causes),
+        ('measure', 'in', measures),
+        ('age', 'in', ages),
+        ('year', 'in', years),
+    ]
+
+
+def plot_component(ax, table, component, locations, causes, colors, hatches):
+    # causes stacked left (decreases) and right (increases) of zero, as % of the start year's total count
+    y = np.arange(len(locations))
+    totals = table.groupby('location')['count_start'].sum()
+    positive = np.zeros(len(locations))
+    negative = np.zeros(len(locations))
+    for i, cause in enumerate(causes):
+        rows = table[table['cause'] == cause].set_index('location').reindex(locations)
+        share = (rows[component] / totals.reindex(locations) * 100).fillna(0).to_numpy()
+        left = np.where(share >= 0, positive, negative)
+        ax.barh(y, share, left=left, height=0.75, color=colors[cause], edgecolor='white', linewidth=0.8,
+                hatch=hatches[i] if i < len(hatches) else '')
+        positive += np.maximum(share, 0)
+        negative += np.minimum(share, 0)
+    net = (table.groupby('location')[component].sum() / totals * 100).reindex(locations)
+    ax.scatter(net, y, marker='D', color='black', s=30, zorder=5)
+
+    ax.axvline(0, color='black', linewidth=0.8)
+    ax.set_yticks(y)
+    ax.set_yticklabels(locations)
+    ax.tick_params(axis='x', labelsize=14)
+    ax.tick_params(axis='y', labelsize=14)
+    ax.spines['right'].set_visible(False)
+    ax.spines['top'].set_visible(False)
+    ax.yaxis.set_ticks_position('none')
+    ax.margins(y=0.01)
+
+
+def plot_decomposition(table, measures, locations, causes, years):
+    figure3 = load_figure(3)
+    figure3.set_plot_style()
+    colors, hatches = figure3.CAUSE_COLORS, figure3.CAUSE_HATCHES
+
+    fig = plt.figure(figsize=(24, 14 * len(measures)))
+    subfigs = fig.subfigures(nrows=len(measures), ncols=1, hspace=0, squeeze=False)[:, 0]
+    for subfig, measure in zip(subfigs, measures):
+        with stage(f'render.{measure}'):
+            axes = subfig.subplots(nrows=1, ncols=len(COMPONENTS), sharey=True)
+            subfig.subplots_adjust(wspace=0.08)
+            rows = table[table['measure'] == measure]
+            for ax, component in zip(axes, COMPONENTS):
+                plot_component(ax, rows, component, locations, causes, colors, hatches)
+                ax.set_title(COMPONENT_TITLES[component], fontsize=16)
+            subfig.text(0.5, 0.93, f'{measure}: change in counts {years[0]}-{years[-1]} (% of {years[0]})',
+                        ha='center', fontsize=18, fontweight='bold')
+
+    handles = [plt.Rectangle((0, 0), 1, 1, fc=colors[cause], ec='white', lw=2.0,
+                             hatch=hatches[i] if i < len(hatches) else '') for i, cause in enumerate(causes)]
+    handles.append(plt.Line2D([0], [0], marker='D', color='black', lw=0, markersize=7))
+    fig.legend(handles, causes + ['Net effect'], loc='center left', bbox_to_anchor=(0.91, 0.5), fontsize=14,
+               handlelength=3.0, borderpad=1.2, frameon=True, edgecolor='#CCCCCC', fancybox=False,
+               labelspacing=1.2)
+    return fig
+
+
+@traced('Decomposition')
+def run_decomposition(file_path, population_path, output_dir, data=None, ages=UNDER_20_AGES, years=(1990, 2021),
+                      sex='Both', locations=None, use_cache=True):
+    # every location x sex x cause x measure with the age-specific counts is decomposed;
+    # the figure shows Figure 3's locations (those present) for one sex
+    os.makedirs(output_dir, exist_ok=True)
+    figure3 = load_figure(3)
+    causes = figure3.CAUSES
+    years = list(years)
+    filters = decomposition_filters(causes, MEASURES, list(ages), years)
+
+    def compute():
+        with stage('population'):
+            population = population_table(read_population(population_path))
+        return pd.concat([decompose(part, population, ages, years)
+                          for part in iter_gbd_filtered(file_path, filters, ['location'], data, use_cache)],
+                         ignore_index=True)
+
+    with stage('statistics'):
+        if use_cache:
+            key = stage_key('decomposition', input_digest(file_path), input_digest(population_path), filters,
+                            source_digest(decomposition_engine, age_standardization, gbd_io))
+            table = cached(key, compute)
+        else:
+            table = compute()
+        set_rows(len(table))
+
+    with stage('tables'):
+        table.to_csv(os.path.join(output_dir, 'Decomposition_results.csv'), index=False)
+        summary = table.groupby(['location', 'sex', 'measure'], observed=True)[
+            ['count_start', 'count_end', 'change'] + COMPONENTS].sum().reset_index()
+        for name in ['change'] + COMPONENTS:
+            summary[f'{name}_percent'] = summary[name] / summary['count_start'] * 100
+        summary.to_csv(os.path.join(output_dir, 'Decomposition_summary.csv'), index=False)
+    print(f"Decomposition tables saved: {len(table)} series, {table['location'].nunique()} locations")
+
+    shown = table[table['sex'] == sex]
+    locations = [location for location in (locations or figure3.LOCATIONS) if location in set(shown['location'])]
+    if not locations:
+        print(f"No decomposed series for the figure locations ({sex}), figure skipped")
+        return True
+    fig = plot_decomposition(shown, MEASURES, locations[::-1], causes, years)
+    with stage('export'):
+        paths = export_figure(fig, os.path.join(output_dir, 'Decomposition_Analysis'), {'png': 300, 'pdf': None},
+                              facecolor='white', edgecolor='none')
+    print(f"Decomposition figure saved: {paths['png']}")
+    plt.close(fig)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Decompose the change in counts into population growth, '
+                                                 'age structure and age-specific rate change')
+    parser.add_argument('input', help='GBD export with age-specific Number rows (csv, zip or directory)')
+    parser.add_argument('--population', required=True, help='population file (location, sex, age, year, population/val)')
+    parser.add_argument('--output-dir', default=os.path.expanduser('~/Desktop/GBD'))
+    parser.add_argument('--ages', nargs='+', default=UNDER_20_AGES, help='age groups making up the total')
+    parser.add_argument('--years', type=int, nargs=2, default=[1990, 2021])
+    parser.add_argument('--sex', default='Both', help='sex shown in the figure')
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+    run_decomposition(args.input, args.population, args.output_dir, ages=args.ages, years=args.years, sex=args.sex,
+                      use_cache=not args.no_cache)
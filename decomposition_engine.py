@@ -0,0 +1,72 @@
+#Decomposition engine
+import numpy as np
+import pandas as pd
+from age_standardization import UNDER_20_AGES, age_specific_rates
+
+DECOMPOSITION_KEYS = ['location', 'sex', 'cause', 'measure']
+COMPONENTS = ['population_growth', 'age_structure', 'rate_change']
+
+
+def decomposition_arrays(counts, population, ages=UNDER_20_AGES, years=(1990, 2021), keys=DECOMPOSITION_KEYS):
+    # age-specific Number rows + population -> (series, age, year) count and population arrays;
+    # cells with no row (or no population) stay NaN
+    rates = age_specific_rates(counts, population)
+    keys = [key for key in keys if key in rates.columns]
+    grouped = rates.groupby(keys, observed=True, sort=True)
+    series = grouped.ngroup().to_numpy()
+    index = grouped.size().index.to_frame(index=False)
+    age = pd.Index(list(ages)).get_indexer(np.asarray(rates['age'], dtype=object))
+    year = pd.Index(list(years)).get_indexer(rates['year'].to_numpy(dtype=int))
+    keep = (series >= 0) & (age >= 0) & (year >= 0)
+
+    shape = (len(index), len(ages), len(years))
+    cell = (series[keep], age[keep], year[keep])
+    count = np.full(shape, np.nan)
+    pop = np.full(shape, np.nan)
+    count[cell] = rates['val'].to_numpy(dtype=float)[keep]
+    pop[cell] = rates['population'].to_numpy(dtype=float)[keep]
+    return index, count, pop
+
+
+def das_gupta(count, pop):
+    # Das Gupta's symmetric three-factor decomposition of N = P * sum_a(s_a * r_a)
+    # (P total population, s_a age share, r_a age-specific rate) between the first and last year.
+    # Each factor's effect averages its change over every combination of the other two at either
+    # end, so the three effects add up to N1 - N0 exactly.
+    total = pop.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        share = pop / total[:, None, :]
+        rate = count / pop
+    P0, P1 = total[:, 0, None], total[:, -1, None]
+    s0, s1 = share[..., 0], share[..., -1]
+    r0, r1 = rate[..., 0], rate[..., -1]
+
+    def weight(a0, a1, b0, b1):
+        return (a0 * b0 + a1 * b1) / 3 + (a0 * b1 + a1 * b0) / 6
+
+    effects = {
+        'population_growth': ((P1 - P0) * weight(s0, s1, r0, r1)).sum(axis=1),
+        'age_structure': ((s1 - s0) * weight(P0, P1, r0, r1)).sum(axis=1),
+        'rate_change': ((r1 - r0) * weight(P0, P1, s0, s1)).sum(axis=1),
+    }
+    # a series missing any age or year is left out rather than decomposed on partial ages
+    complete = np.isfinite(count).all(axis=(1, 2)) & np.isfinite(pop).all(axis=(1, 2)) & (pop > 0).all(axis=(1, 2))
+    return {name: np.where(complete, value, np.nan) for name, value in effects.items()}, complete
+
+
+def decompose(counts, population, ages=UNDER_20_AGES, years=(1990, 2021), keys=DECOMPOSITION_KEYS):
+    index, count, pop = decomposition_arrays(counts, population, ages, years, keys)
+    effects, complete = das_gupta(count, pop)
+    table = index
+    table['count_start'] = np.where(complete, count[..., 0].sum(axis=1), np.nan)
+    table['count_end'] = np.where(complete, count[..., -1].sum(axis=1), np.nan)
+    table['change'] = table['count_end'] - table['count_start']
+    for name in COMPONENTS:
+        table[name] = effects[name]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for name in ['change'] + COMPONENTS:
+            table[f'{name}_percent'] = table[name] / table['count_start'] * 100
+    skipped = int((~complete).sum())
+    if skipped:
+        print(f"Decomposition skipped {skipped} series with missing ages, years or population")
+    return table[complete].reset_index(drop=True)
@@ -0,0 +1,213 @@
+#Figure export
+import io
+import os
+import pickle
+import warnings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.transforms import Bbox
+from PIL import Image
+from instrumentation import stage
+
+
+def figure_bbox_inches(fig, bbox_inches='tight', pad_inches=None, dpi=None):
+    if bbox_inches != 'tight':
+        return Bbox.from_bounds(0, 0, *fig.get_size_inches()) if bbox_inches is None else bbox_inches
+    pad_inches = plt.rcParams['savefig.pad_inches'] if pad_inches is None else pad_inches
+    # text extents depend on the dpi, so the tight bbox is measured at the output dpi, as savefig does
+    figure_dpi = fig.dpi
+    fig.dpi = dpi or figure_dpi
+    try:
+        bbox = fig.get_tightbbox(fig.canvas.get_renderer())
+    finally:
+        fig.dpi = figure_dpi
+    return bbox.padded(pad_inches)
+
+
+def canvas_size(bbox, dpi):
+    # Agg truncates the canvas size in pixels
+    return int(bbox.width * dpi), int(bbox.height * dpi)
+
+
+RASTER_FORMATS = ('png', 'jpg', 'jpeg')
+
+
+def render_strip(fig, bbox, dpi, **savefig_kwargs):
+    # rasterise only the region `bbox` (inches) of the figure
+    buf = io.BytesIO()
+    fig.savefig(buf, format='rgba', dpi=dpi, bbox_inches=bbox, pad_inches=0, **savefig_kwargs)
+    width = canvas_size(bbox, dpi)[0]
+    pixels = np.frombuffer(buf.getbuffer(), dtype=np.uint8)
+    return pixels.reshape(-1, width, 4)
+
+
+def iter_strips(fig, bbox, dpi, strip_height, **savefig_kwargs):
+    width, height = canvas_size(bbox, dpi)
+    # a sliver of slack keeps int() truncation from dropping a row or column
+    slack = 1e-3 / dpi
+    for top in range(0, height, strip_height):
+        rows = min(strip_height, height - top)
+        # strips stack up from the bottom edge, which is where the rasteriser anchors the canvas
+        y0 = bbox.y0 + (height - top - rows) / dpi
+        strip_bbox = Bbox.from_extents(bbox.x0, y0, bbox.x0 + width / dpi + slack, y0 + rows / dpi + slack)
+        strip = render_strip(fig, strip_bbox, dpi, **savefig_kwargs)
+        if strip.shape[:2] == (rows, width):
+            yield strip[:, :, :3]
+            continue
+        out = np.full((rows, width, 3), 255, dtype=np.uint8)
+        h = min(rows, strip.shape[0])
+        w = min(width, strip.shape[1])
+        out[:h, :w] = strip[:h, :w, :3]
+        yield out
+
+
+def iter_tiles(strips, width, tile):
+    # regroup horizontal strips of any height into padded tiles in TIFF order,
+    # copying only the rows that straddle two strips
+    pending = None
+    for strip in strips:
+        start = 0
+        if pending is not None:
+            start = tile - pending.shape[0]
+            pending = np.concatenate([pending, strip[:start]])
+            if pending.shape[0] < tile:
+                continue
+            yield from _row_tiles(pending, width, tile)
+            pending = None
+        for row in range(start, strip.shape[0], tile):
+            band = strip[row:row + tile]
+            if band.shape[0] < tile:
+                pending = band.copy()
+                break
+            yield from _row_tiles(band, width, tile)
+    if pending is not None:
+        yield from _row_tiles(pending, width, tile)
+
+
+def _row_tiles(band, width, tile):
+    for col in range(0, width, tile):
+        block = np.full((tile, tile, 3), 255, dtype=np.uint8)
+        piece = band[:, col:col + tile]
+        block[:piece.shape[0], :piece.shape[1]] = piece
+        yield block
+
+
+def save_tiff_streaming(fig, path, dpi=600, bbox_inches='tight', pad_inches=None,
+                        strip_height=None, tile=256, compression='zlib', max_strip_bytes=128 * 1024 ** 2,
+                        **savefig_kwargs):
+    bbox = figure_bbox_inches(fig, bbox_inches, pad_inches, dpi)
+    width, height = canvas_size(bbox, dpi)
+    try:
+        import tifffile
+    except ImportError:
+        warnings.warn("tifffile is not installed; writing the TIFF with Pillow in one piece, "
+                      "which holds the whole raster in memory")
+        fig.savefig(path, format='tiff', dpi=dpi, bbox_inches=bbox, pad_inches=0,
+                    pil_kwargs={'compression': 'tiff_deflate' if compression == 'zlib' else 'tiff_lzw'},
+                    **savefig_kwargs)
+        return path
+
+    # every strip is a full redraw of the figure, so strips are as tall as the memory budget allows;
+    # hatch patterns repeat every inch, so whole-inch strips keep them continuous across seams
+    if strip_height is None:
+        strip_height = max(1, max_strip_bytes // (4 * max(width, 1)))
+    dpi_px = max(1, int(round(dpi)))
+    strip_height = max(1, strip_height // dpi_px) * dpi_px
+    bigtiff = width * height * 3 > 2 ** 32 - 2 ** 25
+    with tifffile.TiffWriter(path, bigtiff=bigtiff) as tif:
+        tif.write(
+            iter_tiles(iter_strips(fig, bbox, dpi, strip_height, **savefig_kwargs), width, tile),
+            shape=(height, width, 3),
+            dtype=np.uint8,
+            photometric='rgb',
+            tile=(tile, tile),
+            compression=compression,
+            resolution=(dpi, dpi),
+            resolutionunit='INCH',
+        )
+    return path
+
+
+def encode_raster(pixels, path, fmt, dpi):
+    image = Image.fromarray(pixels)
+    if fmt in ('jpg', 'jpeg'):
+        image = image.convert('RGB')
+    image.save(path, dpi=(dpi, dpi))
+    return path
+
+
+def save_format(fig, path, fmt, dpi, bbox, **savefig_kwargs):
+    if fmt in ('tif', 'tiff'):
+        return save_tiff_streaming(fig, path, dpi=dpi, bbox_inches=bbox, **savefig_kwargs)
+    fig.savefig(path, format=fmt, dpi=dpi, bbox_inches=bbox, pad_inches=0, **savefig_kwargs)
+    return path
+
+
+def _save_format_worker(fig_bytes, rc, path, fmt, dpi, bbox, savefig_kwargs):
+    plt.switch_backend('Agg')
+    with plt.rc_context(rc):
+        fig = pickle.loads(fig_bytes)
+        try:
+            return save_format(fig, path, fmt, dpi, bbox, **savefig_kwargs)
+        finally:
+            plt.close(fig)
+
+
+def export_figure(fig, path_stem, formats, bbox_inches='tight', pad_inches=None, n_jobs=None,
+                  **savefig_kwargs):
+    # formats maps extension -> dpi, e.g. {'png': 300, 'pdf': None, 'tiff': 600}.
+    # The tight bbox is measured once per output dpi; raster formats sharing a dpi reuse one Agg buffer,
+    # and vector/TIFF outputs are drawn in worker processes while the rasters encode.
+    formats = dict.fromkeys(formats) if not isinstance(formats, dict) else formats
+    paths = {fmt: f'{path_stem}.{fmt}' for fmt in formats}
+
+    default_dpi = plt.rcParams['savefig.dpi']
+    default_dpi = fig.dpi if default_dpi == 'figure' else default_dpi
+    with stage('layout'):
+        bboxes = {dpi: figure_bbox_inches(fig, bbox_inches, pad_inches, dpi)
+                  for dpi in {dpi or default_dpi for dpi in formats.values()}}
+    format_bboxes = {fmt: bboxes[dpi or default_dpi] for fmt, dpi in formats.items()}
+    raster_groups = {}
+    separate = []
+    for fmt, dpi in formats.items():
+        if fmt in RASTER_FORMATS:
+            raster_groups.setdefault(dpi or default_dpi, []).append(fmt)
+        else:
+            separate.append(fmt)
+
+    n_jobs = n_jobs or os.cpu_count() or 1
+    pool = None
+    futures = {}
+    if n_jobs > 1 and separate and (len(separate) > 1 or raster_groups):
+        try:
+            fig_bytes = pickle.dumps(fig)
+            rc = {key: value for key, value in plt.rcParams.items() if key != 'backend'}
+            pool = ProcessPoolExecutor(max_workers=min(n_jobs, len(separate)))
+            futures = {fmt: pool.submit(_save_format_worker, fig_bytes, rc, paths[fmt], fmt, formats[fmt],
+                                        format_bboxes[fmt], savefig_kwargs) for fmt in separate}
+        except Exception as e:
+            print(f"Exporting formats one at a time: {e}")
+
+    try:
+        with ThreadPoolExecutor() as encoders:
+            encoded = []
+            for dpi, fmts in raster_groups.items():
+                with stage(f'rasterize.{dpi}dpi'):
+                    pixels = render_strip(fig, bboxes[dpi], dpi, **savefig_kwargs)
+                encoded += [encoders.submit(encode_raster, pixels, paths[fmt], fmt, dpi) for fmt in fmts]
+            for fmt in separate:
+                if fmt not in futures:
+                    with stage(f'savefig.{fmt}'):
+                        save_format(fig, paths[fmt], fmt, formats[fmt], format_bboxes[fmt], **savefig_kwargs)
+            with stage('encode'):
+                for future in encoded:
+                    future.result()
+        # worker-process saves: wall time spent waiting on them in this process
+        for fmt, future in futures.items():
+            with stage(f'savefig.{fmt}.worker'):
+                future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return paths
@@ -0,0 +1,45 @@
+#Figure fonts
+import json
+import os
+from stage_cache import DEFAULT_CACHE_DIR
+
+FONT_CACHE_FILE = os.path.join(DEFAULT_CACHE_DIR, 'fonts.json')
+GENERIC_FAMILIES = {'serif', 'sans-serif', 'cursive', 'fantasy', 'monospace'}
+
+
+def _font_list_stamp():
+    import matplotlib
+    from matplotlib import font_manager
+
+    fontlist = os.path.join(matplotlib.get_cachedir(), f'fontlist-v{font_manager.FontManager.__version__}.json')
+    return [matplotlib.__version__, os.path.getmtime(fontlist) if os.path.exists(fontlist) else 0]
+
+
+def resolve_font_families(candidates):
+    # keep only installed families (in order) so text lookups never fall through to the
+    # missing-font search; resolved once per matplotlib font list and persisted on disk
+    stamp = _font_list_stamp()
+    try:
+        with open(FONT_CACHE_FILE, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    if cache.get('stamp') != stamp:
+        cache = {'stamp': stamp, 'families': {}}
+
+    key = '|'.join(candidates)
+    if key not in cache['families']:
+        from matplotlib import font_manager
+
+        installed = {font.name for font in font_manager.fontManager.ttflist}
+        resolved = [name for name in candidates if name in installed or name in GENERIC_FAMILIES]
+        cache['families'][key] = resolved or list(candidates)
+        try:
+            os.makedirs(os.path.dirname(FONT_CACHE_FILE), exist_ok=True)
+            tmp_path = f'{FONT_CACHE_FILE}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, FONT_CACHE_FILE)
+        except OSError as e:
+            print(f"Font cache not written: {e}")
+    return cache['families'][key]
@@ -0,0 +1,44 @@
+#Figure loader
+import importlib.util
+import os
+import sys
+
+FIGURE_FILES = {
+    1: 'Figure 1.py',
+    2: 'Figure 2.py',
+    3: 'Figure 3.py',
+}
+
+# local modules each figure script imports, directly or through another module
+FIGURE_DEPENDENCIES = {
+    1: ['figure_export.py', 'figure_loader.py', 'gbd_io.py', 'instrumentation.py', 'joinpoint_engine.py',
+        'stage_cache.py'],
+    2: ['aapc_engine.py', 'gbd_cube.py', 'gbd_io.py', 'instrumentation.py', 'joinpoint_engine.py', 'stage_cache.py'],
+    3: ['figure_export.py', 'figure_fonts.py', 'gbd_cube.py', 'gbd_io.py', 'instrumentation.py', 'stage_cache.py'],
+}
+
+
+def figure_source_files(number):
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    return [os.path.join(base_dir, name) for name in [FIGURE_FILES[number]] + FIGURE_DEPENDENCIES[number]]
+
+
+def load_figure(number):
+    # the figure scripts have spaces in their file names, so they are loaded by path
+    name = f'figure{number}'
+    if name not in sys.modules:
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), FIGURE_FILES[number])
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        try:
+            spec.loader.exec_module(module)
+        except Exception:
+            del sys.modules[name]
+            raise
+    return sys.modules[name]
+
+
+def call_figure_function(number, func_name, *args, **kwargs):
+    # picklable entry point for process pools: workers resolve the function by name
+    return getattr(load_figure(number), func_name)(*args, **kwargs)
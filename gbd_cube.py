@@ -0,0 +1,187 @@
+#GBD value cube
+import argparse
+import json
+import os
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+import gbd_io
+from gbd_io import GBD_COLUMNS, filter_mask, iter_csv_chunks, resolve_csv_sources
+from stage_cache import cache_path, input_digest, source_digest, stage_key
+
+DIMENSIONS = ['year', 'location', 'sex', 'age', 'cause', 'measure', 'metric']
+VALUE_COLUMNS = ['val', 'upper', 'lower']
+
+
+def cube_files(stem):
+    # labels go last: a cube is complete once its .json exists
+    return {**{stat: f'{stem}.{stat}.npy' for stat in VALUE_COLUMNS}, 'labels': f'{stem}.json'}
+
+
+def collect_labels(sources, filters=None, chunksize=500_000):
+    # first pass: dimension labels in order of first appearance, years ascending
+    seen = {dim: {} for dim in DIMENSIONS}
+    rows = 0
+    for source in sources:
+        for _, chunk in iter_csv_chunks(source, filters, usecols=DIMENSIONS, chunksize=chunksize):
+            rows += len(chunk)
+            for dim in DIMENSIONS:
+                seen[dim].update(dict.fromkeys(chunk[dim].unique().tolist()))
+    labels = {dim: list(values) for dim, values in seen.items()}
+    labels['year'] = sorted(int(year) for year in labels['year'])
+    return labels, rows
+
+
+def build_cube(file_path, stem, filters=None, chunksize=500_000):
+    # long-format export -> dense float32 year x location x sex x age x cause x measure x metric
+    # arrays (one .npy per value column) plus the label dictionaries; missing cells are NaN and
+    # duplicate rows for a cell are averaged, as the frame path does
+    sources = resolve_csv_sources(file_path)
+    labels, rows = collect_labels(sources, filters, chunksize)
+    shape = tuple(len(labels[dim]) for dim in DIMENSIONS)
+    cells = int(np.prod(shape))
+    print(f"Building value cube {shape} from {rows} rows ({rows / max(cells, 1):.0%} of cells filled)")
+
+    files = cube_files(stem)
+    tmp = {name: f'{path}.{os.getpid()}.tmp' for name, path in files.items()}
+    counts_tmp = {stat: f'{stem}.{stat}.count.{os.getpid()}.tmp' for stat in VALUE_COLUMNS}
+    os.makedirs(os.path.dirname(os.path.abspath(stem)), exist_ok=True)
+    try:
+        # value sums and counts per cell, divided once every row is in
+        arrays = {stat: open_memmap(tmp[stat], mode='w+', dtype=np.float32, shape=shape) for stat in VALUE_COLUMNS}
+        counts = {stat: open_memmap(counts_tmp[stat], mode='w+', dtype=np.uint32, shape=shape)
+                  for stat in VALUE_COLUMNS}
+
+        categories = {dim: pd.Index(labels[dim]) for dim in DIMENSIONS}
+        for source in sources:
+            for _, chunk in iter_csv_chunks(source, filters, usecols=GBD_COLUMNS, chunksize=chunksize):
+                flat = np.ravel_multi_index(tuple(categories[dim].get_indexer(chunk[dim]) for dim in DIMENSIONS),
+                                            shape)
+                for stat in VALUE_COLUMNS:
+                    values = chunk[stat].to_numpy(dtype=float)
+                    valid = np.isfinite(values)
+                    cell, inverse = np.unique(flat[valid], return_inverse=True)
+                    arrays[stat].reshape(-1)[cell] += np.bincount(inverse, weights=values[valid]).astype(np.float32)
+                    counts[stat].reshape(-1)[cell] += np.bincount(inverse).astype(np.uint32)
+        for stat in VALUE_COLUMNS:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                for year in range(shape[0]):
+                    arrays[stat][year] = arrays[stat][year] / counts[stat][year]
+            arrays[stat].flush()
+        del arrays, counts
+
+        with open(tmp['labels'], 'w', encoding='utf-8') as f:
+            json.dump({'dimensions': DIMENSIONS, 'values': VALUE_COLUMNS, 'labels': labels, 'rows': rows}, f)
+        for name in [*VALUE_COLUMNS, 'labels']:
+            os.replace(tmp[name], files[name])
+    finally:
+        for path in [*tmp.values(), *counts_tmp.values()]:
+            if os.path.exists(path):
+                os.remove(path)
+    return stem
+
+
+def open_cube(stem, mode='r'):
+    # arrays are memory-mapped, so processes opening the same cube share its pages
+    files = cube_files(stem)
+    with open(files['labels'], encoding='utf-8') as f:
+        meta = json.load(f)
+    cube = {
+        'path': stem,
+        'dimensions': meta['dimensions'],
+        'labels': meta['labels'],
+        'index': {dim: {label: i for i, label in enumerate(labels)} for dim, labels in meta['labels'].items()},
+    }
+    for stat in meta['values']:
+        cube[stat] = np.load(files[stat], mmap_mode=mode)
+    return cube
+
+
+def cube_stem(file_path, filters=None):
+    code = source_digest(collect_labels, build_cube, gbd_io)
+    return cache_path(stage_key('cube', input_digest(file_path), filters, code), suffix='')
+
+
+def cube_for(file_path, stem=None, filters=None):
+    # opens the cube built from file_path, building it first when it is missing or incomplete
+    stem = stem or cube_stem(file_path, filters)
+    try:
+        cube = open_cube(stem)
+    except (OSError, ValueError):
+        build_cube(file_path, stem, filters)
+        return open_cube(stem)
+    for path in cube_files(stem).values():
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+    return cube
+
+
+def cube_selection(cube, **selection):
+    # integer index per axis: one label picks a position (the axis is dropped),
+    # a list of labels keeps the axis, an omitted dimension keeps every label
+    unknown = set(selection) - set(cube['dimensions'])
+    if unknown:
+        raise ValueError(f"Unknown cube dimensions: {sorted(unknown)}")
+    key = []
+    for dim in cube['dimensions']:
+        labels = selection.get(dim)
+        if labels is None:
+            key.append(slice(None))
+        elif isinstance(labels, (list, tuple, np.ndarray, pd.Index)):
+            key.append(np.array([cube['index'][dim][label] for label in labels], dtype=np.intp))
+        else:
+            key.append(cube['index'][dim][labels])
+    return key
+
+
+def select(cube, stat='val', **selection):
+    key = cube_selection(cube, **selection)
+    # single positions first (a view into the map), then one axis at a time for label lists
+    values = cube[stat][tuple(slice(None) if isinstance(k, np.ndarray) else k for k in key)]
+    kept = [k for k in key if not isinstance(k, (int, np.integer))]
+    for axis, k in enumerate(kept):
+        if isinstance(k, np.ndarray):
+            values = np.take(values, k, axis=axis)
+    return values
+
+
+def selection_from_filters(cube, filters):
+    # gbd_io filters ((column, op, value) tuples) resolved against the label dictionaries
+    selection = {}
+    for column, op, value in filters or []:
+        if column not in cube['dimensions']:
+            raise ValueError(f"Cannot filter a value cube on: {column}")
+        labels = pd.Series(selection.get(column, cube['labels'][column]))
+        selection[column] = labels[filter_mask(labels.to_frame(column), [(column, op, value)])].tolist()
+    return selection
+
+
+def cube_frame(cube, filters=None):
+    # long-format rows of the selected cells that hold a value, as read_gbd_csv would return them
+    selection = selection_from_filters(cube, filters)
+    labels = {dim: selection.get(dim, cube['labels'][dim]) for dim in cube['dimensions']}
+    values = {stat: select(cube, stat, **selection) for stat in VALUE_COLUMNS}
+    codes = np.nonzero(~np.isnan(values['val']))
+
+    columns = {}
+    for dim, code in zip(cube['dimensions'], codes):
+        if dim == 'year':
+            columns[dim] = np.asarray(labels[dim], dtype=np.int64)[code]
+        else:
+            columns[dim] = pd.Categorical.from_codes(code, categories=labels[dim])
+    for stat in VALUE_COLUMNS:
+        columns[stat] = values[stat][codes]
+    return pd.DataFrame(columns)[GBD_COLUMNS]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a long-format GBD export into a memory-mapped value cube')
+    parser.add_argument('input', help='GBD export (csv, zip, directory or glob)')
+    parser.add_argument('output', help='output path stem (writes <stem>.json and <stem>.<val|upper|lower>.npy)')
+    args = parser.parse_args()
+
+    cube = open_cube(build_cube(args.input, args.output))
+    for dim in cube['dimensions']:
+        print(f"  {dim}: {len(cube['labels'][dim])} labels")
@@ -0,0 +1,413 @@
+#GBD data ingestion
+import glob
+import hashlib
+import importlib.util
+import os
+import pickle
+import re
+import tempfile
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import pandas as pd
+import stage_cache
+from instrumentation import set_rows, stage
+from stage_cache import cached, input_digest, source_digest, stage_key
+
+CACHE_VERSION = 2
+GBD_COLUMNS = ['measure', 'location', 'sex', 'age', 'cause', 'metric', 'year', 'val', 'upper', 'lower']
+LABEL_COLUMNS = ['measure', 'location', 'sex', 'age', 'cause', 'metric']
+VALUE_COLUMNS = ['val', 'upper', 'lower']
+# in-memory schema: labels as categorical codes, values as float32
+SCHEMA = {**{col: 'category' for col in LABEL_COLUMNS}, 'year': 'int16', **{col: 'float32' for col in VALUE_COLUMNS}}
+# years are read as floats, since an int16 read fails on a blank year, and cast once those rows are dropped
+READ_SCHEMA = {**SCHEMA, 'year': 'float64'}
+SHEET_BATCH_ROWS = 100_000
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(text):
+    # '512M', '4G', '1.5GB' or a plain byte count
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)I?B?\s*', str(text).upper())
+    if match is None:
+        raise ValueError(f"Invalid size: {text}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+
+def default_memory_budget():
+    # GBD_MEMORY_BUDGET, or half of the physical memory
+    if os.environ.get('GBD_MEMORY_BUDGET'):
+        return parse_size(os.environ['GBD_MEMORY_BUDGET'])
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 2
+    except (AttributeError, ValueError, OSError):
+        return 4 * 1024 ** 3
+
+
+MEMORY_BUDGET = default_memory_budget()
+
+
+class MemoryBudgetExceeded(MemoryError):
+    pass
+
+
+FULLWIDTH_TRANSLATION = str.maketrans({'＜': '<', '（': '(', '）': ')'})
+
+
+def file_digest(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def normalize_labels(df):
+    # normalize each distinct label once instead of every row
+    df.columns = df.columns.astype(str).str.strip()
+    for col in df.select_dtypes(include=['object', 'string']).columns:
+        codes, uniques = pd.factorize(df[col], use_na_sentinel=True)
+        normalized = pd.Index([str(u).translate(FULLWIDTH_TRANSLATION) for u in uniques] + ['nan'])
+        df[col] = normalized.take(codes).to_numpy(dtype=object)
+    return df
+
+
+def apply_schema(df):
+    # casts the GBD columns present to SCHEMA; a year column with gaps keeps its dtype
+    for col, dtype in SCHEMA.items():
+        if col not in df.columns or df[col].dtype == dtype:
+            continue
+        if dtype == 'int16' and df[col].isna().any():
+            continue
+        try:
+            df[col] = df[col].astype(dtype)
+        except (TypeError, ValueError):
+            pass
+    return df
+
+
+def drop_blank_years(df):
+    # rows without a year belong to no point of any trend, so they are dropped before the int16 cast
+    if 'year' not in df.columns:
+        return df
+    if df['year'].isna().any():
+        df = df[df['year'].notna()]
+    return df.astype({'year': SCHEMA['year']})
+
+
+def concat_frames(frames):
+    # pd.concat falls back to object columns when the chunks' categories differ,
+    # so label columns are brought onto shared categories first
+    frames = [frame for frame in frames if len(frame.columns)]
+    if not frames:
+        return pd.DataFrame()
+    if len(frames) > 1:
+        for col in frames[0].columns:
+            if all(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+                categories = pd.Index(list(dict.fromkeys(
+                    label for frame in frames for label in frame[col].cat.categories)))
+                for frame in frames:
+                    frame[col] = frame[col].cat.set_categories(categories)
+    return pd.concat(frames, ignore_index=True)
+
+
+def frame_nbytes(df):
+    return int(df.memory_usage(index=False, deep=False).sum())
+
+
+def _sheet_frame(rows, batch_rows=SHEET_BATCH_ROWS):
+    # rows arrive as Python tuples; they are converted to the compact schema a batch at a time
+    rows = iter(rows)
+    header = next(rows, None)
+    if header is None:
+        return pd.DataFrame()
+    columns = [f'Unnamed: {i}' if name is None else name for i, name in enumerate(header)]
+
+    frames = []
+    records = []
+    for row in rows:
+        if any(value is not None for value in row):
+            records.append(row)
+        if len(records) >= batch_rows:
+            frames.append(apply_schema(normalize_labels(pd.DataFrame.from_records(records, columns=columns))))
+            records = []
+    if records or not frames:
+        frames.append(apply_schema(normalize_labels(pd.DataFrame.from_records(records, columns=columns))))
+    return concat_frames(frames)
+
+
+def _cache_paths(file_path, digest, sheets, cache_dir):
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(file_path)), '.gbd_cache')
+    stem = f'{os.path.basename(file_path)}.{digest[:16]}.v{CACHE_VERSION}'
+    manifest = os.path.join(cache_dir, f"{stem}.{'-'.join(sheets)}.sheets")
+    return cache_dir, manifest, {sheet: os.path.join(cache_dir, f'{stem}.{sheet}.feather') for sheet in sheets}
+
+
+def read_workbook(file_path, sheets, cache_dir=None, use_cache=True):
+    # the Feather sidecar is part of the cache, so --no-cache / GBD_CACHE=0 turn it off too
+    use_cache = use_cache and stage_cache.ENABLED and importlib.util.find_spec('pyarrow') is not None
+    if use_cache:
+        digest = file_digest(file_path)
+        cache_dir, manifest, cache_files = _cache_paths(file_path, digest, sheets, cache_dir)
+        if os.path.exists(manifest):
+            with open(manifest, encoding='utf-8') as f:
+                present = [line.strip() for line in f if line.strip()]
+            if all(os.path.exists(cache_files[s]) for s in present if s in cache_files):
+                print(f"Loading cached workbook: {file_path}")
+                return {s: pd.read_feather(cache_files[s]) for s in present if s in cache_files}
+
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file_path, read_only=True, data_only=True)
+    try:
+        frames = {}
+        for sheet in sheets:
+            if sheet in workbook.sheetnames:
+                frames[sheet] = _sheet_frame(workbook[sheet].iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+    if use_cache:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            for sheet, frame in frames.items():
+                frame.to_feather(cache_files[sheet])
+            with open(manifest, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(frames))
+        except Exception as e:
+            print(f"Workbook cache not written: {e}")
+
+    return frames
+
+
+def _category_hits(col, op, value):
+    # tests each category once and broadcasts the result through the codes;
+    # missing labels (code -1) behave like NaN in the plain comparisons
+    categories = col.cat.categories
+    if op == '==':
+        hits, missing = categories == value, False
+    elif op == '!=':
+        hits, missing = categories != value, True
+    elif op == 'in':
+        hits, missing = categories.isin(value), False
+    elif op == 'not in':
+        hits, missing = ~categories.isin(value), True
+    elif op == 'contains':
+        hits, missing = categories.astype(str).str.contains(value, regex=False), value in 'nan'
+    else:
+        return None
+    return np.append(np.asarray(hits, dtype=bool), missing)[col.cat.codes.to_numpy()]
+
+
+def _column_hits(col, op, value):
+    if op == '==':
+        hits = col == value
+    elif op == '!=':
+        hits = col != value
+    elif op == 'in':
+        hits = col.isin(value)
+    elif op == 'not in':
+        hits = ~col.isin(value)
+    elif op == 'contains':
+        hits = col.astype(str).str.contains(value, regex=False)
+    elif op == 'between':
+        hits = col.between(*value)
+    else:
+        raise ValueError(f"Unsupported filter operator: {op}")
+    return hits.to_numpy(dtype=bool)
+
+
+def filter_mask(df, filters):
+    # filters: list of (column, op, value) with op in ==, !=, in, not in, contains, between
+    mask = np.ones(len(df), dtype=bool)
+    for column, op, value in filters or []:
+        col = df[column]
+        hits = _category_hits(col, op, value) if isinstance(col.dtype, pd.CategoricalDtype) else None
+        mask &= hits if hits is not None else _column_hits(col, op, value)
+    return mask
+
+
+def filter_frame(df, filters):
+    # one boolean take on the original frame, no intermediate copies
+    if not filters:
+        return df
+    return df[filter_mask(df, filters)]
+
+
+def as_categorical(df, columns=LABEL_COLUMNS):
+    for col in columns:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype('category')
+    return df
+
+
+def resolve_csv_sources(path):
+    # a .csv, a .zip bundle, a directory of either, or a glob pattern
+    if os.path.isdir(path):
+        paths = sorted(glob.glob(os.path.join(path, '*.zip')) + glob.glob(os.path.join(path, '*.csv')))
+    elif os.path.exists(path):
+        paths = [path]
+    else:
+        paths = sorted(glob.glob(path))
+    if not paths:
+        raise FileNotFoundError(f"No GBD export found at: {path}")
+
+    sources = []
+    for file_path in paths:
+        if zipfile.is_zipfile(file_path):
+            with zipfile.ZipFile(file_path) as archive:
+                members = [name for name in archive.namelist() if name.lower().endswith('.csv')]
+            sources.extend((file_path, member) for member in sorted(members))
+        else:
+            sources.append((file_path, None))
+    return sources
+
+
+def read_csv_header(source, encoding='utf-8'):
+    file_path, member = source
+    if member is None:
+        return pd.read_csv(file_path, nrows=0, encoding=encoding).columns.tolist()
+    with zipfile.ZipFile(file_path) as archive, archive.open(member) as handle:
+        return pd.read_csv(handle, nrows=0, encoding=encoding).columns.tolist()
+
+
+def iter_csv_chunks(source, filters=None, usecols=GBD_COLUMNS, chunksize=500_000, encoding='utf-8',
+                    categorical=True):
+    # yields (rows read, filtered chunk) so callers can stream an export of any size
+    file_path, member = source
+    wanted = set(usecols) if usecols is not None else None
+    filter_cols = {column for column, _, _ in filters or []}
+    # categorical=True reads straight into SCHEMA (label codes, int16 years, float32 values)
+    dtype = READ_SCHEMA if categorical else None
+
+    archive = zipfile.ZipFile(file_path) if member is not None else None
+    handle = archive.open(member) if archive is not None else file_path
+    try:
+        reader = pd.read_csv(
+            handle,
+            usecols=(lambda c: c in wanted or c in filter_cols) if wanted is not None else None,
+            dtype=dtype,
+            chunksize=chunksize,
+            encoding=encoding,
+        )
+        for chunk in reader:
+            rows = len(chunk)
+            if categorical:
+                chunk = drop_blank_years(chunk)
+            yield rows, filter_frame(chunk, filters)
+    finally:
+        if archive is not None:
+            handle.close()
+            archive.close()
+
+
+def read_csv_source(source, filters=None, usecols=GBD_COLUMNS, chunksize=500_000, encoding='utf-8',
+                    categorical=True, budget=None):
+    chunks = []
+    total_rows = 0
+    kept_bytes = 0
+    for rows, chunk in iter_csv_chunks(source, filters, usecols, chunksize, encoding, categorical):
+        total_rows += rows
+        kept_bytes += frame_nbytes(chunk)
+        if budget is not None and kept_bytes > budget:
+            raise MemoryBudgetExceeded(f"{source[0]} needs more than the {budget / 1024 ** 2:.1f} MB memory budget")
+        chunks.append(chunk)
+
+    data = concat_frames(chunks)
+    return data, total_rows
+
+
+@stage('read_csv')
+def read_gbd_csv(file_path, filters=None, usecols=GBD_COLUMNS, chunksize=500_000, encoding='utf-8',
+                 categorical=True, n_jobs=None, budget=None):
+    # raises MemoryBudgetExceeded once the kept rows outgrow the budget (default MEMORY_BUDGET);
+    # read_gbd_partitions is the chunked alternative
+    budget = MEMORY_BUDGET if budget is None else budget
+    sources = resolve_csv_sources(file_path)
+    options = dict(filters=filters, usecols=usecols, chunksize=chunksize, encoding=encoding,
+                   categorical=categorical, budget=budget)
+
+    if len(sources) == 1 or n_jobs == 1:
+        results = [read_csv_source(source, **options) for source in sources]
+    else:
+        n_workers = min(n_jobs or os.cpu_count() or 1, len(sources))
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(partial(read_csv_source, **options), sources))
+
+    total_rows = sum(rows for _, rows in results)
+    if sum(frame_nbytes(frame) for frame, _ in results) > budget:
+        raise MemoryBudgetExceeded(f"{file_path} needs more than the {budget / 1024 ** 2:.1f} MB memory budget")
+    data = concat_frames([frame for frame, _ in results])
+    if categorical:
+        as_categorical(data)
+    print(f"Read {total_rows} rows from {len(sources)} file(s) at {file_path}, kept {len(data)}")
+    set_rows(len(data))
+    return data
+
+
+def read_gbd_partitions(file_path, filters=None, by=('location',), chunksize=500_000, spill_dir=None):
+    # chunked fallback for inputs past the memory budget: one streaming pass spills the
+    # filtered rows into a file per `by` group, then the groups are yielded one at a time.
+    # Per-group statistics stay exact as long as `by` is part of their grouping keys.
+    by = list(by)
+    with tempfile.TemporaryDirectory(prefix='gbd_partitions_', dir=spill_dir) as tmp:
+        spills = {}
+        for source in resolve_csv_sources(file_path):
+            for _, chunk in iter_csv_chunks(source, filters, chunksize=chunksize):
+                for key, part in chunk.groupby(by, observed=True, sort=False):
+                    path = spills.setdefault(key, os.path.join(tmp, f'part{len(spills)}.pkl'))
+                    with open(path, 'ab') as f:
+                        pickle.dump(part, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        print(f"Processing {file_path} in {len(spills)} partition(s) by {', '.join(by)}")
+        for path in spills.values():
+            parts = []
+            with open(path, 'rb') as f:
+                while True:
+                    try:
+                        parts.append(pickle.load(f))
+                    except EOFError:
+                        break
+            os.remove(path)
+            with stage('partition'):
+                frame = concat_frames(parts)
+                set_rows(len(frame))
+            yield frame
+
+
+def ingest_key(file_path, filters=None, usecols=GBD_COLUMNS):
+    return stage_key('ingest', input_digest(file_path), filters, usecols,
+                     source_digest(__file__))
+
+
+def read_gbd_filtered(file_path, filters, data=None, use_cache=True):
+    # ingest stage: a frame or value cube (or a loader for one) from the caller is filtered
+    # in memory, otherwise the export is streamed with the filters pushed down
+    def compute():
+        if data is not None:
+            frame = data() if callable(data) else data
+            with stage('filter'):
+                if isinstance(frame, dict):
+                    from gbd_cube import cube_frame
+                    frame = cube_frame(frame, filters)
+                else:
+                    frame = filter_frame(frame, filters).reset_index(drop=True)
+                set_rows(len(frame))
+            return frame
+        return read_gbd_csv(file_path, filters=filters)
+
+    if not use_cache:
+        return compute()
+    return cached(ingest_key(file_path, filters), compute)
+
+
+def iter_gbd_filtered(file_path, filters, by, data=None, use_cache=True):
+    # the filtered rows as one frame, or one frame per `by` group once they outgrow the memory budget
+    try:
+        frame = read_gbd_filtered(file_path, filters, data, use_cache)
+    except MemoryBudgetExceeded as e:
+        print(f"{e}, switching to chunked processing")
+        yield from read_gbd_partitions(file_path, filters, by)
+        return
+    yield frame
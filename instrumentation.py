@@ -0,0 +1,188 @@
+#Stage instrumentation
+import contextlib
+import csv
+import functools
+import inspect
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+TRACE_SUFFIXES = ('_trace.json', '_trace.csv', '_profile.pstats', '_tracemalloc.txt')
+FIELDS = ['run', 'stage', 'depth', 'start_s', 'wall_s', 'cpu_s', 'peak_rss_mb', 'rss_delta_mb',
+          'peak_traced_mb', 'rows']
+SAMPLE_INTERVAL = 0.01
+
+_traces = []
+
+
+def is_trace_file(name):
+    return name.endswith(TRACE_SUFFIXES)
+
+
+def current_rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        # no /proc: fall back to the process-wide peak (KiB on Linux, bytes on macOS)
+        scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def cpu_seconds():
+    # this process plus its finished worker processes (pools are reaped when they shut down)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _sample_rss(trace, stop):
+    # the open stages' peak RSS, polled while they run
+    while not stop.wait(SAMPLE_INTERVAL):
+        rss = current_rss_mb()
+        for record in list(trace['open']):
+            if rss > record['peak_rss_mb']:
+                record['peak_rss_mb'] = rss
+
+
+@contextlib.contextmanager
+def trace_run(name, output_dir=None):
+    # GBD_PROFILE=1 adds a cProfile dump, GBD_TRACEMALLOC=1 adds Python-heap peaks per stage
+    profile = os.environ.get('GBD_PROFILE', '0') != '0'
+    trace_memory = os.environ.get('GBD_TRACEMALLOC', '0') != '0'
+    trace = {
+        'run': name, 'output_dir': output_dir, 'records': [], 'open': [], 'start': time.perf_counter(),
+        'started': datetime.now(timezone.utc).isoformat(), 'trace_memory': trace_memory,
+    }
+
+    profiler = None
+    if profile:
+        import cProfile
+        profiler = cProfile.Profile()
+    if trace_memory:
+        import tracemalloc
+        tracemalloc.start()
+
+    stop = threading.Event()
+    sampler = threading.Thread(target=_sample_rss, args=(trace, stop), daemon=True)
+    _traces.append(trace)
+    sampler.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        with stage('total'):
+            yield trace
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        stop.set()
+        sampler.join()
+        _traces.remove(trace)
+        if trace['output_dir']:
+            write_trace(trace, profiler)
+        if trace_memory:
+            import tracemalloc
+            tracemalloc.stop()
+
+
+@contextlib.contextmanager
+def stage(name, rows=None):
+    # no-op bookkeeping when no run is being traced
+    trace = _traces[-1] if _traces else None
+    record = {'stage': name, 'rows': rows}
+    if trace is None or threading.current_thread() is not threading.main_thread():
+        yield record
+        return
+
+    rss = current_rss_mb()
+    record.update(run=trace['run'], depth=len(trace['open']), peak_rss_mb=rss, peak_traced_mb=None,
+                  start_s=time.perf_counter() - trace['start'])
+    if trace['trace_memory']:
+        import tracemalloc
+        if trace['open']:
+            parent = trace['open'][-1]
+            parent['peak_traced_mb'] = max(parent['peak_traced_mb'] or 0, tracemalloc.get_traced_memory()[1] / 1024 ** 2)
+        tracemalloc.reset_peak()
+    trace['records'].append(record)
+    trace['open'].append(record)
+
+    start_wall = time.perf_counter()
+    start_cpu = cpu_seconds()
+    try:
+        yield record
+    finally:
+        record['wall_s'] = time.perf_counter() - start_wall
+        record['cpu_s'] = cpu_seconds() - start_cpu
+        end_rss = current_rss_mb()
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], end_rss)
+        record['rss_delta_mb'] = end_rss - rss
+        trace['open'].pop()
+        if trace['open']:
+            parent = trace['open'][-1]
+            parent['peak_rss_mb'] = max(parent['peak_rss_mb'], record['peak_rss_mb'])
+        if trace['trace_memory']:
+            import tracemalloc
+            record['peak_traced_mb'] = max(record['peak_traced_mb'] or 0, tracemalloc.get_traced_memory()[1] / 1024 ** 2)
+            if trace['open']:
+                parent = trace['open'][-1]
+                parent['peak_traced_mb'] = max(parent['peak_traced_mb'] or 0, record['peak_traced_mb'])
+
+
+def set_rows(rows):
+    # row count of the innermost running stage
+    if _traces and _traces[-1]['open']:
+        _traces[-1]['open'][-1]['rows'] = int(rows)
+
+
+def set_trace_output_dir(output_dir):
+    if _traces:
+        _traces[-1]['output_dir'] = output_dir
+
+
+def traced(name, output_dir_arg='output_dir'):
+    # wraps a run_figure* entry point in trace_run, taking the output directory from its arguments
+    def decorate(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            output_dir = signature.bind_partial(*args, **kwargs).arguments.get(output_dir_arg)
+            with trace_run(name, output_dir):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def write_trace(trace, profiler=None):
+    output_dir = trace['output_dir']
+    base = os.path.join(output_dir, trace['run'])
+    records = [{field: round(value, 4) if isinstance(value, float) else value
+                for field, value in ((field, record.get(field)) for field in FIELDS)}
+               for record in sorted(trace['records'], key=lambda r: r['start_s'])]
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+        with open(f'{base}_trace.json', 'w', encoding='utf-8') as f:
+            json.dump({
+                'run': trace['run'],
+                'started': trace['started'],
+                'pid': os.getpid(),
+                'python': sys.version.split()[0],
+                'stages': records,
+            }, f, indent=2)
+        with open(f'{base}_trace.csv', 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        if profiler is not None:
+            profiler.dump_stats(f'{base}_profile.pstats')
+        if trace['trace_memory']:
+            import tracemalloc
+            top = tracemalloc.take_snapshot().statistics('lineno')[:25]
+            with open(f'{base}_tracemalloc.txt', 'w', encoding='utf-8') as f:
+                f.write('\n'.join(str(line) for line in top) + '\n')
+        print(f"Stage trace saved: {base}_trace.json")
+    except OSError as e:
+        print(f"Stage trace not written: {e}")
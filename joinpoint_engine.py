@@ -0,0 +1,495 @@
+#Joinpoint engine
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import numpy as np
+import pandas as pd
+from scipy import stats
+
+SERIES_KEYS = ['location', 'sex', 'age', 'cause', 'measure']
+# exhaustive joinpoint search while there are at most this many placements of the first k-1 joinpoints
+GRID_LIMIT = 5000
+
+
+def t_critical(df, alpha=0.05):
+    df = np.maximum(np.asarray(df, dtype=float), 1)
+    return stats.t.ppf(1 - alpha / 2, df)
+
+
+def t_pvalue(t_stat, df):
+    t_stat = np.abs(np.asarray(t_stat, dtype=float))
+    df = np.maximum(np.asarray(df, dtype=float), 1)
+    return 2 * stats.t.sf(t_stat, df)
+
+
+def build_series_matrix(df, keys=SERIES_KEYS, year_col='year', value_col='val'):
+    keys = [k for k in keys if k in df.columns]
+    wide = df.pivot_table(index=keys, columns=year_col, values=value_col, aggfunc='mean')
+    wide = wide.sort_index(axis=1)
+    years = wide.columns.to_numpy(dtype=float)
+    values = wide.to_numpy(dtype=float)
+    return wide.index, years, values
+
+
+def _log_values(values):
+    values = np.asarray(values, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        y = np.where(values > 0, np.log(values), np.nan)
+    w = np.isfinite(y).astype(float)
+    return np.nan_to_num(y), w
+
+
+def _prefix(a):
+    return np.concatenate([np.zeros((a.shape[0], 1)), np.cumsum(a, axis=1)], axis=1)
+
+
+def _segment_costs(x, y, w, min_segment):
+    # cost[s, i, j] = SSE of a straight line through points i..j-1 of series s
+    xw = w * x[None, :]
+    sums = [_prefix(a) for a in (w, xw, xw * x[None, :], w * y, xw * y, w * y * y)]
+    n, sx, sxx, sy, sxy, syy = [s[:, None, :] - s[:, :, None] for s in sums]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sxx_c = sxx - sx ** 2 / n
+        sxy_c = sxy - sx * sy / n
+        syy_c = syy - sy ** 2 / n
+        cost = np.maximum(syy_c - sxy_c ** 2 / sxx_c, 0)
+
+    T = x.shape[0]
+    idx = np.arange(T + 1)
+    too_short = (idx[None, :] - idx[:, None]) < min_segment
+    cost[(n < 2) | ~(sxx_c > 1e-12) | too_short[None, :, :]] = np.inf
+    return cost
+
+
+def _dp_boundaries(cost, max_segments):
+    # best partition of 0..T into m segments for every m <= max_segments
+    n_series, T1, _ = cost.shape
+    T = T1 - 1
+    rows = np.arange(n_series)
+    F = cost[:, 0, :].copy()
+    back = []
+    results = [(F[:, T].copy(), np.tile([0, T], (n_series, 1)))]
+
+    for m in range(1, max_segments):
+        cand = F[:, :, None] + cost
+        arg = np.argmin(cand, axis=1)
+        F = np.take_along_axis(cand, arg[:, None, :], axis=1)[:, 0, :]
+        back.append(arg)
+
+        bounds = np.empty((n_series, m + 2), dtype=int)
+        bounds[:, 0] = 0
+        bounds[:, -1] = T
+        j = np.full(n_series, T)
+        for step in range(m, 0, -1):
+            j = back[step - 1][rows, j]
+            bounds[:, step] = j
+        results.append((F[:, T].copy(), bounds))
+
+    return results
+
+
+def _design(x, taus):
+    # intercept, slope and one hinge column per joinpoint
+    n_series, k = taus.shape
+    X = np.empty((n_series, len(x), k + 2))
+    X[:, :, 0] = 1.0
+    X[:, :, 1] = x[None, :]
+    if k:
+        X[:, :, 2:] = np.maximum(x[None, :, None] - taus[:, None, :], 0)
+    return X
+
+
+def _hinge_fit(x, y, w, taus):
+    X = _design(x, taus)
+    Xw = X * w[:, :, None]
+    XtX = np.einsum('stp,stq->spq', Xw, X)
+    Xty = np.einsum('stp,st->sp', Xw, y)
+    XtX_inv = np.linalg.pinv(XtX)
+    beta = np.einsum('spq,sq->sp', XtX_inv, Xty)
+
+    resid = y - np.einsum('stp,sp->st', X, beta)
+    sse = np.sum(w * resid ** 2, axis=1)
+    return beta, XtX_inv, sse
+
+
+def _inverse(G):
+    # batched inverse of the small normal matrices, with the pseudo-inverse when any is singular
+    try:
+        return np.linalg.inv(G)
+    except np.linalg.LinAlgError:
+        return np.linalg.pinv(G)
+
+
+def _added_hinge_sse(x, y, w, Z, ginv=None):
+    # SSE after adding a hinge at each data year to the columns Z, for all years at once: only the part
+    # of the new column h that Z does not explain can lower the SSE (Frisch-Waugh), by
+    # (r'Wh)^2 / (h'Wh - h'WZ G^-1 Z'Wh) with r the residual on Z and G = Z'WZ
+    H = np.maximum(x[:, None] - x[None, :], 0)
+    Zw = Z * w[:, :, None]
+    if ginv is None:
+        ginv = _inverse(np.einsum('stp,stq->spq', Zw, Z))
+    resid = y - np.einsum('stp,sp->st', Z, np.einsum('spq,sq->sp', ginv, np.einsum('stp,st->sp', Zw, y)))
+    ZtWH = np.matmul(Zw.transpose(0, 2, 1), H)
+    hh = w @ H ** 2
+    num = (w * resid) @ H
+    den = hh - np.einsum('sqc,sqc->sc', ZtWH, np.matmul(ginv, ZtWH))
+    base = np.sum(w * resid ** 2, axis=1)
+    # a hinge (almost) spanned by Z adds no new model
+    informative = den > 1e-9 * hh
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(informative, np.maximum(base[:, None] - num ** 2 / den, 0), np.inf)
+
+
+def _allowed(bounds, T, min_segment):
+    # joinpoints at least min_segment points from each other and from both ends
+    edges = np.concatenate([np.zeros(bounds.shape[:-1] + (1,), dtype=int), bounds,
+                            np.full(bounds.shape[:-1] + (1,), T)], axis=-1)
+    return (np.diff(edges, axis=-1) >= min_segment).all(axis=-1)
+
+
+def _refine_joinpoints(x, y, w, bounds, sse, min_segment, max_sweeps=20):
+    # descent on the continuous hinge SSE: each joinpoint in turn is dropped and put back at the data year
+    # that fits best with the others fixed, until no joinpoint moves
+    n_series, k = bounds.shape
+    T = len(x)
+    rows = np.arange(n_series)
+    for _ in range(max_sweeps):
+        moved = False
+        for j in range(k):
+            others = np.delete(bounds, j, axis=1)
+            cand = np.concatenate([np.repeat(others[:, None, :], T, axis=1),
+                                   np.broadcast_to(np.arange(T)[None, :, None], (n_series, T, 1))], axis=2)
+            cand = np.sort(cand, axis=2)
+            cand_sse = np.where(_allowed(cand, T, min_segment),
+                                _added_hinge_sse(x, y, w, _design(x, x[others])), np.inf)
+            best = np.argmin(cand_sse, axis=1)
+            better = cand_sse[rows, best] < sse * (1 - 1e-10)
+            if better.any():
+                bounds[better] = cand[rows[better], best[better]]
+                sse = np.where(better, cand_sse[rows, best], sse)
+                moved = True
+        if not moved:
+            break
+    return bounds
+
+
+def _extend_joinpoints(x, y, w, bounds, min_segment):
+    # best k+1 model that keeps the k joinpoints and adds one; its SSE can never exceed the k model's
+    n_series, k = bounds.shape
+    T = len(x)
+    cand = np.concatenate([np.repeat(bounds[:, None, :], T, axis=1),
+                           np.broadcast_to(np.arange(T)[None, :, None], (n_series, T, 1))], axis=2)
+    cand = np.sort(cand, axis=2)
+    cand_sse = np.where(_allowed(cand, T, min_segment), _added_hinge_sse(x, y, w, _design(x, x[bounds])), np.inf)
+    best = np.argmin(cand_sse, axis=1)
+    rows = np.arange(n_series)
+    return cand[rows, best], cand_sse[rows, best]
+
+
+@lru_cache(maxsize=None)
+def _grid_heads(T, k, min_segment, limit=GRID_LIMIT):
+    # allowed positions of the first k-1 joinpoints, or None when there are more than `limit`
+    heads = []
+    for head in itertools.combinations(range(min_segment, T - 2 * min_segment + 1), k - 1):
+        if all(b - a >= min_segment for a, b in zip(head, head[1:])):
+            heads.append(head)
+            if len(heads) > limit:
+                return None
+    return tuple(heads)
+
+
+def _grid_joinpoints(x, y, w, heads, min_segment, block_size=4_000_000):
+    # Exhaustive grid search: every placement of the first k-1 joinpoints, with the last one scanned over all
+    # years. Series with the same missing years share the design's Z'WZ and Z'WH, so per pattern only the
+    # y terms vary by series and all placements are scored together (in blocks of about block_size cells).
+    n_series, T = y.shape
+    heads = np.array(heads, dtype=int).reshape(len(heads), -1)
+    n_heads, k = heads.shape[0], heads.shape[1] + 1
+    H = np.maximum(x[:, None] - x[None, :], 0)
+    cand = np.concatenate([np.repeat(heads[:, None, :], T, axis=1),
+                           np.broadcast_to(np.arange(T)[None, :, None], (n_heads, T, 1))], axis=2)
+    allowed = _allowed(cand, T, min_segment)
+    Z = _design(x, x[heads])
+
+    best = np.zeros((n_series, k), dtype=int)
+    patterns, pattern_of = np.unique(w, axis=0, return_inverse=True)
+    for p, pattern in enumerate(patterns):
+        members = np.where(pattern_of.ravel() == p)[0]
+        yp = y[members] * pattern[None, :]
+        Zw = Z * pattern[None, :, None]
+        ginv = _inverse(np.einsum('htp,htq->hpq', Zw, Z))
+        A = np.einsum('htq,tc->hqc', Zw, H)
+        hh = pattern @ H ** 2
+        den = hh[None, :] - np.einsum('hqc,hqc->hc', A, np.matmul(ginv, A))
+        # a hinge (almost) spanned by the other columns adds no new model
+        usable = allowed & (den > 1e-9 * hh[None, :])
+        yy = np.sum(yp * y[members], axis=1)
+        yH = yp @ H
+
+        best_sse = np.full(len(members), np.inf)
+        step = max(1, block_size // (len(members) * T))
+        for h0 in range(0, n_heads, step):
+            hs = slice(h0, h0 + step)
+            head, last = np.nonzero(usable[hs])
+            if not len(head):
+                continue
+            zy = np.matmul(yp, Zw[hs])
+            gz = np.matmul(zy, ginv[hs])
+            base = yy[None, :] - np.sum(zy * gz, axis=2)
+            num = yH[:, last].T - np.matmul(gz, A[hs])[head, :, last]
+            sse = np.maximum(base[head] - num ** 2 / den[h0 + head, last][:, None], 0)
+            arg = np.argmin(sse, axis=0)
+            block_sse = sse[arg, np.arange(len(members))]
+            better = block_sse < best_sse
+            best[members[better]] = cand[h0 + head[arg[better]], last[arg[better]]]
+            best_sse = np.where(better, block_sse, best_sse)
+    return best
+
+
+def fit_joinpoint_models(years, values, max_joinpoints=5, min_segment=3, chunk_size=1024, ks=None):
+    # Joinpoints are placed on data years by minimizing the SSE of the connected (hinge) model: by grid
+    # search while that stays small, beyond it by descent from the disconnected-segment DP partition and
+    # from the k-1 model plus one joinpoint, whichever ends lower. Either way the SSE never rises with k.
+    years = np.asarray(years, dtype=float)
+    x = years - years[0]
+    T = len(x)
+    y_all, w_all = _log_values(values)
+    n_series = y_all.shape[0]
+    grids = [None] + [_grid_heads(T, k, min_segment) for k in range(1, max_joinpoints + 1)]
+    # only the requested models, plus the lower ones a descent is seeded from
+    needed = set(range(max_joinpoints + 1) if ks is None else ks)
+    for k in range(max_joinpoints, 0, -1):
+        if k in needed and not grids[k]:
+            needed.add(k - 1)
+
+    fits = []
+    for k in range(max_joinpoints + 1):
+        fits.append({
+            'k': k,
+            'sse': np.full(n_series, np.inf),
+            'joinpoints': np.full((n_series, k), np.nan),
+            'beta': np.full((n_series, k + 2), np.nan),
+            'xtx_inv': np.full((n_series, k + 2, k + 2), np.nan),
+        })
+
+    for start in range(0, n_series, chunk_size):
+        sl = slice(start, start + chunk_size)
+        y, w = y_all[sl], w_all[sl]
+        cost = _segment_costs(x, y, w, min_segment)
+        rows = np.arange(start, min(start + chunk_size, n_series))
+        previous = None
+
+        for k, (total, bounds) in enumerate(_dp_boundaries(cost, max_joinpoints + 1)):
+            feasible = np.isfinite(total)
+            if not feasible.any():
+                break
+            if k not in needed:
+                continue
+            yf, wf = y[feasible], w[feasible]
+            bounds = np.minimum(bounds[feasible, 1:-1], T - 1)
+            if k and grids[k]:
+                bounds = _grid_joinpoints(x, yf, wf, grids[k], min_segment)
+            elif k:
+                # descend from both starting points and keep the better end point
+                extended, extended_sse = _extend_joinpoints(x, yf, wf, previous[feasible], min_segment)
+                extended = _refine_joinpoints(x, yf, wf, extended, extended_sse, min_segment)
+                bounds = _refine_joinpoints(x, yf, wf, bounds, _hinge_fit(x, yf, wf, x[bounds])[2], min_segment)
+                use = _hinge_fit(x, yf, wf, x[extended])[2] <= _hinge_fit(x, yf, wf, x[bounds])[2]
+                bounds[use] = extended[use]
+            taus = x[bounds]
+            beta, xtx_inv, sse = _hinge_fit(x, yf, wf, taus)
+
+            fit = fits[k]
+            fit['sse'][rows[feasible]] = sse
+            fit['joinpoints'][rows[feasible]] = taus + years[0]
+            fit['beta'][rows[feasible]] = beta
+            fit['xtx_inv'][rows[feasible]] = xtx_inv
+            previous = np.zeros((len(total), k), dtype=int)
+            previous[feasible] = bounds
+
+    nobs = w_all.sum(axis=1)
+    for fit in fits:
+        fit['nobs'] = nobs
+    return fits
+
+
+def select_bic(fits):
+    # NCI Joinpoint BIC: ln(SSE/n) + 2(k+1)/n * ln(n)
+    nobs = fits[0]['nobs']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bic = np.stack([
+            np.log(f['sse'] / nobs) + 2 * (f['k'] + 1) / nobs * np.log(nobs)
+            for f in fits
+        ], axis=1)
+    bic[~np.isfinite(bic)] = np.inf
+    return np.argmin(bic, axis=1)
+
+
+def _fitted_log(years, fit, row):
+    x = years - years[0]
+    k = fit['k']
+    X = np.empty((len(x), k + 2))
+    X[:, 0] = 1.0
+    X[:, 1] = x
+    if k:
+        X[:, 2:] = np.maximum(x[:, None] - (fit['joinpoints'][row] - years[0])[None, :], 0)
+    return X @ fit['beta'][row]
+
+
+def _sequential_permutation_test(task):
+    # Kim et al. (2000): test k0 vs k1 joinpoints, moving k0 up on rejection and k1 down otherwise.
+    # The observed and permuted statistics both come from the grid-searched continuous fits, whose SSEs
+    # are nested in k, so (SSE_k0 - SSE_k1) / SSE_k1 is the nested-model statistic the test assumes.
+    years, values, max_joinpoints, min_segment, n_permutations, alpha, seed, batch_size, z = task
+    years = np.asarray(years, dtype=float)
+    values = np.asarray(values, dtype=float)[None, :]
+    fits = fit_joinpoint_models(years, values, max_joinpoints, min_segment)
+    sse = np.array([f['sse'][0] for f in fits])
+    feasible = np.where(np.isfinite(sse))[0]
+    if len(feasible) == 0:
+        return 0
+
+    y, w = _log_values(values)
+    valid = w[0] > 0
+    rng = np.random.default_rng(seed)
+    k0, k1 = 0, int(feasible.max())
+
+    while k0 < k1:
+        observed = (sse[k0] - sse[k1]) / sse[k1]
+        fitted = _fitted_log(years, fits[k0], 0)
+        resid = (y[0] - fitted)[valid]
+        alpha_adj = alpha / (k1 - k0)
+
+        exceed = 0
+        done = 0
+        p_value = 1.0
+        while done < n_permutations:
+            b = min(batch_size, n_permutations - done)
+            y_perm = np.full((b, len(years)), np.nan)
+            y_perm[:, valid] = fitted[valid] + rng.permuted(np.tile(resid, (b, 1)), axis=1)
+            perm_fits = fit_joinpoint_models(years, np.exp(y_perm), k1, min_segment, ks=(k0, k1))
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stat = (perm_fits[k0]['sse'] - perm_fits[k1]['sse']) / perm_fits[k1]['sse']
+            exceed += int(np.sum(stat >= observed * (1 - 1e-9)))
+            done += b
+
+            # stop once the Monte Carlo interval for p no longer straddles alpha_adj
+            p_value = (exceed + 1) / (done + 1)
+            margin = z * np.sqrt(p_value * (1 - p_value) / done)
+            if p_value - margin > alpha_adj or p_value + margin < alpha_adj:
+                break
+
+        if p_value < alpha_adj:
+            k0 += 1
+        else:
+            k1 -= 1
+
+    return k0
+
+
+def select_permutation(years, values, max_joinpoints=5, min_segment=3, n_permutations=4499,
+                       alpha=0.05, seed=0, n_jobs=None, batch_size=250, z=2.576):
+    values = np.asarray(values, dtype=float)
+    seeds = np.random.SeedSequence(seed).spawn(values.shape[0])
+    tasks = [
+        (years, values[i], max_joinpoints, min_segment, n_permutations, alpha, seeds[i], batch_size, z)
+        for i in range(values.shape[0])
+    ]
+
+    n_jobs = max(1, n_jobs or os.cpu_count() or 1)
+    if n_jobs == 1 or len(tasks) <= 1:
+        return np.array([_sequential_permutation_test(t) for t in tasks], dtype=int)
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        chunksize = max(1, len(tasks) // (4 * n_jobs))
+        return np.array(list(pool.map(_sequential_permutation_test, tasks, chunksize=chunksize)), dtype=int)
+
+
+def summarize_fits(index, years, values, fits, selected_k, alpha=0.05):
+    years = np.asarray(years, dtype=float)
+    _, w = _log_values(values)
+    key_frame = index.to_frame(index=False)
+
+    apc_rows = []
+    aapc_rows = []
+    for k, fit in enumerate(fits):
+        rows = np.where((selected_k == k) & np.isfinite(fit['sse']))[0]
+        if len(rows) == 0:
+            continue
+
+        # one residual df for the variance and the t quantiles: n minus the k + 2 hinge-model coefficients
+        df = np.maximum(fit['nobs'][rows] - (k + 2), 1)
+        sigma2 = fit['sse'][rows] / df
+        cov = fit['xtx_inv'][rows] * sigma2[:, None, None]
+        t_crit = t_critical(df, alpha)
+
+        # segment slope m = b1 + sum of the first m hinge coefficients
+        L = np.zeros((k + 1, k + 2))
+        L[:, 1] = 1.0
+        for m in range(1, k + 1):
+            L[m:, 1 + m] = 1.0
+        slopes = fit['beta'][rows] @ L.T
+        slope_se = np.sqrt(np.maximum(np.einsum('mp,spq,mq->sm', L, cov, L), 0))
+
+        first_year = np.array([years[w[r] > 0][0] for r in rows])
+        last_year = np.array([years[w[r] > 0][-1] for r in rows])
+        edges = np.column_stack([first_year, fit['joinpoints'][rows], last_year])
+        weights = np.diff(edges, axis=1) / (last_year - first_year)[:, None]
+
+        aapc_L = np.einsum('sm,mp->sp', weights, L)
+        aapc_slope = np.einsum('sp,sp->s', aapc_L, fit['beta'][rows])
+        aapc_se = np.sqrt(np.maximum(np.einsum('sp,spq,sq->s', aapc_L, cov, aapc_L), 0))
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            seg_t = slopes / slope_se
+            aapc_t = aapc_slope / aapc_se
+        seg_p = t_pvalue(seg_t, df[:, None])
+        aapc_p = t_pvalue(aapc_t, df)
+
+        keys = key_frame.iloc[rows].reset_index(drop=True)
+        for m in range(k + 1):
+            seg = keys.copy()
+            seg['Model'] = k
+            seg['Segment'] = m
+            seg['Segment Start'] = edges[:, m].astype(int)
+            seg['Segment End'] = edges[:, m + 1].astype(int)
+            seg['APC'] = (np.exp(slopes[:, m]) - 1) * 100
+            seg['APC C.I. Low'] = (np.exp(slopes[:, m] - t_crit * slope_se[:, m]) - 1) * 100
+            seg['APC C.I. High'] = (np.exp(slopes[:, m] + t_crit * slope_se[:, m]) - 1) * 100
+            seg['Test Statistic'] = seg_t[:, m]
+            seg['P-Value'] = seg_p[:, m]
+            apc_rows.append(seg)
+
+        total = keys.copy()
+        total['Model'] = k
+        total['Start Obs'] = first_year.astype(int)
+        total['End Obs'] = last_year.astype(int)
+        total['AAPC'] = (np.exp(aapc_slope) - 1) * 100
+        total['AAPC C.I. Low'] = (np.exp(aapc_slope - t_crit * aapc_se) - 1) * 100
+        total['AAPC C.I. High'] = (np.exp(aapc_slope + t_crit * aapc_se) - 1) * 100
+        total['Test Statistic'] = aapc_t
+        total['P-Value'] = aapc_p
+        aapc_rows.append(total)
+
+    key_cols = list(key_frame.columns)
+    apc_df = pd.concat(apc_rows, ignore_index=True) if apc_rows else pd.DataFrame(columns=key_cols)
+    aapc_df = pd.concat(aapc_rows, ignore_index=True) if aapc_rows else pd.DataFrame(columns=key_cols)
+    if len(apc_df):
+        apc_df = apc_df.sort_values(key_cols + ['Segment']).reset_index(drop=True)
+        aapc_df = aapc_df.sort_values(key_cols).reset_index(drop=True)
+    return apc_df, aapc_df
+
+
+def joinpoint_regression(df, max_joinpoints=5, keys=SERIES_KEYS, year_col='year', value_col='val',
+                         min_segment=3, alpha=0.05, chunk_size=1024, method='permutation',
+                         n_permutations=4499, seed=0, n_jobs=None):
+    index, years, values = build_series_matrix(df, keys, year_col, value_col)
+    fits = fit_joinpoint_models(years, values, max_joinpoints, min_segment, chunk_size)
+    if method == 'permutation':
+        selected_k = select_permutation(years, values, max_joinpoints, min_segment, n_permutations,
+                                        alpha, seed, n_jobs)
+    else:
+        selected_k = select_bic(fits)
+    return summarize_fits(index, years, values, fits, selected_k, alpha)
@@ -1,40 +1,100 @@
-
-
+import argparse
 import os
 import sys
-from figure1_joinpoint import run_figure1
-from figure2_aapc import run_figure2
-from figure3_percentage import run_figure3
+import time
+import stage_cache
+from figure_loader import call_figure_function, figure_source_files
+from instrumentation import is_trace_file
 
-def main():
-    """main function: running all analyses"""
-    print("=" * 60)
-    print("GBD data analysis tool")
-    print("=" * 60)
-    
-    output_dir = '/Users/patricia-yj/Desktop/GBD'
-    
-    os.makedirs(output_dir, exist_ok=True)
-    
-    print(f"\noutput directory: {output_dir}\n")
-    
+# pandas, matplotlib and the figure scripts are imported only once a job needs them
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+DEFAULT_OUTPUT_DIR = os.path.expanduser('~/Desktop/GBD')
+FIGURE_NAMES = {
+    1: 'Figure 1 - Joinpoint regression analysis',
+    2: 'Figure 2 - AAPC comparison analysis',
+    3: 'Figure 3 - percentage stacked chart',
+}
+CSV_FIGURES = (2, 3)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='GBD data analysis tool')
+    parser.add_argument('--figure1', help='Figure 1 data file (xlsx)')
+    parser.add_argument('--figure2', help='Figure 2 data file (csv, zip or directory)')
+    parser.add_argument('--figure3', help='Figure 3 data file (csv, zip or directory)')
+    parser.add_argument('--figure1-batch', action='store_true',
+                        help='render Figure 1 for every location/sex/age group in the workbook')
+    parser.add_argument('--figure2-draws', help='GBD draw file (draw_0..draw_999) for Figure 2 uncertainty intervals')
+    parser.add_argument('--job-file', help='TOML or YAML file listing the jobs to run')
+    parser.add_argument('--output-dir', default=None, help='output directory')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every stage')
+    parser.add_argument('--profile', action='store_true', help='write a cProfile dump next to each stage trace')
+    parser.add_argument('--trace-memory', action='store_true', help='record Python heap peaks per stage (slower)')
+    return parser.parse_args(argv)
+
+
+def load_job_file(path):
+    # top-level output_dir / n_jobs, plus a [[jobs]] list of {figure, input, output_dir, ...options}
+    if path.lower().endswith(('.yaml', '.yml')):
+        try:
+            import yaml
+        except ImportError:
+            raise ImportError("PyYAML is required for YAML job files")
+        with open(path, encoding='utf-8') as f:
+            config = yaml.safe_load(f) or {}
+    else:
+        try:
+            import tomllib
+        except ImportError:
+            raise ImportError("TOML job files need Python 3.11+")
+        with open(path, 'rb') as f:
+            config = tomllib.load(f)
+
+    output_dir = os.path.expanduser(config.get('output_dir', DEFAULT_OUTPUT_DIR))
+    jobs = []
+    for entry in config.get('jobs', []):
+        job = dict(entry)
+        job['figure'] = int(job['figure'])
+        job['input'] = os.path.expanduser(job['input'])
+        job['output_dir'] = os.path.expanduser(job.get('output_dir', output_dir))
+        jobs.append(job)
+    return jobs, config.get('n_jobs')
+
+
+def jobs_from_args(args):
+    output_dir = args.output_dir or DEFAULT_OUTPUT_DIR
+    inputs = {1: args.figure1, 2: args.figure2, 3: args.figure3}
+    jobs = [{'figure': figure, 'input': path, 'output_dir': output_dir}
+            for figure, path in inputs.items() if path]
+    for job in jobs:
+        if job['figure'] == 1 and args.figure1_batch:
+            job['batch'] = True
+        if job['figure'] == 2 and args.figure2_draws:
+            job['draws_path'] = args.figure2_draws
+    return jobs
+
+
+def prompt_jobs():
+    output_dir = DEFAULT_OUTPUT_DIR
     print("provide the data file path:")
     print("  Figure 1 needs .xlsx file (contains 3 sheets)")
     print("  Figure 2 needs .csv file")
     print("  Figure 3 needs .csv file")
-    
+
     figure1_data = input("\nFigure 1 data file path (xlsx): ").strip()
     if not figure1_data:
-        figure1_data = "/path/to/your/data.xlsx" 
-    
+        figure1_data = "/path/to/your/data.xlsx"
+
     figure2_data = input("Figure 2 data file path (csv): ").strip()
     if not figure2_data:
-        figure2_data = "/path/to/your/data.csv"  
+        figure2_data = "/path/to/your/data.csv"
 
     figure3_data = input("Figure 3 data file path (csv): ").strip()
     if not figure3_data:
-        figure3_data = "/path/to/your/data.csv"  
-    
+        figure3_data = "/path/to/your/data.csv"
+
 
     print("\n" + "=" * 60)
     print("select the analysis to run:")
@@ -43,60 +103,182 @@ def main():
     print("  3. Figure 3 - percentage stacked chart")
     print("  4. running all analyses")
     choice = input("\nenter the option (1-4): ").strip()
-    
+
+    inputs = {1: figure1_data, 2: figure2_data, 3: figure3_data}
+    return [{'figure': figure, 'input': inputs[figure], 'output_dir': output_dir}
+            for figure in (1, 2, 3) if choice in (str(figure), '4')]
+
+
+def share_inputs(jobs, share_dir):
+    # inputs used by several figures are converted once into a memory-mapped value cube
+    # (see gbd_cube) that every worker maps read-only and slices by label index.
+    # The cube lives in the stage cache, so later runs reuse it without a parse.
+    from gbd_cube import cube_for, cube_stem
+    from gbd_io import read_workbook
+
+    usage = {}
+    for job in jobs:
+        if os.path.exists(job['input']):
+            usage.setdefault((job['figure'] in CSV_FIGURES, job['input']), []).append(job)
+
+    shared = {}
+    for (is_csv, path), users in usage.items():
+        if len(users) < 2:
+            continue
+        if not is_csv:
+            # warms the workbook's Feather cache so the Figure 1 workers skip the xlsx parse
+            if stage_cache.ENABLED:
+                read_workbook(path, ['Sheet1', 'Sheet2', 'Sheet3'])
+            continue
+
+        if stage_cache.ENABLED:
+            stem = cube_stem(path)
+        else:
+            stem = os.path.join(share_dir, f'dataset{len(shared)}')
+        print(f"Preparing shared dataset: {path}")
+        cube_for(path, stem)
+        shared[path] = stem
+    if shared and stage_cache.ENABLED:
+        stage_cache.evict()
+    return shared
+
+
+def load_shared(shared):
+    from gbd_cube import open_cube
+    return open_cube(shared)
+
+
+def output_key(job):
+    # rendered outputs depend on the input content, the job options and every source file of the figure
+    options = {key: value for key, value in job.items() if key not in ('input', 'output_dir')}
+    if job.get('draws_path'):
+        options['draws_path'] = stage_cache.input_digest(job['draws_path'])
+    return stage_cache.stage_key('outputs', options, stage_cache.input_digest(job['input']),
+                                 stage_cache.source_digest(*figure_source_files(job['figure'])))
+
+
+def job_outputs(job, started):
+    prefix = f"Figure{job['figure']}_"
+    return [entry.path for entry in os.scandir(job['output_dir'])
+            if entry.is_file() and entry.name.startswith(prefix) and not is_trace_file(entry.name)
+            and entry.stat().st_mtime >= started]
+
+
+def run_job(job, shared=None, cache_key=None):
+    started = time.time() - 1
+    figure = job['figure']
+    options = {key: value for key, value in job.items() if key not in ('figure', 'input', 'output_dir')}
+    if figure == 1:
+        # batch = true renders every location/sex/age group instead of the single Global panel figure
+        func_name = 'run_figure1_batch' if options.pop('batch', False) else 'run_figure1'
+        result = call_figure_function(1, func_name, job['input'], output_dir=job['output_dir'], **options)
+    else:
+        data = (lambda: load_shared(shared)) if shared is not None else None
+        result = call_figure_function(figure, f'run_figure{figure}', job['input'], job['output_dir'],
+                                      data=data, **options)
+    if result and cache_key:
+        stage_cache.store_outputs(cache_key, job_outputs(job, started))
+    return result
+
+
+def run_jobs(jobs, n_jobs=None, restore=True):
+    import tempfile
+    from concurrent.futures import ProcessPoolExecutor
+
     results = []
-    
+    runnable = []
+    for job in jobs:
+        os.makedirs(job['output_dir'], exist_ok=True)
+        if not os.path.exists(job['input']):
+            print(f"error: file not found - {job['input']}")
+            results.append((job, False))
+            continue
+        cache_key = output_key(job)
+        restored = stage_cache.restore_outputs(cache_key, job['output_dir']) if restore else None
+        if restored is not None:
+            print(f"{FIGURE_NAMES[job['figure']]}: inputs unchanged, restored {len(restored)} cached file(s)")
+            results.append((job, True))
+        else:
+            runnable.append((job, cache_key))
+    if not runnable:
+        return results
+
+    n_workers = max(1, min(n_jobs or os.cpu_count() or 1, len(runnable)))
+    with tempfile.TemporaryDirectory(prefix='gbd_shared_') as share_dir:
+        shared = share_inputs([job for job, _ in runnable], share_dir)
+
+        if n_workers == 1:
+            for i, (job, cache_key) in enumerate(runnable, 1):
+                print(f"\n[{i}/{len(runnable)}] running {FIGURE_NAMES[job['figure']]}...")
+                try:
+                    results.append((job, run_job(job, shared.get(job['input']), cache_key)))
+                except Exception as e:
+                    print(f"error in {FIGURE_NAMES[job['figure']]}: {e}")
+                    results.append((job, False))
+            return results
+
+        print(f"\nrunning {len(runnable)} job(s) on {n_workers} worker(s)...")
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            futures = [(job, pool.submit(run_job, job, shared.get(job['input']), cache_key))
+                       for job, cache_key in runnable]
+            for job, future in futures:
+                try:
+                    results.append((job, future.result()))
+                except Exception as e:
+                    print(f"error in {FIGURE_NAMES[job['figure']]}: {e}")
+                    results.append((job, False))
+    return results
+
+
+def main(argv=None):
+    """main function: running all analyses"""
+    args = parse_args(argv)
+    if args.no_cache:
+        os.environ['GBD_CACHE'] = '0'
+        stage_cache.ENABLED = False
+    if args.profile:
+        os.environ['GBD_PROFILE'] = '1'
+    if args.trace_memory:
+        os.environ['GBD_TRACEMALLOC'] = '1'
+
+    print("=" * 60)
+    print("GBD data analysis tool")
+    print("=" * 60)
+
+    n_jobs = args.jobs
+    if args.job_file:
+        jobs, file_jobs = load_job_file(args.job_file)
+        n_jobs = n_jobs or file_jobs
+    elif args.figure1 or args.figure2 or args.figure3:
+        jobs = jobs_from_args(args)
+    else:
+        jobs = prompt_jobs()
+
+    output_dirs = sorted({job['output_dir'] for job in jobs})
+    print(f"\noutput directory: {', '.join(output_dirs)}\n")
+
     print("\n" + "=" * 60)
     print("starting analysis...")
     print("=" * 60)
-    
-    try:
-        if choice in ['1', '4']:
-            print("\n[1/3] running Figure 1 - Joinpoint regression analysis...")
-            if os.path.exists(figure1_data):
-                result = run_figure1(figure1_data)
-                results.append(("Figure 1", result))
-            else:
-                print(f"error: file not found - {figure1_data}")
-                results.append(("Figure 1", False))
-        
-        if choice in ['2', '4']:
-            print("\n[2/3] running Figure 2 - AAPC comparison analysis...")
-            if os.path.exists(figure2_data):
-                result = run_figure2(figure2_data, output_dir)
-                results.append(("Figure 2", result))
-            else:
-                print(f"error: file not found - {figure2_data}")
-                results.append(("Figure 2", False))
-        
-        if choice in ['3', '4']:
-            print("\n[3/3] running Figure 3 - percentage stacked chart...")
-            if os.path.exists(figure3_data):
-                result = run_figure3(figure3_data, output_dir)
-                results.append(("Figure 3", result))
-            else:
-                print(f"error: file not found - {figure3_data}")
-                results.append(("Figure 3", False))
-        
-    except Exception as e:
-        print(f"\n错误: {e}")
-        import traceback
-        traceback.print_exc()
-    
+
+    # a profiled run has to render, so finished outputs are not restored from the cache
+    results = run_jobs(jobs, n_jobs, restore=not (args.profile or args.trace_memory))
+
     print("\n" + "=" * 60)
     print("analysis completed!")
     print("=" * 60)
     print("\nresult summary:")
-    for name, success in results:
+    for job, success in results:
         status = "✓ success" if success else "✗ failed"
-        print(f"  {name}: {status}")
-    
-    print(f"\nall output files saved in: {output_dir}")
+        print(f"  Figure {job['figure']} ({job['input']}): {status}")
+
+    print(f"\nall output files saved in: {', '.join(output_dirs)}")
     print("\n" + "=" * 60)
+    return all(success for _, success in results)
 
 if __name__ == "__main__":
     try:
-        main()
+        sys.exit(0 if main() else 1)
     except KeyboardInterrupt:
         print("\n\ninterupted by user")
         sys.exit(0)
@@ -104,4 +286,4 @@ if __name__ == "__main__":
         print(f"\nerror: {e}")
         import traceback
         traceback.print_exc()
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
@@ -0,0 +1,263 @@
+#Trend projection
+import argparse
+import os
+import matplotlib.pyplot as plt
+import matplotlib.gridspec as gridspec
+import matplotlib.patches as mpatches
+import pandas as pd
+import aapc_engine
+import joinpoint_engine
+import projection_engine
+from aapc_engine import grouped_log_linear
+from apc_engine import INTERVAL, component_ages
+from figure_export import export_figure
+from figure_loader import load_figure
+from gbd_io import ingest_key, read_gbd_filtered, read_workbook
+from instrumentation import set_rows, stage, traced
+from projection_engine import (HORIZONS, PROJECTION_KEYS, fit_series_joinpoints, project_series, projection_summary,
+                               uncovered_series)
+from stage_cache import MISS, cached, load, source_digest, stage_key
+
+DISEASES = ["Attention-deficit/hyperactivity disorder", "Autism spectrum disorders",
+            "Epilepsy", "Hearing loss", "Intellectual disability", "Vision loss"]
+LABELS = ["ADHD", "ASD", "Epilepsy", "Hearing Loss", "Intellectual disability", "Vision Loss"]
+DISEASE_COLORS = {
+    "Attention-deficit/hyperactivity disorder": "#0072B2",
+    "Autism spectrum disorders": "#E69F00",
+    "Epilepsy": "#009E73",
+    "Hearing loss": "#F0E442",
+    "Intellectual disability": "#D55E00",
+    "Vision loss": "#CC79A7"
+}
+MEASURES = ['Prevalence', 'DALYs']
+# the age group Figures 1 and 2 fit, whose fits the projection reuses
+FIGURE_AGE = '<20 years'
+METHOD_STYLES = {
+    'log-linear': dict(color='black', linestyle='--', label='Log-linear trend'),
+    'joinpoint': dict(color=None, linestyle='-', label='Joinpoint last segment'),
+    'apc': dict(color='#7F7F7F', linestyle=':', label='APC net drift'),
+}
+
+
+def projection_filters(diseases, measures, age, first_year=1990, last_year=2021):
+    return [
+        ('cause', 'in', diseases),
+        ('measure', 'in', measures),
+        ('age', '==', age),
+        ('metric', '==', 'Rate'),
+        ('year', 'between', (first_year, last_year)),
+    ]
+
+
+def figure2_aapc(file_path, age):
+    # Figure 2's cached log-linear fits (Global, Both, <20 years by cause and measure), or None until Figure 2 has run
+    if age != FIGURE_AGE:
+        return None
+    table = load(load_figure(2).aapc_cache_key(file_path, DISEASES))
+    if table is MISS:
+        return None
+    print(f"Reusing Figure 2's log-linear fits for {len(table)} Global/Both series")
+    return table.assign(location='Global', sex='Both', age=age)
+
+
+def figure1_joinpoints(workbook_path, use_cache=True):
+    # Figure 1's joinpoint segments: the workbook's Sheet3, or else Figure 1's cached fit of Sheet1;
+    # None when Figure 1 has neither
+    sheets = read_workbook(workbook_path, ['Sheet3'], use_cache=use_cache)
+    if 'Sheet3' in sheets:
+        print(f"Reusing joinpoint segments from {workbook_path} (Sheet3)")
+        return sheets['Sheet3']
+    if not use_cache:
+        return None
+    fit = load(load_figure(1).JoinpointAnalysisRefined(workbook_path).joinpoint_cache_key())
+    if fit is MISS:
+        return None
+    print(f"Reusing Figure 1's cached joinpoint fit of {workbook_path}")
+    return fit[0]
+
+
+def covered_series(table, keys=PROJECTION_KEYS):
+    # the series a reused table already covers, as part of the stage key of the remaining fits
+    if table is None:
+        return None
+    keys = [key for key in keys if key in table.columns]
+    return sorted(set(table[keys].astype(str).itertuples(index=False, name=None)))
+
+
+def fit_remaining(fit, reused, rest, key, use_cache):
+    # fits the series a figure's table does not cover (cached under their own key) and appends them to it
+    if rest.empty and reused is not None:
+        return reused
+    table = cached(key, lambda: fit(rest)) if use_cache else fit(rest)
+    return table if reused is None else pd.concat([reused, table], ignore_index=True)
+
+
+def plot_projection_panel(ax, observed, projection, cause, measure, last_year, show_ylabel):
+    color = DISEASE_COLORS.get(cause, '#7F7F7F')
+    if observed.empty:
+        ax.text(0.5, 0.5, 'Data Not Available', transform=ax.transAxes, ha='center', va='center',
+                fontsize=12, fontweight='bold',
+                bbox=dict(boxstyle="round,pad=0.3", facecolor="#F0F0F0", alpha=0.8))
+        return
+    if observed[['lower', 'upper']].notna().all(axis=None):
+        ax.fill_between(observed['year'], observed['lower'], observed['upper'], alpha=0.25, color='gray', zorder=1)
+    ax.plot(observed['year'], observed['val'], color=color, linewidth=3.5, alpha=0.9, zorder=3,
+            solid_capstyle='round')
+
+    for method, style in METHOD_STYLES.items():
+        rows = projection[projection['method'] == method]
+        if rows.empty:
+            continue
+        line_color = style['color'] or color
+        ax.plot(rows['year'], rows['val'], color=line_color, linestyle=style['linestyle'], linewidth=2.5,
+                alpha=0.9, zorder=4)
+        ax.fill_between(rows['year'], rows['lower'], rows['upper'], color=line_color, alpha=0.08, zorder=2)
+
+    ax.axvline(last_year, color='#999999', linestyle='-', linewidth=1, zorder=1)
+    ax.set_xlabel('Year', fontsize=11)
+    if show_ylabel:
+        ax.set_ylabel(f'{measure}\n(per 100,000, log scale)' if measure == 'DALYs' else f'{measure}\n(per 100,000)',
+                      fontsize=11)
+    if measure == 'DALYs' and (observed['val'] > 0).all():
+        ax.set_yscale('log')
+    end_year = int(projection['year'].max()) if len(projection) else last_year
+    ax.set_xlim(observed['year'].min() - 0.5, end_year + 0.5)
+    ax.set_xticks(list(range(int(observed['year'].min()), end_year + 1, 10)))
+    ax.grid(True, alpha=0.4, linestyle='-', linewidth=0.5)
+    for spine in ax.spines.values():
+        spine.set_color('#DDDDDD')
+        spine.set_linewidth(1)
+    ax.spines['top'].set_visible(False)
+    ax.spines['right'].set_visible(False)
+
+
+def plot_projection(data, projection, location, sex, age, measures, alpha=0.05):
+    # Figure 1 layout: disease titles, a Prevalence and a DALYs row, legend underneath
+    plt.style.use('default')
+    plt.rcParams.update({'font.size': 11, 'axes.titlesize': 14, 'axes.labelsize': 12,
+                         'xtick.labelsize': 10, 'ytick.labelsize': 10})
+    pick = lambda table: table[(table['location'].astype(str) == location) & (table['sex'].astype(str) == sex)
+                               & (table['age'].astype(str) == age)]
+    data, projection = pick(data), pick(projection)
+    last_year = int(data['year'].max())
+
+    fig = plt.figure(figsize=(24, 14))
+    gs_main = gridspec.GridSpec(3, 1, height_ratios=[0.08, 3, 0.15], hspace=0.08)
+    gs_titles = gridspec.GridSpecFromSubplotSpec(1, len(DISEASES), gs_main[0], wspace=0.2)
+    for i, (cause, label) in enumerate(zip(DISEASES, LABELS)):
+        ax_title = fig.add_subplot(gs_titles[0, i])
+        ax_title.axis('off')
+        ax_title.text(0.5, 0.5, label, ha='center', va='center', transform=ax_title.transAxes,
+                      fontsize=13, fontweight='bold', color=DISEASE_COLORS[cause])
+
+    gs_panels = gridspec.GridSpecFromSubplotSpec(len(measures), len(DISEASES), gs_main[1], hspace=0.2, wspace=0.2)
+    for row, measure in enumerate(measures):
+        for col, cause in enumerate(DISEASES):
+            with stage(f'render.{cause}.{measure}'):
+                ax = fig.add_subplot(gs_panels[row, col])
+                observed = data[(data['cause'].astype(str) == cause) & (data['measure'].astype(str) == measure)]
+                observed = observed.sort_values('year')
+                projected = projection[(projection['cause'] == cause) & (projection['measure'] == measure)]
+                plot_projection_panel(ax, observed, projected.sort_values('year'), cause, measure, last_year, col == 0)
+
+    ax_legend = fig.add_subplot(gs_main[2])
+    ax_legend.axis('off')
+    legend_elements = [
+        mpatches.Patch(color='gray', alpha=0.25, label='95% Uncertainty Intervals'),
+        plt.Line2D([0], [0], color='black', lw=3, label='Observed'),
+    ] + [plt.Line2D([0], [0], color=style['color'] or '#0072B2', lw=2.5, linestyle=style['linestyle'],
+                    label=style['label']) for method, style in METHOD_STYLES.items()
+         if (projection['method'] == method).any()] + [
+        mpatches.Patch(color='gray', alpha=0.1, label=f'{1 - alpha:.0%} prediction intervals'),
+    ]
+    ax_legend.legend(handles=legend_elements, bbox_to_anchor=(0.5, -0.1), loc='center',
+                     ncol=len(legend_elements), fontsize=12, frameon=False)
+    fig.suptitle(f'Projected trends to {int(projection["year"].max())}: {location}, {sex}, {age}',
+                 fontsize=16, fontweight='bold')
+    with stage('layout_adjust'):
+        fig.subplots_adjust(left=0.05, right=0.98, top=0.93, bottom=0.05)
+    return fig
+
+
+@traced('Projection')
+def run_projection(file_path, output_dir, data=None, workbook_path=None, location='Global', sex='Both',
+                   age='<20 years', horizons=HORIZONS, max_joinpoints=5, joinpoint_method='bic', apc=True,
+                   n_jobs=None, use_cache=True):
+    # series Figure 2 (log-linear) and Figure 1 (joinpoint, with --workbook) have already fitted are read from
+    # their stage cache entries; only the remaining series are fitted here, cached under the projection's own keys
+    os.makedirs(output_dir, exist_ok=True)
+    filters = projection_filters(DISEASES, MEASURES, age)
+    with stage('load_data'):
+        frame = read_gbd_filtered(file_path, filters, data, use_cache)
+        set_rows(len(frame))
+
+    with stage('statistics'):
+        reused = figure2_aapc(file_path, age) if use_cache else None
+        aapc_key = stage_key('aapc', ingest_key(file_path, filters), PROJECTION_KEYS, covered_series(reused),
+                             source_digest(aapc_engine, joinpoint_engine)) if use_cache else None
+        aapc_table = fit_remaining(lambda rest: grouped_log_linear(rest, PROJECTION_KEYS), reused,
+                                   uncovered_series(frame, reused, PROJECTION_KEYS), aapc_key, use_cache)
+        set_rows(len(aapc_table))
+
+    with stage('joinpoint'):
+        reused = figure1_joinpoints(workbook_path, use_cache) if workbook_path else None
+        joinpoint_key = stage_key('joinpoint', ingest_key(file_path, filters), PROJECTION_KEYS, max_joinpoints,
+                                  joinpoint_method, covered_series(reused),
+                                  source_digest(joinpoint_engine, projection_engine)) if use_cache else None
+        apc_table = fit_remaining(
+            lambda rest: fit_series_joinpoints(rest, PROJECTION_KEYS, max_joinpoints, joinpoint_method, n_jobs),
+            reused, uncovered_series(frame, reused, PROJECTION_KEYS), joinpoint_key, use_cache)
+        set_rows(len(apc_table))
+
+    drift_table = None
+    if apc:
+        from apc_analysis import load_apc_tables
+        # the net drift is fitted over the projected group's own age groups ('<20 years' -> <5 ... 15-19)
+        ages = component_ages(age)
+        with stage('apc'):
+            try:
+                if not ages or len(ages) < 3:
+                    raise ValueError(f"'{age}' is not made up of at least three {INTERVAL}-year age groups")
+                drift_table = load_apc_tables(file_path, data, use_cache=use_cache, ages=ages)[2]
+            except ValueError as e:
+                print(f"APC projection skipped: {e}")
+
+    with stage('projection'):
+        projection = project_series(frame, aapc_table, apc_table, drift_table, PROJECTION_KEYS, max(horizons))
+        summary = projection_summary(frame, projection, PROJECTION_KEYS, horizons)
+        set_rows(len(projection))
+    with stage('tables'):
+        projection.to_csv(os.path.join(output_dir, 'Projection_results.csv'), index=False)
+        summary.to_csv(os.path.join(output_dir, 'Projection_summary.csv'), index=False)
+    print(f"Projection tables saved: {len(summary)} horizon rows, methods: {', '.join(projection['method'].unique())}")
+
+    observed = frame[(frame['location'].astype(str) == location) & (frame['sex'].astype(str) == sex)]
+    if observed.empty:
+        print(f"No series for {location} / {sex}, figure skipped")
+        return True
+    fig = plot_projection(frame, projection, location, sex, age, MEASURES)
+    with stage('export'):
+        paths = export_figure(fig, os.path.join(output_dir, 'Projection_Analysis'), {'png': 300, 'pdf': None},
+                              facecolor='white', edgecolor='none')
+    print(f"Projection figure saved: {paths['png']}")
+    plt.close(fig)
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Project GBD trends to 2030/2040 with prediction intervals')
+    parser.add_argument('input', help='GBD export (csv, zip or directory)')
+    parser.add_argument('--output-dir', default=os.path.expanduser('~/Desktop/GBD'))
+    parser.add_argument('--workbook', help='Figure 1 workbook whose joinpoint segments (Sheet3, or its cached Sheet1 fit) are reused')
+    parser.add_argument('--location', default='Global', help='location shown in the figure')
+    parser.add_argument('--sex', default='Both', help='sex shown in the figure')
+    parser.add_argument('--age', default='<20 years', help='age group to project')
+    parser.add_argument('--horizons', type=int, nargs='+', default=list(HORIZONS))
+    parser.add_argument('--joinpoint-method', default='bic', choices=['bic', 'permutation'])
+    parser.add_argument('--no-apc', action='store_true', help='skip the age-period-cohort projection')
+    parser.add_argument('--jobs', type=int, default=None, help='worker processes for the model fits')
+    parser.add_argument('--no-cache', action='store_true')
+    args = parser.parse_args()
+    run_projection(args.input, args.output_dir, workbook_path=args.workbook, location=args.location, sex=args.sex,
+                   age=args.age, horizons=args.horizons, joinpoint_method=args.joinpoint_method,
+                   apc=not args.no_apc, n_jobs=args.jobs, use_cache=not args.no_cache)
@@ -0,0 +1,158 @@
+#Projection engine
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from joinpoint_engine import build_series_matrix, joinpoint_regression, t_critical
+
+PROJECTION_KEYS = ['location', 'sex', 'age', 'cause', 'measure']
+HORIZONS = (2030, 2040)
+METHODS = ['log-linear', 'joinpoint', 'apc']
+
+
+def _fit_chunk(task):
+    frame, keys, max_joinpoints, method = task
+    apc_table, _ = joinpoint_regression(frame, max_joinpoints=max_joinpoints, keys=keys, method=method, n_jobs=1)
+    return apc_table
+
+
+def fit_series_joinpoints(df, keys=PROJECTION_KEYS, max_joinpoints=5, method='bic', n_jobs=None):
+    # joinpoint fits (segment APC table) for every series, with the series split across a process pool
+    keys = [key for key in keys if key in df.columns]
+    n_jobs = max(1, n_jobs or os.cpu_count() or 1)
+    codes = df.groupby(keys, observed=True, sort=True).ngroup().to_numpy()
+    n_series = codes.max() + 1 if len(codes) else 0
+    n_chunks = max(1, min(n_series, 4 * n_jobs)) if n_jobs > 1 else 1
+    tasks = [(df[codes % n_chunks == i], keys, max_joinpoints, method) for i in range(n_chunks)]
+
+    if n_chunks == 1:
+        results = [_fit_chunk(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            results = list(pool.map(_fit_chunk, tasks))
+    return pd.concat(results, ignore_index=True)
+
+
+def uncovered_series(df, table, keys=PROJECTION_KEYS):
+    # rows of df whose series has no row in an already fitted table
+    if table is None or not len(table):
+        return df
+    keys = [key for key in keys if key in df.columns and key in table.columns]
+    if not keys:
+        return df
+    covered = pd.MultiIndex.from_frame(table[keys].astype(str))
+    series = pd.MultiIndex.from_frame(df[keys].astype(str))
+    return df[~series.isin(covered)]
+
+
+def _aligned(index, table, keys, columns):
+    # table rows in the order of the series matrix index (NaN where a series has no row)
+    table = table.astype({key: str for key in keys}).drop_duplicates(keys, keep='last').set_index(keys)
+    positions = table.index.get_indexer(index)
+    out = {}
+    for col in columns:
+        values = pd.to_numeric(table[col], errors='coerce').to_numpy(dtype=float)
+        out[col] = np.where(positions >= 0, values[np.maximum(positions, 0)], np.nan)
+    return out
+
+
+def _anchor(years, log_values, window_start, slope):
+    # level at the last observed year for a fixed slope (least squares over the anchor window),
+    # with the window's residual variance and size
+    last = np.array([years[np.isfinite(row)][-1] if np.isfinite(row).any() else np.nan for row in log_values])
+    in_window = np.isfinite(log_values) & (years[None, :] >= window_start[:, None])
+    detrended = np.where(in_window, log_values - slope[:, None] * (years[None, :] - last[:, None]), 0.0)
+    n = in_window.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        level = detrended.sum(axis=1) / n
+        resid = np.where(in_window, detrended - level[:, None], 0.0)
+        sigma2 = np.where(n > 1, (resid ** 2).sum(axis=1) / (n - 1), np.nan)
+    return last, level, sigma2, n
+
+
+def _long_projection(index, method, future, log_mean, log_se, t_crit):
+    n_series, n_years = log_mean.shape
+    frame = index.to_frame(index=False).loc[np.repeat(np.arange(n_series), n_years)].reset_index(drop=True)
+    frame['method'] = method
+    frame['year'] = np.tile(future, n_series)
+    frame['val'] = np.exp(log_mean).ravel()
+    frame['lower'] = np.exp(log_mean - t_crit[:, None] * log_se).ravel()
+    frame['upper'] = np.exp(log_mean + t_crit[:, None] * log_se).ravel()
+    return frame
+
+
+def project_series(df, aapc_table=None, apc_table=None, drift_table=None, keys=PROJECTION_KEYS,
+                   end_year=max(HORIZONS), alpha=0.05, anchor_years=5):
+    # Projects every series from already fitted models, without refitting:
+    #   log-linear - the grouped_log_linear line, with its OLS prediction interval
+    #   joinpoint  - the last segment's APC (Sheet3 / joinpoint_regression table), anchored on that segment
+    #   apc        - the age-period-cohort net drift, anchored on the last `anchor_years` years
+    # Intervals combine the slope's standard error with the residual variance around the fit.
+    keys = [key for key in keys if key in df.columns]
+    index, years, values = build_series_matrix(df, keys)
+    index = index.set_levels([level.astype(str) for level in index.levels]) if len(keys) > 1 else index.astype(str)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_values = np.where(values > 0, np.log(values), np.nan)
+    last_observed = int(years[np.isfinite(log_values).any(axis=0)][-1])
+    future = np.arange(last_observed + 1, end_year + 1)
+    frames = []
+
+    if aapc_table is not None and len(aapc_table):
+        fit = _aligned(index, aapc_table, keys, ['slope', 'intercept', 'year_origin', 'x_mean', 'sxx',
+                                                 'std_err', 'n'])
+        x = future[None, :] - fit['year_origin'][:, None]
+        log_mean = fit['intercept'][:, None] + fit['slope'][:, None] * x
+        with np.errstate(invalid='ignore'):
+            sigma2 = fit['std_err'] ** 2 * fit['sxx']
+            log_se = np.sqrt(sigma2[:, None] * (1 + 1 / fit['n'][:, None]
+                                                + (x - fit['x_mean'][:, None]) ** 2 / fit['sxx'][:, None]))
+        frames.append(_long_projection(index, 'log-linear', future, log_mean, log_se,
+                                       t_critical(fit['n'] - 2, alpha)))
+
+    n_obs = np.isfinite(log_values).sum(axis=1)
+    for method, table, slope_col, low_col, high_col, start in [
+        ('joinpoint', apc_table, 'APC', 'APC C.I. Low', 'APC C.I. High', 'Segment Start'),
+        ('apc', drift_table, 'net_drift', 'ci_low', 'ci_high', None),
+    ]:
+        if table is None or not len(table):
+            continue
+        table_keys, table_index = keys, index
+        if method == 'joinpoint':
+            table = table.sort_values('Segment Start')
+        elif 'age' in keys:
+            # net drifts summarize all ages of a location/sex/cause/measure, so every age series shares them
+            table_keys = [key for key in keys if key != 'age']
+            table_index = index.droplevel('age') if len(table_keys) > 1 else index.get_level_values(
+                [key for key in keys if key != 'age'][0])
+        extra = [col for col in ([start, 'Model'] if method == 'joinpoint' else ['dof']) if col in table.columns]
+        fit = _aligned(table_index, table, table_keys, [slope_col, low_col, high_col] + extra)
+        slope = np.log1p(fit[slope_col] / 100)
+        window_start = fit[start] if start in fit else np.full(len(index), last_observed - anchor_years + 1.0)
+        last, level, sigma2, n = _anchor(years, log_values, window_start, slope)
+        # degrees of freedom the table's interval was built with
+        if method == 'joinpoint':
+            model = np.where(np.isfinite(fit['Model']), fit['Model'], 0) if 'Model' in fit else 0
+            df_slope = n_obs - (model + 2.0)
+        else:
+            df_slope = fit['dof']
+        t_crit = t_critical(np.where(np.isfinite(df_slope), df_slope, 1), alpha)
+        slope_se = (np.log1p(fit[high_col] / 100) - np.log1p(fit[low_col] / 100)) / (2 * t_crit)
+        h = future[None, :] - last[:, None]
+        log_mean = level[:, None] + slope[:, None] * h
+        log_se = np.sqrt(sigma2[:, None] * (1 + 1 / n[:, None]) + (h * slope_se[:, None]) ** 2)
+        frames.append(_long_projection(index, method, future, log_mean, log_se, t_crit))
+
+    if not frames:
+        return pd.DataFrame(columns=keys + ['method', 'year', 'val', 'lower', 'upper'])
+    projection = pd.concat(frames, ignore_index=True)
+    return projection[np.isfinite(projection['val'])].reset_index(drop=True)
+
+
+def projection_summary(df, projection, keys=PROJECTION_KEYS, horizons=HORIZONS):
+    # projected values at each horizon next to the last observed value, with the percent change
+    keys = [key for key in keys if key in df.columns]
+    observed = df.astype({key: str for key in keys}).sort_values('year').drop_duplicates(keys, keep='last')
+    observed = observed[keys + ['year', 'val']].rename(columns={'year': 'last_year', 'val': 'last_val'})
+    summary = projection[projection['year'].isin(horizons)].merge(observed, on=keys, how='left')
+    summary['percent_change'] = (summary['val'] / summary['last_val'] - 1) * 100
+    return summary.sort_values(keys + ['method', 'year']).reset_index(drop=True)
@@ -0,0 +1,153 @@
+#Stage cache
+import glob
+import hashlib
+import json
+import os
+import pickle
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get('GBD_CACHE_DIR', os.path.expanduser('~/.cache/gbd'))
+DEFAULT_MAX_BYTES = int(os.environ.get('GBD_CACHE_MAX_BYTES', 2 * 1024 ** 3))
+ENABLED = os.environ.get('GBD_CACHE', '1') != '0'
+MISS = object()
+
+
+def source_digest(*objects):
+    # code version of a stage: the source of the functions/modules that compute it,
+    # or the bytes of a file path
+    import inspect
+
+    digest = hashlib.sha256()
+    for obj in objects:
+        if isinstance(obj, str):
+            with open(obj, 'rb') as f:
+                digest.update(f.read())
+        else:
+            digest.update(inspect.getsource(obj).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def stage_key(stage, *parts):
+    payload = json.dumps([CACHE_VERSION, stage, parts], default=str, sort_keys=True)
+    return f'{stage}-' + hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _input_files(path):
+    # same resolution rules as gbd_io.resolve_csv_sources, without importing pandas
+    if os.path.isdir(path):
+        return sorted(glob.glob(os.path.join(path, '*.zip')) + glob.glob(os.path.join(path, '*.csv')))
+    if os.path.exists(path):
+        return [path]
+    return sorted(glob.glob(path))
+
+
+def _file_sha256(file_path, block_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def input_digest(path, cache_dir=None):
+    # content hash of an input; memoized on (path, size, mtime) so re-runs skip re-hashing
+    digests = []
+    for file_path in _input_files(path):
+        stat = os.stat(file_path)
+        memo = stage_key('digest', os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)
+        digests.append(cached(memo, lambda: _file_sha256(file_path), cache_dir))
+    return hashlib.sha256(''.join(digests).encode('utf-8')).hexdigest()
+
+
+def cache_path(key, cache_dir=None, suffix='.pkl'):
+    return os.path.join(cache_dir or DEFAULT_CACHE_DIR, key[-2:], f'{key}{suffix}')
+
+
+def load(key, cache_dir=None):
+    if not ENABLED:
+        return MISS
+    path = cache_path(key, cache_dir)
+    try:
+        with open(path, 'rb') as f:
+            value = pickle.load(f)
+    except FileNotFoundError:
+        return MISS
+    except Exception as e:
+        print(f"Ignoring unreadable cache entry {path}: {e}")
+        return MISS
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return value
+
+
+def store(key, value, cache_dir=None, max_bytes=None):
+    if not ENABLED:
+        return
+    path = cache_path(key, cache_dir)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        print(f"Cache entry not written: {e}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return
+    evict(cache_dir, max_bytes)
+
+
+def cached(key, compute, cache_dir=None):
+    value = load(key, cache_dir)
+    if value is MISS:
+        value = compute()
+        store(key, value, cache_dir)
+    return value
+
+
+def evict(cache_dir=None, max_bytes=None):
+    # size-bounded LRU: hits refresh the entry's mtime, the oldest entries go first
+    cache_dir = cache_dir or DEFAULT_CACHE_DIR
+    max_bytes = DEFAULT_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    for bucket in os.scandir(cache_dir):
+        if bucket.is_dir():
+            for entry in os.scandir(bucket.path):
+                if not entry.name.endswith('.tmp'):
+                    try:
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def store_outputs(key, paths, cache_dir=None):
+    outputs = {}
+    for path in paths:
+        with open(path, 'rb') as f:
+            outputs[os.path.basename(path)] = f.read()
+    store(key, outputs, cache_dir)
+
+
+def restore_outputs(key, output_dir, cache_dir=None):
+    outputs = load(key, cache_dir)
+    if outputs is MISS:
+        return None
+    os.makedirs(output_dir, exist_ok=True)
+    for name, content in outputs.items():
+        with open(os.path.join(output_dir, name), 'wb') as f:
+            f.write(content)
+    return sorted(outputs)